@@ -0,0 +1,170 @@
+import numpy as np
+
+from dataqDecoder import ADC_FULL_SCALE_COUNTS
+
+"""
+Ring buffers that hold decoded scans as raw int16 counts. Counts take 2 bytes a sample instead of the 8 (ndarray)
+to 24+ (list of Python floats) bytes of a voltage, and nothing is scaled until a consumer asks for voltages.
+"""
+
+
+class DQScanRingBuffer:
+
+    def __init__(self, number_of_channels, capacity_scans, scales=None, counts=None, scans_written=None,
+                 scans_reserved=None):
+        """
+        Single writer, single reader ring of scans. The writer moves scans_reserved past the scans it is about to
+        overwrite before copying and scans_written once they are in place, the reader checks both so it never
+        returns scans that were overwritten while it copied them.
+        :param number_of_channels: scan list positions per scan
+        :param capacity_scans: scans held before the oldest unread ones are overwritten
+        :param scales: full scale voltage of each channel, used when voltages are requested
+        :param counts: optional (channels x capacity) int16 array to use as storage, e.g. in shared memory
+        :param scans_written: optional one element int64 array to use as the write position
+        :param scans_reserved: optional one element int64 array to use as the position being written up to
+        """
+        self.number_of_channels = number_of_channels
+        self.capacity_scans = capacity_scans
+
+        if scales is None:
+            scales = np.ones(number_of_channels)
+
+        self.scales = np.asarray(scales, dtype=float)
+
+        if counts is None:
+            counts = np.zeros(shape=(number_of_channels, capacity_scans), dtype=np.int16)
+
+        if scans_written is None:
+            scans_written = np.zeros(1, dtype=np.int64)
+
+        if scans_reserved is None:
+            scans_reserved = np.zeros(1, dtype=np.int64)
+
+        self.counts = counts
+        self.scans_written = scans_written
+        self.scans_reserved = scans_reserved
+
+        # reader side position
+        self.scans_read = 0
+        self.scans_overrun = 0
+
+    def get_scans_written(self):
+        return int(self.scans_written[0])
+
+    def get_scans_reserved(self):
+        return int(self.scans_reserved[0])
+
+    def get_memory_bytes(self):
+        return self.counts.nbytes
+
+    def counts_to_voltages(self, counts, channel_indices=None):
+        # convert count into a voltage, from page 67 of Protocol pdf
+        scales = self.scales if channel_indices is None else self.scales[channel_indices]
+        return scales[:, None] * (counts / ADC_FULL_SCALE_COUNTS)
+
+    def reserve(self, number_of_scans):
+        """
+        For writers that fill the slots themselves, e.g. the decode kernel: announce the scans about to be written
+        before touching their slots, then commit them once they are in place.
+        :param number_of_scans: scans about to be written, at most this many can be committed
+        :return: scan index the first of them goes to, its slot is that modulo capacity_scans
+        """
+        scans_written = self.get_scans_written()
+        self.scans_reserved[0] = scans_written + number_of_scans
+
+        return scans_written
+
+    def commit(self, number_of_scans):
+        """
+        Publish scans written after reserve, up to the number reserved.
+        """
+        self.scans_written[0] = self.get_scans_written() + number_of_scans
+
+    def write(self, counts: np.ndarray):
+        number_of_scans = counts.shape[1]
+
+        if number_of_scans == 0:
+            return
+
+        scans_written = self.reserve(number_of_scans)
+
+        if number_of_scans > self.capacity_scans:
+            # only the newest capacity worth can be kept
+            skipped_scans = number_of_scans - self.capacity_scans
+            counts = counts[:, skipped_scans:]
+            self.commit(skipped_scans)
+            scans_written += skipped_scans
+            number_of_scans = self.capacity_scans
+
+        start = scans_written % self.capacity_scans
+        first_part = min(number_of_scans, self.capacity_scans - start)
+
+        self.counts[:, start:start + first_part] = counts[:, :first_part]
+        self.counts[:, :number_of_scans - first_part] = counts[:, first_part:]
+
+        # publish only after the data is in place
+        self.commit(number_of_scans)
+
+    def __gather(self, first_scan_index, number_of_scans, channel_indices):
+        start = first_scan_index % self.capacity_scans
+        counts = self.counts if channel_indices is None else self.counts[channel_indices]
+
+        if start + number_of_scans <= self.capacity_scans:
+            return counts[:, start:start + number_of_scans].copy()
+
+        return np.concatenate((counts[:, start:], counts[:, :start + number_of_scans - self.capacity_scans]), axis=1)
+
+    def __drop_torn_scans(self, first_scan_index, counts):
+        """
+        Scans the writer started overwriting while they were copied can be a mix of old and new data.
+        :return: (first_scan_index, counts) without them
+        """
+        torn_scans = min(self.get_scans_reserved() - self.capacity_scans - first_scan_index, counts.shape[1])
+
+        if torn_scans <= 0:
+            return first_scan_index, counts
+
+        return first_scan_index + torn_scans, counts[:, torn_scans:]
+
+    def read(self, channel_indices=None):
+        """
+        Take everything written since the last read.
+        :return: (first_scan_index, counts)
+        """
+        scans_written = self.get_scans_written()
+
+        if scans_written - self.scans_read > self.capacity_scans:
+            # the writer lapped us, skip to the oldest scan still in the ring
+            self.scans_overrun += scans_written - self.capacity_scans - self.scans_read
+            self.scans_read = scans_written - self.capacity_scans
+
+        first_scan_index = self.scans_read
+        counts = self.__gather(first_scan_index, scans_written - first_scan_index, channel_indices)
+
+        torn_first_scan_index = first_scan_index
+        first_scan_index, counts = self.__drop_torn_scans(first_scan_index, counts)
+        self.scans_overrun += first_scan_index - torn_first_scan_index
+
+        self.scans_read = scans_written
+
+        return first_scan_index, counts
+
+    def read_voltages(self, channel_indices=None):
+        first_scan_index, counts = self.read(channel_indices)
+        return first_scan_index, self.counts_to_voltages(counts, channel_indices)
+
+    def latest(self, number_of_scans, channel_indices=None):
+        """
+        Look at the newest scans without moving the read position.
+        :return: (first_scan_index, counts), fewer scans than asked for if the ring doesn't hold that many yet
+        """
+        scans_written = self.get_scans_written()
+        number_of_scans = min(number_of_scans, scans_written, self.capacity_scans)
+        first_scan_index = scans_written - number_of_scans
+
+        return self.__drop_torn_scans(first_scan_index,
+                                      self.__gather(first_scan_index, number_of_scans, channel_indices))
+
+    def latest_voltages(self, number_of_scans, channel_indices=None):
+        first_scan_index, counts = self.latest(number_of_scans, channel_indices)
+        return first_scan_index, self.counts_to_voltages(counts, channel_indices)
@@ -0,0 +1,131 @@
+import json
+import os
+import numpy as np
+
+from dataqDecoder import ADC_FULL_SCALE_COUNTS
+
+"""
+Capture files meant to be opened with np.memmap. A fixed size header holds the capture metadata as JSON, it is
+followed by the raw int16 counts stored scan by scan (one row per scan, one column per scan list position), so a
+time range is one contiguous slice of the file and nothing outside it is ever read.
+
+Write them through dataqExport.DQCaptureExporter so the disk never holds up the receive path:
+
+    exporter = DQCaptureExporter(DQCaptureFileWriter(file_name, manager.get_capture_metadata()))
+    manager.add_decoded_block_handler(exporter.decoded_block_counts_handler)
+"""
+
+CAPTURE_FILE_MAGIC = b"DQCAP\x00\x01\x00"
+CAPTURE_FILE_HEADER_BYTES = 4096
+
+
+class DQCaptureFileWriter:
+
+    def __init__(self, file_name, metadata):
+        """
+        :param metadata: dict from dataqExport.make_capture_metadata, needs at least channel_scales and scan_rate_hz
+        """
+        self.file_name = file_name
+        self.number_of_channels = len(metadata["channel_scales"])
+        self.rows_written = 0
+
+        header = json.dumps(metadata).encode()
+        header_length = len(CAPTURE_FILE_MAGIC) + 4 + len(header)
+
+        if header_length > CAPTURE_FILE_HEADER_BYTES:
+            raise ValueError("capture metadata too large: " + str(header_length) + " bytes")
+
+        self.capture_file = open(file_name, "wb")
+        self.capture_file.write(CAPTURE_FILE_MAGIC)
+        self.capture_file.write(np.uint32(len(header)).tobytes())
+        self.capture_file.write(header)
+        self.capture_file.write(b"\x00" * (CAPTURE_FILE_HEADER_BYTES - header_length))
+
+    def write_chunk(self, counts: np.ndarray):
+        """
+        :param counts: (channels x scans) int16 counts, e.g. DQDecodedBlock.counts
+        """
+        if counts.shape[0] != self.number_of_channels:
+            raise ValueError("expected " + str(self.number_of_channels) + " channels, got " + str(counts.shape[0]))
+
+        self.capture_file.write(np.ascontiguousarray(counts.T, dtype='<i2').tobytes())
+        self.rows_written += counts.shape[1]
+
+    def close(self):
+        self.capture_file.close()
+
+
+class DQCaptureFileReader:
+
+    def __init__(self, file_name):
+        """
+        Only the header is read here. The scan count comes from the file size, so files still being written or
+        cut short by a crash can be opened too.
+        """
+        self.file_name = file_name
+
+        with open(file_name, "rb") as capture_file:
+            magic = capture_file.read(len(CAPTURE_FILE_MAGIC))
+
+            if magic != CAPTURE_FILE_MAGIC:
+                raise ValueError(file_name + " is not a capture file")
+
+            metadata_length = int(np.frombuffer(capture_file.read(4), dtype='<u4')[0])
+            self.metadata = json.loads(capture_file.read(metadata_length).decode())
+
+        self.channel_scales = np.asarray(self.metadata["channel_scales"], dtype=float)
+        self.number_of_channels = self.channel_scales.shape[0]
+        self.scan_rate_hz = float(self.metadata["scan_rate_hz"])
+
+        scan_bytes = 2 * self.number_of_channels
+        self.number_of_scans = (os.path.getsize(file_name) - CAPTURE_FILE_HEADER_BYTES) // scan_bytes
+
+        if self.number_of_scans > 0:
+            self.counts = np.memmap(file_name, dtype='<i2', mode="r", offset=CAPTURE_FILE_HEADER_BYTES,
+                                    shape=(self.number_of_scans, self.number_of_channels))
+        else:
+            self.counts = np.zeros((0, self.number_of_channels), dtype='<i2')
+
+    def get_duration_s(self):
+        return self.number_of_scans / self.scan_rate_hz
+
+    def time_to_scan_index(self, time_s):
+        # first scan at or after time_s, clamped to the capture
+        scan_index = int(np.ceil(time_s * self.scan_rate_hz - 1e-9))
+        return min(max(scan_index, 0), self.number_of_scans)
+
+    def read_counts(self, first_scan, end_scan, channel_indices=None):
+        """
+        :param first_scan: first scan to return
+        :param end_scan: one past the last scan to return
+        :param channel_indices: scan list positions to return, all by default
+        :return: (channels x scans) int16 counts, copied out of the file
+        """
+        first_scan = min(max(first_scan, 0), self.number_of_scans)
+        end_scan = min(max(end_scan, first_scan), self.number_of_scans)
+
+        rows = self.counts[first_scan:end_scan]
+
+        if channel_indices is not None:
+            rows = rows[:, channel_indices]
+
+        return np.array(rows.T)
+
+    def read_voltages(self, start_s, end_s, channel_indices=None):
+        """
+        :param start_s: seconds from the first scan, inclusive
+        :param end_s: seconds from the first scan, exclusive
+        :return: (time of the first returned scan in seconds, (channels x scans) voltages)
+        """
+        first_scan = self.time_to_scan_index(start_s)
+        end_scan = self.time_to_scan_index(end_s)
+
+        counts = self.read_counts(first_scan, end_scan, channel_indices)
+
+        scales = self.channel_scales if channel_indices is None else self.channel_scales[channel_indices]
+
+        return first_scan / self.scan_rate_hz, scales[:, None] * (counts / ADC_FULL_SCALE_COUNTS)
+
+    def close(self):
+        # the mapping goes away with the last reference to it
+        self.counts = None
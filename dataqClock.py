@@ -0,0 +1,188 @@
+import socket
+import struct
+import sys
+import threading
+import time
+import numpy as np
+
+"""
+Host side time keeping for the sample stream. Every received datagram is stamped with a host monotonic time and
+each device gets a running linear fit of host time against its scan count, which is then used to turn scan
+indices into host or wall clock times in bulk.
+"""
+
+# struct timespec as delivered with SO_TIMESTAMPNS
+TIMESPEC_STRUCT = struct.Struct("@ll")
+
+# not every Python build exports the constant, the value is fixed on Linux
+if hasattr(socket, "SO_TIMESTAMPNS"):
+    SO_TIMESTAMPNS = socket.SO_TIMESTAMPNS
+elif sys.platform.startswith("linux"):
+    SO_TIMESTAMPNS = 35
+else:
+    SO_TIMESTAMPNS = None
+
+
+def enable_kernel_timestamps(udp_socket):
+    """
+    Ask the kernel to stamp every datagram on arrival. Only available on Linux.
+    :return: True if kernel timestamps will be delivered with recvmsg
+    """
+    if SO_TIMESTAMPNS is None:
+        return False
+
+    try:
+        udp_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except OSError:
+        return False
+
+    return True
+
+
+def receive_timestamped(udp_socket, buffer_size, kernel_timestamps_enabled):
+    """
+    :return: (datagram, host monotonic time in ns). The kernel timestamp is on the realtime clock, so it is moved
+    onto the monotonic clock with an offset sampled right after the receive.
+    """
+    if not kernel_timestamps_enabled:
+        datagram = udp_socket.recv(buffer_size)
+        return datagram, time.monotonic_ns()
+
+    datagram, ancillary_data, flags, address = udp_socket.recvmsg(buffer_size,
+                                                                  socket.CMSG_SPACE(TIMESPEC_STRUCT.size))
+
+    monotonic_now_ns = time.monotonic_ns()
+    realtime_now_ns = time.time_ns()
+
+    for level, message_type, data in ancillary_data:
+        if level == socket.SOL_SOCKET and message_type == SO_TIMESTAMPNS:
+            seconds, nanoseconds = TIMESPEC_STRUCT.unpack(data[:TIMESPEC_STRUCT.size])
+            kernel_realtime_ns = seconds * 1000000000 + nanoseconds
+            return datagram, monotonic_now_ns - (realtime_now_ns - kernel_realtime_ns)
+
+    return datagram, monotonic_now_ns
+
+
+class DQSampleClockModel:
+
+    def __init__(self, nominal_scan_rate_hz=None, forgetting_factor=0.999):
+        """
+        Weighted least squares fit of host time = offset + period * scan index, where older observations fade by
+        forgetting_factor per packet so the fit follows slow drift of the device oscillator.
+        :param nominal_scan_rate_hz: used until there are enough observations for a fit
+        :param forgetting_factor: weight decay per observation, 1.0 keeps everything
+        """
+        self.nominal_scan_rate_hz = nominal_scan_rate_hz
+        self.forgetting_factor = forgetting_factor
+
+        # observations are kept relative to the latest point so the sums stay small on long runs
+        self.reference_scan_index = 0.0
+        self.reference_host_time_ns = 0
+        self.sum_weight = 0.0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+
+        self.observation_count = 0
+
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.reference_scan_index = 0.0
+            self.reference_host_time_ns = 0
+            self.sum_weight = 0.0
+            self.sum_x = 0.0
+            self.sum_y = 0.0
+            self.sum_xx = 0.0
+            self.sum_xy = 0.0
+            self.observation_count = 0
+
+    def add_observation(self, scan_index, host_time_ns):
+        """
+        :param scan_index: scans (possibly fractional) the device had sent when the datagram was stamped
+        :param host_time_ns: host monotonic receive time of that datagram
+        """
+        with self.lock:
+            if self.observation_count == 0:
+                self.reference_scan_index = float(scan_index)
+                self.reference_host_time_ns = host_time_ns
+
+            # move the origin onto the new point
+            dx = float(scan_index) - self.reference_scan_index
+            dy = (host_time_ns - self.reference_host_time_ns) * 1e-9
+
+            self.sum_xx = self.sum_xx - 2 * dx * self.sum_x + dx * dx * self.sum_weight
+            self.sum_xy = self.sum_xy - dx * self.sum_y - dy * self.sum_x + dx * dy * self.sum_weight
+            self.sum_x = self.sum_x - dx * self.sum_weight
+            self.sum_y = self.sum_y - dy * self.sum_weight
+
+            self.reference_scan_index = float(scan_index)
+            self.reference_host_time_ns = host_time_ns
+
+            # age the old observations and add the new one, which sits at the origin
+            self.sum_weight = self.sum_weight * self.forgetting_factor + 1.0
+            self.sum_x *= self.forgetting_factor
+            self.sum_y *= self.forgetting_factor
+            self.sum_xx *= self.forgetting_factor
+            self.sum_xy *= self.forgetting_factor
+
+            self.observation_count += 1
+
+    def get_fit(self):
+        """
+        :return: (reference_scan_index, reference_host_time_ns, seconds at the reference relative to the reference
+        host time, seconds per scan). None before the first observation.
+        """
+        with self.lock:
+            if self.observation_count == 0:
+                return None
+
+            denominator = self.sum_weight * self.sum_xx - self.sum_x * self.sum_x
+
+            if self.observation_count < 2 or denominator <= 0:
+                if not self.nominal_scan_rate_hz:
+                    return None
+                period_sec = 1.0 / self.nominal_scan_rate_hz
+            else:
+                period_sec = (self.sum_weight * self.sum_xy - self.sum_x * self.sum_y) / denominator
+
+            intercept_sec = (self.sum_y - period_sec * self.sum_x) / self.sum_weight
+
+            return self.reference_scan_index, self.reference_host_time_ns, intercept_sec, period_sec
+
+    def get_scan_rate_hz(self):
+        fit = self.get_fit()
+
+        if fit is None or fit[3] <= 0:
+            return self.nominal_scan_rate_hz
+
+        return 1.0 / fit[3]
+
+    def scan_index_to_host_time_ns(self, scan_indices):
+        """
+        Vectorized conversion of scan indices to host monotonic time.
+        :return: int64 array of nanoseconds, None if no fit is available yet
+        """
+        fit = self.get_fit()
+
+        if fit is None:
+            return None
+
+        reference_scan_index, reference_host_time_ns, intercept_sec, period_sec = fit
+
+        offsets_sec = intercept_sec + (np.asarray(scan_indices, dtype=float) - reference_scan_index) * period_sec
+
+        return reference_host_time_ns + np.rint(offsets_sec * 1e9).astype(np.int64)
+
+    def scan_index_to_wall_time_ns(self, scan_indices):
+        """
+        Same as scan_index_to_host_time_ns but on the realtime clock (ns since the epoch).
+        """
+        host_times_ns = self.scan_index_to_host_time_ns(scan_indices)
+
+        if host_times_ns is None:
+            return None
+
+        return host_times_ns + (time.time_ns() - time.monotonic_ns())
@@ -1,12 +1,27 @@
+from collections import deque
 from dataclasses import dataclass
 from enum import IntEnum
 from typing import List
 import socket
+import struct
 import logging
-import sys
 import threading
 import time
-import numpy as np
+
+from dataqBuffers import DQScanRingBuffer
+from dataqClock import DQSampleClockModel, enable_kernel_timestamps, receive_timestamped
+from dataqDeviceInfo import DQDeviceInfo, DQDeviceInfoCache, DQInfoRequests, STATIC_INFO_FIELDS, \
+    parse_info_response
+from dataqExport import make_capture_metadata
+from dataqKeepAlive import DQKeepAliveRegistration, get_keep_alive_scheduler
+from dataqMetrics import DQMetricsRegistry
+from dataqProfiler import profiler
+from dataqPacketTuning import packet_size_to_samples, DQPacketSizeTuner, DQPacketSizeMeasurement, DQPacketSizeReport
+from dataqRatePlanner import DQSampleRatePlanner
+from dataqSupervisor import DQConnectionSupervisor, DQGapRecord, GAP_KIND_MISSING_SAMPLES, GAP_KIND_OUTAGE
+from dataqDecoder import DQDeviceDecoder, CHANNEL_KIND_ANALOG, CHANNEL_KIND_DIGITAL, CHANNEL_KIND_COUNTER, \
+    CHANNEL_KIND_RAW, pack_digital_lines, unwrap_cumulative_count
+from dataqSync import DQSyncFrameAssembler
 
 """
 https://www.dataq.com/products/di-4108-e/
@@ -53,14 +68,8 @@ class DQEnums:
         PS_1024_BYTES = 6
         PS_2048_BYTES = 7
 
-    @dataclass()
-    class InfoRequests(IntEnum):
-        MFG = 0
-        MODEL = 1
-        FIRMWARE_REV = 2
-        DEVICE_STRING = 5
-        SERIAL_NO = 6
-        SAMPLE_RATE = 9
+    # defined with the info cache that keys on it
+    InfoRequests = DQInfoRequests
 
     @dataclass()
     class DeviceRole(IntEnum):
@@ -89,21 +98,6 @@ class DQEnums:
 
     @dataclass()
     class DQ4108:
-        # rate in hz: [dec, deca]
-        PreCalculatedDecDecaDict = {
-            1: [512, 2],
-            10: [300, 2],
-            100: [10, 1],
-            250: [4, 1],
-            500: [2, 1],
-            750: [2, 1],
-            1000: [1, 1],
-            2500: [1, 1],
-            5000: [1, 1],
-            7500: [1, 1],
-            10000: [1, 1]
-        }
-
         @dataclass()
         class ScanRateLimits(IntEnum):
             SRATE_MIN = 375
@@ -162,15 +156,16 @@ class DQMasks:
                 ch7 = 6 << __bit_shift
                 ch8 = 7 << __bit_shift
 
+            # slist channel numbers 8 and 10 per the Protocol pdf, 4 and 6 collided with AnalogIn ch5 and ch7
             @dataclass()
             class DigitalIn:
                 __bit_shift = 0
-                ch1 = 4 << __bit_shift
+                ch1 = 8 << __bit_shift
 
             @dataclass()
             class CountIn:
                 __bit_shift = 0
-                ch1 = 6 << __bit_shift
+                ch1 = 10 << __bit_shift
 
 
 # maybe one day make the class iterable?
@@ -190,6 +185,7 @@ class DQDataStructures:
             analog8: List[float]
             digital1: List[int]
             digital2: List[int]
+            counter1: List[int]
 
             # channel_carryover_index keeps track of which channel the first byte within the received packet should go
             # to. For example, if three channels are being sampled and the packet size is 4, the first three bytes
@@ -199,6 +195,27 @@ class DQDataStructures:
             cumulative_samples_received_this_device: int
             cumulative_missing_samples_this_device: int
 
+        # scan list channel to the BinaryStreamOutput list its samples are stored in
+        AnalogChannelFields = {
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch1: "analog1",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch2: "analog2",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch3: "analog3",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch4: "analog4",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch5: "analog5",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch6: "analog6",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch7: "analog7",
+            DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch8: "analog8"
+        }
+
+        # digital inputs are stored packed, one integer of line states per scan
+        DigitalChannelFields = {
+            DQMasks.DQ4108.ScanListDefinition.DigitalIn.ch1: "digital1"
+        }
+
+        CounterChannelFields = {
+            DQMasks.DQ4108.ScanListDefinition.CountIn.ch1: "counter1"
+        }
+
 
 @dataclass()
 class DQCommandResponseStructures:
@@ -230,6 +247,32 @@ class DQCommandResponseStructures:
         adc_data: int  # note this should be short but python does not have this a a type...
 
 
+# id, public_key, command, par1, par2, par3 - the payload text follows
+DQCOMMAND_HEADER_STRUCT = struct.Struct('<6I')
+
+
+def encode_command(dq_command):
+    return DQCOMMAND_HEADER_STRUCT.pack(dq_command.id, dq_command.public_key, dq_command.command, dq_command.par1,
+                                        dq_command.par2, dq_command.par3) + dq_command.payload.encode('utf-8')
+
+
+def parse_slave_delay_response(payload):
+    """
+    :param payload: DQRESPONSE text of FINDOUTSLAVEDELAY, the command echo with the delay as its final field
+    :return: signed delay in microseconds, negative when the slave starts ahead of the master. None if the final
+    field isn't an integer
+    """
+    fields = payload.strip().split()
+
+    if not fields:
+        return None
+
+    try:
+        return int(fields[-1])
+    except ValueError:
+        return None
+
+
 @dataclass()
 class DQPorts:
     # port numbers are from the loggers perspective
@@ -258,29 +301,45 @@ class DQSampleConfiguration:
 
 
 class DQDataContainer:
-    def __init__(self, device_order, dq_data_structure: DQDataStructures):
+    def __init__(self, device_order, dq_data_structure: DQDataStructures, dq_decoder: DQDeviceDecoder = None):
         self.device_order = device_order
         self.dq_data_structure = dq_data_structure
+        self.dq_decoder = dq_decoder
+        # only used with count storage, see DataqCommsManager.enable_count_storage
+        self.count_buffer = None
 
 
 class DataqCommsManager:
 
-    def __init__(self, dq_ports, logger_ip, client_ip):
+    def __init__(self, dq_ports, logger_ip, client_ip, device_info_cache_file=None):
+        """
+        :param dq_ports: DQPorts shared by every logger
+        :param logger_ip: IP of a single logger, or a list of IPs for a sync group. The list order is the device
+        order within the group, the first logger is the master.
+        :param client_ip: IP the loggers should stream to
+        :param device_info_cache_file: JSON file that keeps device info between runs, in memory only if None
+        """
         self.log = logging.getLogger("DataqCommsManager")
 
         self.recv_buffer_size = 1024 * 1024 * 1  # ~X MBs
 
+        if isinstance(logger_ip, str):
+            self.logger_ips = [logger_ip]
+        else:
+            self.logger_ips = list(logger_ip)
+
         self.dq_ports = dq_ports
-        self.logger_ip = logger_ip
+        self.logger_ip = self.logger_ips[0]
         self.client_ip = client_ip
 
-        # drowan_NOTES_20200618: Only one device used so setting to 1
-        self.sync_device_count = 1
+        self.sync_device_count = len(self.logger_ips)
         self.receive_timeout_sec = 5
 
-        self.keep_alive_thread_enable = False
-        self.keep_alive_thread = None
-        self.keep_alive_thread_event = threading.Event()
+        # the "keepalive" setting uploaded to every logger, the keep alive interval follows from it. The loggers are
+        # registered with the process wide scheduler while connected
+        self.keep_alive_timeout_ms = 8000
+        self.keep_alive_registration = DQKeepAliveRegistration(self.send_keep_alive, self.sync_device_count,
+                                                               self.keep_alive_timeout_ms)
 
         self.receive_data_thread_enable = False
         self.receive_data_thread = None
@@ -292,6 +351,29 @@ class DataqCommsManager:
 
         self.set_sample_rate_hz = 10
 
+        # stall detection, reconnects and the gap index
+        self.connection_supervisor = DQConnectionSupervisor()
+        self.acquisition_running = False
+        # first wait between failed reconnects, doubled after each failure up to the maximum
+        self.recovery_retry_interval_s = 0.1
+        self.recovery_retry_max_interval_s = 5.0
+        # set by stop_acquisition and disconnect_device to cut a wait between reconnects short
+        self.recovery_stop_event = threading.Event()
+
+        # host time spent on each received DQADCDATA datagram, see calibrate_packet_size
+        self.packets_processed = 0
+        self.packet_processing_ns = 0
+
+        # see setup_metrics, export with metrics.to_prometheus_text, metrics.to_json or start_metrics_server
+        self.metrics = DQMetricsRegistry()
+        self.setup_metrics()
+
+        # spans around receive, decode and handler dispatch, off unless enabled or DATAQ_PROFILE is set
+        self.profiler = profiler
+
+        # see set_sample_rate, replace with a planner given a cache_file to keep plans between runs
+        self.sample_rate_planner = DQSampleRatePlanner(DQEnums.DQ4108.ScanRateLimits)
+
         self.buffer_overflow_detected = False
         self.buffer_overflow_exception_count = 0
 
@@ -316,6 +398,7 @@ class DataqCommsManager:
             __analog_ch8_list = []
             __digital_ch1_list = []
             __digital_ch2_list = []
+            __counter_ch1_list = []
             __carryover_channel_index = 0
             __cumulative_samples_received = 0
             __cumulative_missing_samples = 0
@@ -332,6 +415,7 @@ class DataqCommsManager:
                 __analog_ch8_list,
                 __digital_ch1_list,
                 __digital_ch2_list,
+                __counter_ch1_list,
                 __carryover_channel_index,
                 __cumulative_samples_received,
                 __cumulative_missing_samples
@@ -339,6 +423,40 @@ class DataqCommsManager:
 
             self.dataq_group_container.append(DQDataContainer(device_order, dataq_logger_data))
 
+        # lines up the decoded scans of every device in the group
+        self.sync_frame_assembler = DQSyncFrameAssembler(self.sync_device_count)
+        self.sync_frame_assembly_enable = self.sync_device_count > 1
+
+        # host receive time of each datagram and a per device fit of host time against scan count
+        self.kernel_timestamps_enabled = False
+        self.sample_clock_models = [DQSampleClockModel() for _ in range(self.sync_device_count)]
+        # unwrapped cumulative count each device's next packet should report, the decoders keep their own (in the
+        # workers with sharded decode)
+        self.sample_clock_cumulative_counts = [0] * self.sync_device_count
+        # scans added to each device's clock scan index when its count went backwards outside of an outage
+        self.sample_clock_scan_offsets = [0.0] * self.sync_device_count
+
+        # called with every DQDecodedBlock, this is where statistics, filters, recorders etc. attach
+        self.decoded_block_handlers = []
+
+        # keep raw int16 counts in a ring per device instead of appending voltages to the channel lists
+        self.count_storage_capacity_scans = None
+
+        # (device order, payload) of every DQRESPONSE not yet taken by receive_response, filled in by
+        # process_response on whichever thread reads the socket
+        self.command_responses = deque(maxlen=64)
+        self.command_response_condition = threading.Condition()
+
+        # see add_foreign_datagram_handler
+        self.foreign_datagram_handlers = []
+
+        # serial numbers already known for each device, from discovery or an earlier query, see get_device_info
+        self.device_serial_numbers = [None] * self.sync_device_count
+        self.device_info_cache = DQDeviceInfoCache(device_info_cache_file)
+
+        # when set, DQADCDATA packets are decoded in one worker process per device instead of in process_response
+        self.sharded_decode_coordinator = None
+
         """
         # drowan_NOTES_20200624: The variables between this note and the string of ### is
         # used for the C# port that I attempted. I am keeping it here for context.
@@ -361,6 +479,8 @@ class DataqCommsManager:
 
         # Where to send the data I think, need to look further into this...
         self.dataq_server_address_and_port = (self.logger_ip, self.dq_ports.logger_command_local_port)
+        self.dataq_device_addresses_and_ports = [(ip, self.dq_ports.logger_command_local_port)
+                                                 for ip in self.logger_ips]
 
         # UDP Command Socket Setup
         self.udp_command_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
@@ -372,6 +492,85 @@ class DataqCommsManager:
         self.udp_response_socket.settimeout(self.receive_timeout_sec)
         self.client_inbound_address_and_port = ("0.0.0.0", self.dq_ports.logger_discovery_remote_port)
 
+    def setup_metrics(self):
+        """
+        Create the pipeline metrics. The per packet ones are kept as attributes so the receive path never looks
+        anything up in the registry.
+        """
+        metrics = self.metrics
+
+        self.metric_packets_received = [metrics.counter("packets_received_total", "DQADCDATA packets received",
+                                                        device=device_order)
+                                        for device_order in range(self.sync_device_count)]
+        self.metric_samples_decoded = [metrics.counter("samples_decoded_total", "samples decoded",
+                                                       device=device_order)
+                                       for device_order in range(self.sync_device_count)]
+        self.metric_samples_gap_filled = [metrics.counter("samples_gap_filled_total",
+                                                          "samples the device sent that never arrived, filled in",
+                                                          device=device_order)
+                                          for device_order in range(self.sync_device_count)]
+        self.metric_responses_received = metrics.counter("responses_received_total", "DQRESPONSE packets received")
+        self.metric_packets_rejected = metrics.counter("packets_rejected_total",
+                                                       "packets from an unknown device order or of an unknown id")
+        self.metric_recoveries = metrics.counter("recovery_attempts_total", "reconnects after a stall")
+
+        self.metric_decode_seconds = metrics.histogram("decode_seconds", "decode time per DQADCDATA packet")
+        self.metric_block_handler_seconds = metrics.histogram("handler_seconds",
+                                                              "time spent in handlers per packet",
+                                                              handler="decoded_block")
+        self.metric_receive_handler_seconds = metrics.histogram("handler_seconds",
+                                                                "time spent in handlers per packet",
+                                                                handler="receive_data")
+        self.metric_receive_to_handler_seconds = metrics.histogram(
+            "receive_to_handler_seconds", "socket receive to receive_data_handler call")
+
+        for device_order in range(self.sync_device_count):
+            metrics.gauge("queue_depth", "items waiting per pipeline stage", stage="sync_frame_assembler",
+                          device=device_order).set_function(
+                lambda device_order=device_order: self.sync_frame_assembler.pending_scan_counts[device_order])
+            metrics.gauge("queue_depth", "items waiting per pipeline stage", stage="sharded_decode",
+                          device=device_order).set_function(
+                lambda device_order=device_order: 0 if self.sharded_decode_coordinator is None else
+                self.sharded_decode_coordinator.get_queue_depth(device_order))
+            # the counters above stay at 0 when the workers decode, these read the worker rings instead
+            metrics.gauge("sharded_samples_received", "device samples accounted for by the decode worker",
+                          device=device_order).set_function(
+                lambda device_order=device_order: self.get_sharded_decode_counter(device_order,
+                                                                                 "cumulative_samples_received"))
+            metrics.gauge("sharded_samples_gap_filled", "samples the decode worker filled in",
+                          device=device_order).set_function(
+                lambda device_order=device_order: self.get_sharded_decode_counter(device_order,
+                                                                                 "cumulative_missing_samples"))
+
+        metrics.gauge("receive_buffer_bytes", "receive buffer size requested for the response socket").set_function(
+            lambda: self.recv_buffer_size)
+
+    def get_sharded_decode_counter(self, device_order, counter_name):
+        """
+        :param counter_name: key of DQShardedDecodeCoordinator.get_device_counters
+        :return: the worker's counter, 0 when not decoding in workers
+        """
+        coordinator = self.sharded_decode_coordinator
+
+        if coordinator is None or device_order >= len(coordinator.scan_rings):
+            return 0
+
+        return coordinator.get_device_counters(device_order)[counter_name]
+
+    def get_sharded_decode_totals(self):
+        """
+        :return: get_sharded_decode_counter values summed over the devices
+        """
+        return {counter_name: sum(self.get_sharded_decode_counter(device_order, counter_name)
+                                  for device_order in range(self.sync_device_count))
+                for counter_name in ("scans_written", "cumulative_missing_samples", "packets_decoded")}
+
+    def start_metrics_server(self, port, host="127.0.0.1"):
+        """
+        Serve /metrics (Prometheus text) and /metrics.json until disconnect_device.
+        """
+        self.metrics.serve(port, host)
+
     def set_receive_buffer_size(self, size_in_bytes):
         self.recv_buffer_size = size_in_bytes
 
@@ -390,12 +589,29 @@ class DataqCommsManager:
             self.log.exception(name + ": ")
             return 0
 
+        # falls back to stamping in user space if the kernel can't do it
+        self.kernel_timestamps_enabled = enable_kernel_timestamps(self.udp_response_socket)
+        self.log.info(name + ": kernel timestamps " + str(self.kernel_timestamps_enabled))
+
         # drowan_TODO_20200624: test the connection
 
         # everything went OK
         return 1
 
+    def get_device_role(self, device_order):
+        # a lone logger keeps whatever role it was configured with, a group has one master and the rest slaves
+        if self.sync_device_count == 1:
+            return self.device_configuration.device_role
+        elif device_order == 0:
+            return DQEnums.DeviceRole.MASTER
+        else:
+            return DQEnums.DeviceRole.SLAVE
+
     def configure_and_connect_device(self, configuration: DQDeviceConfiguration, receive_data_handler):
+        """
+        Configure every logger in the group with the same scan list and sample configuration.
+        :return: True if every logger acknowledged the connection and configuration, see connect_devices
+        """
         name = "configure_and_connect_device"
         self.log.info(name + ": " + repr(configuration))
 
@@ -405,99 +621,437 @@ class DataqCommsManager:
 
         scan_list = configuration.s_list
 
-        # configure key, connection, role, group
+        channel_scales = [self.get_voltage_scale_for_channel(channel_index)
+                          for channel_index in range(len(scan_list))]
+        channel_kinds = self.get_channel_kinds()
+
+        for device_order in range(self.sync_device_count):
+            self.dataq_group_container[device_order].dq_decoder = DQDeviceDecoder(device_order, channel_scales,
+                                                                                  channel_kinds)
+
+            if self.count_storage_capacity_scans is not None:
+                self.dataq_group_container[device_order].count_buffer = DQScanRingBuffer(
+                    len(scan_list), self.count_storage_capacity_scans, channel_scales)
+
+        connected = self.connect_devices()
+
+        self.keep_alive_registration.set_keep_alive_timeout_ms(self.keep_alive_timeout_ms)
+        get_keep_alive_scheduler().add(self.keep_alive_registration)
+
+        return connected
+
+    def connect_devices(self, response_timeout_s=1.0):
+        """
+        CONNECT every logger, upload the configuration and tell the master about its slaves. Used for the first
+        connection and again by recover_connection.
+        :return: True if every step was acknowledged
+        """
+        name = "connect_devices"
+        self.log.info(name)
+
+        connected = True
+
+        for device_order in range(self.sync_device_count):
+            # configure key, connection, role, group
+            dq_command = DQCommandResponseStructures.DQCommand(
+                id=DQEnums.ID.DQCOMMAND,
+                public_key=self.device_configuration.device_group_key_id,
+                command=DQEnums.Command.CONNECT,
+                par1=self.dq_ports.logger_discovery_remote_port,
+                par2=self.get_device_role(device_order),
+                par3=self.device_configuration.device_group_order + device_order,
+                payload=self.client_ip
+            )
+
+            command_ok = self.send_command(dq_command, False, device_order, response_timeout_s)
+
+            if not command_ok:
+                self.log.error(name + ": command error on device " + str(device_order))
+                connected = False
+
+        # encode, ps, srate, dec, deca, keepalive and the scan list, pipelined across the whole group
+        if not self.upload_configuration(response_timeout_s=response_timeout_s):
+            self.log.error(name + ": configuration upload could not be verified")
+            connected = False
+
+        # tell the master which loggers it is driving
+        for device_order in range(1, self.sync_device_count):
+            dq_command = DQCommandResponseStructures.DQCommand(
+                id=DQEnums.ID.DQCOMMAND,
+                public_key=self.device_configuration.device_group_key_id,
+                command=DQEnums.Command.SLAVEIP,
+                par1=device_order,
+                par2=0,
+                par3=0,
+                payload=self.logger_ips[device_order]
+            )
+
+            command_ok = self.send_command(dq_command, False, 0, response_timeout_s)
+
+            if not command_ok:
+                self.log.error(name + ": slave ip command error on device " + str(device_order))
+                connected = False
+
+        return connected
+
+    def build_configuration_commands(self):
+        """
+        :return: every SECONDCOMMAND a logger needs after CONNECT, in the order they have to be applied
+        """
+        setting_payloads = [
+            "encode " + str(int(self.device_configuration.encode)),
+            "ps " + str(int(self.device_configuration.ps)),
+            "srate " + str(int(self.device_sample_configuration.s_rate)),
+            "dec " + str(int(self.device_sample_configuration.dec)),
+            "deca " + str(int(self.device_sample_configuration.deca)),
+            "keepalive " + str(int(self.keep_alive_timeout_ms))
+        ]
+
+        # slist positions must be defined sequentially beginning with position 0
+        scan_list = self.device_configuration.s_list
+        for scan_position, scan_config in enumerate(scan_list):
+            setting_payloads.append("slist " + str(scan_position) + " " + str(scan_config | scan_list[scan_config]))
+
+        return [DQCommandResponseStructures.DQCommand(
+            id=DQEnums.ID.DQCOMMAND,
+            public_key=self.device_configuration.device_group_key_id,
+            command=DQEnums.Command.SECONDCOMMAND,
+            par1=0,
+            par2=0,
+            par3=0,
+            payload=setting_payload + "\r"
+        ) for setting_payload in setting_payloads]
+
+    def upload_configuration(self, pipeline_depth=8, response_timeout_s=1.0):
+        """
+        Send the configuration to every logger without waiting on each echo in turn. Up to pipeline_depth
+        commands per logger are in flight, each echo releases the next command. If an echo is still missing after
+        response_timeout_s of silence, everything from that command on is sent again one command at a time so the
+        logger applies them in order.
+        :return: True if every logger echoed back exactly the settings that were sent
+        """
+        name = "upload_configuration"
+
+        dq_commands = self.build_configuration_commands()
+        encoded_commands = [encode_command(dq_command) for dq_command in dq_commands]
+        expected_echoes = [" ".join(dq_command.payload.split()) for dq_command in dq_commands]
+        number_of_commands = len(dq_commands)
+
+        next_to_send = [0] * self.sync_device_count
+        next_to_acknowledge = [0] * self.sync_device_count
+        echoes = [[None] * number_of_commands for device_order in range(self.sync_device_count)]
+
+        def send_next(device_order):
+            while next_to_send[device_order] < min(number_of_commands,
+                                                   next_to_acknowledge[device_order] + pipeline_depth):
+                self.udp_command_socket.sendto(encoded_commands[next_to_send[device_order]],
+                                               self.dataq_device_addresses_and_ports[device_order])
+                self.keep_alive_registration.note_command_sent(device_order)
+                next_to_send[device_order] += 1
+
+        self.discard_command_responses()
+
+        for device_order in range(self.sync_device_count):
+            send_next(device_order)
+
+        while min(next_to_acknowledge) < number_of_commands:
+            command_response = self.receive_response(response_timeout_s=response_timeout_s)
+
+            if command_response is None:
+                break
+
+            device_order = command_response[0]
+            echo = " ".join(command_response[1].split())
+
+            # match against everything in flight so a lost echo doesn't stall the rest. An exact match first,
+            # then the oldest command of the same kind in case the logger changed the value
+            in_flight = [command_index for command_index in range(next_to_acknowledge[device_order],
+                                                                  next_to_send[device_order])
+                         if echoes[device_order][command_index] is None]
+            matches = [command_index for command_index in in_flight
+                       if expected_echoes[command_index] == echo]
+            if not matches:
+                matches = [command_index for command_index in in_flight
+                           if expected_echoes[command_index].split()[:1] == echo.split()[:1]]
+
+            if not matches:
+                self.log.warning(name + ": device " + str(device_order) + " unexpected echo " + repr(echo))
+                continue
+
+            echoes[device_order][matches[0]] = echo
+
+            # the window only moves past commands that have been answered
+            while next_to_acknowledge[device_order] < number_of_commands and \
+                    echoes[device_order][next_to_acknowledge[device_order]] is not None:
+                next_to_acknowledge[device_order] += 1
+
+            send_next(device_order)
+
+        for device_order in range(self.sync_device_count):
+            for command_index in range(next_to_acknowledge[device_order], number_of_commands):
+                self.log.warning(name + ": device " + str(device_order) + " resending " +
+                                 repr(expected_echoes[command_index]))
+
+                echo = self.request_response(dq_commands[command_index], device_order, response_timeout_s)
+
+                if echo is not None:
+                    echoes[device_order][command_index] = " ".join(echo.split())
+
+        # the echo is the device's own account of the setting, so it doubles as the check of the final state
+        verified = True
+
+        for device_order in range(self.sync_device_count):
+            for command_index in range(number_of_commands):
+                if echoes[device_order][command_index] != expected_echoes[command_index]:
+                    self.log.error(name + ": device " + str(device_order) + " sent " +
+                                   repr(expected_echoes[command_index]) + " got " +
+                                   repr(echoes[device_order][command_index]))
+                    verified = False
+
+        return verified
+
+    def enable_count_storage(self, capacity_scans):
+        """
+        Store decoded scans as int16 counts plus a per channel scale instead of lists of float voltages. Must be
+        called before configure_and_connect_device. Voltages are computed on demand by the ring buffer, e.g.
+        get_count_buffer(0).read_voltages().
+        :param capacity_scans: scans kept per device before the oldest unread ones are overwritten
+        """
+        name = "enable_count_storage"
+        self.log.info(name + ": " + str(capacity_scans) + " scans")
+
+        self.count_storage_capacity_scans = capacity_scans
+
+    def get_count_buffer(self, device_order=0) -> DQScanRingBuffer:
+        return self.dataq_group_container[device_order].count_buffer
+
+    def enable_sharded_decode(self, ring_capacity_scans=1000000, batch_size=1, max_batch_delay_s=0.05):
+        """
+        Decode each device in its own process. Must be called after configure_and_connect_device and before
+        start_acquisition. Decoded scans are then read with read_sharded_decoded_block, the channel lists in
+        dataq_group_container are not filled in this mode.
+        :param ring_capacity_scans: scans buffered per device in shared memory
+        :param batch_size: datagrams handed to a worker at a time
+        :param max_batch_delay_s: longest a partial batch is held back waiting for more datagrams
+        """
+        name = "enable_sharded_decode"
+        self.log.info(name)
+
+        # multiprocessing and shared memory only get imported by processes that shard
+        from dataqWorkers import DQShardedDecodeCoordinator
+
+        channel_scales = [self.get_voltage_scale_for_channel(channel_index)
+                          for channel_index in range(len(self.device_configuration.s_list))]
+
+        self.sharded_decode_coordinator = DQShardedDecodeCoordinator(self.sync_device_count, channel_scales,
+                                                                     self.get_channel_kinds(),
+                                                                     ring_capacity_scans, batch_size,
+                                                                     max_batch_delay_s)
+
+    def read_sharded_decoded_block(self, device_order):
+        return self.sharded_decode_coordinator.read_decoded_block(device_order)
+
+    def set_slave_delay(self, device_order, delay):
+        """
+        Offset a slave's start relative to the master's sync pulse to make up for network latency.
+        :param device_order: slave to adjust, the master (0) has no delay
+        :param delay: delay value passed straight to the device
+        """
+        name = "set_slave_delay"
+        self.log.info(name + ": device " + str(device_order) + " delay " + str(delay))
+
         dq_command = DQCommandResponseStructures.DQCommand(
             id=DQEnums.ID.DQCOMMAND,
             public_key=self.device_configuration.device_group_key_id,
-            command=DQEnums.Command.CONNECT,
-            par1=self.dq_ports.logger_discovery_remote_port,
-            par2=self.device_configuration.device_role,
-            par3=self.device_configuration.device_group_order,
-            payload=self.client_ip
+            command=DQEnums.Command.SETSLAVEDELAY,
+            par1=delay,
+            par2=0,
+            par3=0,
+            payload=""
         )
 
-        command_ok = self.send_command(dq_command, False)
+        command_ok = self.send_command(dq_command, False, device_order)
 
         if not command_ok:
-            self.log.error(name + ": command error")
-
-        # configure encoding
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "encode " + str(int(self.device_configuration.encode)) + "\r"
-
-        self.send_command(dq_command, False)
-
-        # configure packet size
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "ps " + str(int(self.device_configuration.ps)) + "\r"
-
-        self.send_command(dq_command, False)
-
-        # configure srate
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "srate " + str(int(self.device_sample_configuration.s_rate)) + "\r"
-
-        self.send_command(dq_command, False)
-
-        # configure dec
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "dec " + str(int(self.device_sample_configuration.dec)) + "\r"
-
-        self.send_command(dq_command, False)
-
-        # configure deca
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "deca " + str(int(self.device_sample_configuration.deca)) + "\r"
-
-        self.send_command(dq_command, False)
-
-        # configure keep alive
-        dq_command.command = DQEnums.Command.SECONDCOMMAND
-        dq_command.par1 = 0
-        dq_command.par2 = 0
-        dq_command.par3 = 0
-        dq_command.payload = "keepalive 8000\r"
-
-        self.send_command(dq_command, False)
-
-        for scan_config in scan_list:
-            dq_command.payload = "slist " + str(scan_config) + " " + str(
-                scan_config | scan_list[scan_config]) + "\r"
-            self.log.info("slist config " + dq_command.payload)
-            self.send_command(dq_command, False)
-
-        self.keep_alive_thread_enable = True
-        self.keep_alive_thread = threading.Thread(target=self.keep_alive_runnable)
-
-        self.keep_alive_thread.start()
-        self.keep_alive_thread_event.set()
+            self.log.error(name + " command error")
+
+        return command_ok
+
+    def set_packet_size(self, packet_size: DQEnums.PacketSize):
+        """
+        Change the packet size of every logger in the group. Only while stopped.
+        """
+        name = "set_packet_size"
+        self.log.info(name + ": " + repr(packet_size))
+
+        self.device_configuration.ps = packet_size
+
+        for device_order in range(self.sync_device_count):
+            dq_command = DQCommandResponseStructures.DQCommand(
+                id=DQEnums.ID.DQCOMMAND,
+                public_key=self.device_configuration.device_group_key_id,
+                command=DQEnums.Command.SECONDCOMMAND,
+                par1=0,
+                par2=0,
+                par3=0,
+                payload="ps " + str(int(packet_size)) + "\r"
+            )
+
+            command_ok = self.send_command(dq_command, False, device_order)
+
+            if not command_ok:
+                self.log.error(name + ": command error on device " + str(device_order))
+
+    def calibrate_packet_size(self, packet_sizes=None, run_duration_s=2.0, latency_target_s=0.05,
+                              max_drop_fraction=0.0, calibration_drain_timeout_s=1.0) -> DQPacketSizeReport:
+        """
+        Run a short acquisition at each packet size, fit the host cost per packet and per sample, then keep the
+        packet size with the least CPU per sample that fills within latency_target_s and didn't drop samples.
+        Needs a configured device that isn't acquiring. Log the report and pin the result in the configuration.
+        :param packet_sizes: DQEnums.PacketSize candidates, all of them by default
+        :param calibration_drain_timeout_s: how long to wait for the decode workers to finish a run, if sharded
+        :return: DQPacketSizeReport, the chosen size is already applied
+        """
+        name = "calibrate_packet_size"
+
+        if packet_sizes is None:
+            packet_sizes = list(DQEnums.PacketSize)
+
+        packet_size_tuner = DQPacketSizeTuner(len(self.device_configuration.s_list), self.get_scan_rate_hz(),
+                                              latency_target_s, max_drop_fraction)
+
+        for packet_size in packet_sizes:
+            self.set_packet_size(packet_size)
+
+            self.start_acquisition()
+
+            packets_at_start = self.packets_processed
+            processing_ns_at_start = self.packet_processing_ns
+            sharded_counters_at_start = self.get_sharded_decode_totals()
+
+            time.sleep(run_duration_s)
+
+            self.stop_acquisition()
+
+            if self.sharded_decode_coordinator is None:
+                samples = sum(device_container.dq_decoder.cumulative_samples_received
+                              for device_container in self.dataq_group_container)
+                missing_samples = sum(device_container.dq_decoder.cumulative_missing_samples
+                                      for device_container in self.dataq_group_container)
+            else:
+                # the in process decoders stay at 0, the workers keep counting across runs so take the difference
+                # once they have caught up with what was dispatched
+                self.sharded_decode_coordinator.flush()
+                packets = self.packets_processed - packets_at_start
+                wait_until_s = time.monotonic() + calibration_drain_timeout_s
+
+                while True:
+                    sharded_counters = self.get_sharded_decode_totals()
+
+                    if sharded_counters["packets_decoded"] - sharded_counters_at_start["packets_decoded"] >= \
+                            packets or time.monotonic() > wait_until_s:
+                        break
+
+                    time.sleep(0.01)
+
+                samples = (sharded_counters["scans_written"] - sharded_counters_at_start["scans_written"]) * \
+                    len(self.device_configuration.s_list)
+                missing_samples = sharded_counters["cumulative_missing_samples"] - \
+                    sharded_counters_at_start["cumulative_missing_samples"]
+
+            measurement = DQPacketSizeMeasurement(
+                packet_size=int(packet_size),
+                packets=self.packets_processed - packets_at_start,
+                samples=samples,
+                processing_ns=self.packet_processing_ns - processing_ns_at_start,
+                missing_samples=missing_samples
+            )
+
+            self.log.info(name + ": " + repr(measurement))
+            packet_size_tuner.add_measurement(measurement)
+
+        report = packet_size_tuner.choose(packet_sizes)
+
+        self.set_packet_size(DQEnums.PacketSize(report.packet_size))
+
+        self.log.info(name + ": " + repr(report))
+
+        return report
 
     def start_acquisition(self):
+        """
+        :return: True if the start commands were acknowledged, see send_start_commands
+        """
         name = "start_acquisition"
         self.log.info(name)
 
-        # start the read thread
+        # nothing may decode while the decoders and clocks are reset, normally stop_acquisition already did this
+        self.stop_receive_thread()
+
+        for device_container in self.dataq_group_container:
+            device_container.dq_decoder.reset()
+
+        for sample_clock_model in self.sample_clock_models:
+            sample_clock_model.reset()
+            sample_clock_model.nominal_scan_rate_hz = self.get_scan_rate_hz()
+
+        self.sample_clock_cumulative_counts = [0] * self.sync_device_count
+        self.sample_clock_scan_offsets = [0.0] * self.sync_device_count
+
+        if self.sharded_decode_coordinator is not None:
+            self.sharded_decode_coordinator.start()
+
+        self.drain_response_socket()
+
+        # start the read thread, it runs until stop_acquisition or disconnect_device
         self.receive_data_thread_enable = True
         self.receive_data_thread = threading.Thread(target=self.receive_data_runnable)
 
         self.receive_data_thread.start()
+
         self.receive_data_thread_event.set()
 
+        # from here on a silent socket means a stall, see recover_connection
+        self.connection_supervisor.set_cadence(self.get_scan_rate_hz(), len(self.device_configuration.s_list),
+                                               packet_size_to_samples(self.device_configuration.ps))
+        self.udp_response_socket.settimeout(self.connection_supervisor.get_stall_timeout_s())
+
+        started = self.send_start_commands()
+
+        self.recovery_stop_event.clear()
+        self.acquisition_running = True
+        self.connection_supervisor.on_streaming_started(time.monotonic_ns())
+
+        return started
+
+    def send_start_commands(self, response_timeout_s=None):
+        """
+        SYNC to the slaves, then SYNCSTART to the master which starts the whole group.
+        :param response_timeout_s: how long to wait for each echo, receive_timeout_sec if not given
+        :return: True if every command was acknowledged
+        """
+        name = "send_start_commands"
+
+        started = True
+
+        # arm the slaves so they wait on the master's sync pulse
+        for device_order in range(1, self.sync_device_count):
+            dq_command = DQCommandResponseStructures.DQCommand(
+                id=DQEnums.ID.DQCOMMAND,
+                public_key=self.device_configuration.device_group_key_id,
+                command=DQEnums.Command.SYNC,
+                par1=0,
+                par2=0,
+                par3=0,
+                payload="start 0\r"
+            )
+
+            command_ok = self.send_command(dq_command, False, device_order, response_timeout_s)
+
+            if not command_ok:
+                self.log.error(name + " sync command error on device " + str(device_order))
+                started = False
+
         # configure key, connection, role, group
         dq_command = DQCommandResponseStructures.DQCommand(
             id=DQEnums.ID.DQCOMMAND,
@@ -509,15 +1063,26 @@ class DataqCommsManager:
             payload="start 0\r"
         )
 
-        command_ok = self.send_command(dq_command, False)
+        command_ok = self.send_command(dq_command, False, 0, response_timeout_s)
 
         if not command_ok:
             self.log.error(name + " command error")
+            started = False
+
+        return started
 
     def stop_acquisition(self):
         name = "stop_acquisition"
         self.log.info(name)
 
+        self.acquisition_running = False
+        self.recovery_stop_event.set()
+        self.connection_supervisor.on_stopped()
+
+        # the receive thread exits after the SYNCSTOP echo or the packet in hand, start_acquisition starts a fresh
+        # one once the decoders are reset
+        self.receive_data_thread_enable = False
+
         # configure key, connection, role, group
         dq_command = DQCommandResponseStructures.DQCommand(
             id=DQEnums.ID.DQCOMMAND,
@@ -529,22 +1094,66 @@ class DataqCommsManager:
             payload="stop\r"
         )
 
+        # the master's stop is relayed to the slaves
         command_ok = self.send_command(dq_command, False)
 
         if not command_ok:
             self.log.error(name + " command error")
 
-        # drowan_TODO_20200624: find a way to pause the thread?
-        # self.receive_data_thread_event.clear()
+        self.stop_receive_thread()
+        self.udp_response_socket.settimeout(self.receive_timeout_sec)
+
+    def stop_receive_thread(self):
+        """
+        Let the receive thread finish the datagram in hand and wait for it to exit.
+        """
+        self.receive_data_thread_enable = False
+
+        if self.receive_data_thread is None or self.receive_data_thread is threading.current_thread():
+            return
+
+        self.receive_data_thread_event.set()
+        self.receive_data_thread.join()
+
+    def drain_response_socket(self):
+        """
+        Throw away whatever is still queued on the response socket, e.g. packets sent before the last SYNCSTOP took
+        effect. Their counts belong to the run that ended and would be decoded against freshly reset decoders.
+        Only while the receive thread is stopped.
+        :return: datagrams discarded
+        """
+        name = "drain_response_socket"
+
+        socket_timeout_s = self.udp_response_socket.gettimeout()
+        self.udp_response_socket.setblocking(False)
+
+        discarded = 0
+
+        try:
+            while True:
+                self.udp_response_socket.recv(self.recv_buffer_size)
+                discarded += 1
+        except (BlockingIOError, socket.timeout):
+            pass
+        except socket.error as e:
+            self.log.exception(name + ": ")
+        finally:
+            self.udp_response_socket.settimeout(socket_timeout_s)
+
+        if discarded:
+            self.log.info(name + ": discarded " + str(discarded) + " datagrams")
+
+        return discarded
 
     def disconnect_device(self):
         name = "disconnect_device"
         self.log.info(name)
 
-        if self.keep_alive_thread is not None:
-            self.keep_alive_thread_enable = False
-            self.keep_alive_thread_event.set()
-            self.keep_alive_thread.join()
+        get_keep_alive_scheduler().remove(self.keep_alive_registration)
+
+        # the receive thread exits on the disconnect echo rather than a socket timeout
+        self.receive_data_thread_enable = False
+        self.recovery_stop_event.set()
 
         # send disconnect command
         dq_command = DQCommandResponseStructures.DQCommand(
@@ -557,102 +1166,188 @@ class DataqCommsManager:
             payload="disconnect\r"
         )
 
-        command_ok = self.send_command(dq_command, False)
+        for device_order in range(self.sync_device_count):
+            command_ok = self.send_command(dq_command, False, device_order)
 
-        if not command_ok:
-            self.log.error(name + " command error")
+            if not command_ok:
+                self.log.error(name + " command error on device " + str(device_order))
+
+        self.stop_receive_thread()
+
+        if self.sharded_decode_coordinator is not None:
+            self.sharded_decode_coordinator.stop()
+
+        self.metrics.stop_serving()
 
-        if self.receive_data_thread is not None:
-            self.receive_data_thread_enable = False
-            self.receive_data_thread_event.set()
-            self.receive_data_thread.join()
+        # plans are only written out here, not on every set_sample_rate
+        self.sample_rate_planner.save_cache()
 
+        self.close_sockets()
+
+    def close_sockets(self):
         self.udp_command_socket.close()
         self.udp_response_socket.close()
 
-    def send_command(self, dq_command, ignore_timeout):
+    def send_command(self, dq_command, ignore_timeout, device_order=0, response_timeout_s=None):
+        """
+        :param ignore_timeout: True for commands that don't echo, returns as soon as the command is sent
+        :param response_timeout_s: how long to wait for the echo, receive_timeout_sec if not given
+        :return: 1 if the command was sent and, unless ignore_timeout, echoed
+        """
         name = "send_command"
-        self.log.info(name + ": " + repr(dq_command))
 
-        command_string = ''
-        id_byte = dq_command.id.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-        public_key_byte = dq_command.public_key.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-        command_byte = dq_command.command.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-        par1_byte = dq_command.par1.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-        par2_byte = dq_command.par2.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-        par3_byte = dq_command.par3.to_bytes(4, byteorder=self.byte_order, signed=self.is_signed)
-
-        command_string = id_byte + \
-                         public_key_byte + \
-                         command_byte + \
-                         par1_byte + \
-                         par2_byte + \
-                         par3_byte + \
-                         dq_command.payload.encode('utf-8')
-
-        self.udp_command_socket.sendto(command_string, self.dataq_server_address_and_port)
-
-        # this is for commands that don't echo
-        if ignore_timeout is True:
-            return 1
-        else:
-            try:
-                response_from_logger = self.udp_response_socket.recv(self.recv_buffer_size)
-                response_ok = self.process_response(response_from_logger)
+        if ignore_timeout is not True:
+            return 0 if self.request_response(dq_command, device_order, response_timeout_s) is None else 1
 
-                if not response_ok:
-                    self.log.error(name + ": got bad response")
-                    return 0
-                else:
-                    return 1
+        self.log.info(name + ": " + repr(dq_command))
 
-            except socket.error as e:
-                self.log.exception(name + ": ")
-                self.log.warning(name + ": Code to handle exception needed!")
-                return 0
+        self.udp_command_socket.sendto(encode_command(dq_command), self.dataq_device_addresses_and_ports[device_order])
+        self.keep_alive_registration.note_command_sent(device_order)
 
-    def keep_alive_runnable(self):
-        name = "keep_alive_runnable"
-        self.log.info(name)
+        return 1
 
-        while True:
+    def request_response(self, dq_command, device_order=0, response_timeout_s=None):
+        """
+        Send a command and wait for the device's response to it.
+        :return: response payload text, None if the device did not answer within response_timeout_s
+        """
+        name = "request_response"
+        self.log.info(name + ": " + repr(dq_command))
 
-            if self.keep_alive_thread_enable is False:
-                self.log.info(name + ": told to exit thread")
-                break
+        # an echo nobody waited for, e.g. of the SYNCSTOP sent during a recovery, is not the answer to this command
+        self.discard_command_responses(device_order)
+
+        self.udp_command_socket.sendto(encode_command(dq_command), self.dataq_device_addresses_and_ports[device_order])
+        self.keep_alive_registration.note_command_sent(device_order)
+
+        command_response = self.receive_response(device_order, response_timeout_s)
+
+        if command_response is None:
+            self.log.error(name + ": no response from device " + str(device_order))
+            return None
+
+        return command_response[1]
+
+    def is_receive_thread_reading(self):
+        """
+        :return: True if the receive thread reads the response socket for the calling thread
+        """
+        return self.receive_data_thread is not None and self.receive_data_thread.is_alive() and \
+            threading.current_thread() is not self.receive_data_thread
+
+    def discard_command_responses(self, device_order=None):
+        with self.command_response_condition:
+            if device_order is None:
+                self.command_responses.clear()
             else:
-                self.log.info(name + ": waiting for keep alive event")
-                self.keep_alive_thread_event.wait()
-                self.log.info(name + ": got keep alive event")
+                for command_response in [command_response for command_response in self.command_responses
+                                         if command_response[0] == device_order]:
+                    self.command_responses.remove(command_response)
 
-            # configure key, connection, role, group
-            dq_command = DQCommandResponseStructures.DQCommand(
-                id=DQEnums.ID.DQCOMMAND,
-                public_key=self.device_configuration.device_group_key_id,
-                command=DQEnums.Command.KEEPALIVE,
-                par1=0,
-                par2=0,
-                par3=0,
-                payload="keepalive\r"
-            )
+    def take_command_response(self, device_order=None):
+        # only called with command_response_condition held
+        for command_response in self.command_responses:
+            if device_order is None or command_response[0] == device_order:
+                self.command_responses.remove(command_response)
+                return command_response
 
-            command_ok = self.send_command(dq_command, True)
+        return None
 
-            if not command_ok:
-                self.log.error(name + " command error")
+    def receive_response(self, device_order=None, response_timeout_s=None):
+        """
+        Wait for the next DQRESPONSE. While the receive thread runs it reads the socket and process_response hands
+        the response over through command_response_condition. Otherwise, or when called on the receive thread
+        itself, the socket is read here and any data that arrives meanwhile is processed as usual.
+        :param device_order: only take a response from this device, None for any
+        :param response_timeout_s: receive_timeout_sec if not given
+        :return: (device order, payload text), None on timeout
+        """
+        if response_timeout_s is None:
+            response_timeout_s = self.receive_timeout_sec
 
-            # just chose 6 seconds
-            time.sleep(6)
+        deadline_s = time.monotonic() + response_timeout_s
 
-        self.log.info(name + ": exiting...")
+        while True:
+            with self.command_response_condition:
+                command_response = self.take_command_response(device_order)
+
+                if command_response is not None:
+                    return command_response
+
+                remaining_s = deadline_s - time.monotonic()
+
+                if remaining_s <= 0:
+                    return None
+
+                # short waits, a receive thread on its way out (e.g. after the disconnect echo) leaves the socket
+                # to this one
+                if self.is_receive_thread_reading():
+                    self.command_response_condition.wait(min(remaining_s, 0.1))
+                    continue
+
+            if self.receive_datagram(remaining_s) is None:
+                return None
+
+    def receive_datagram(self, timeout_s):
+        """
+        Read one datagram from the response socket and process it, for callers waiting on something
+        process_response hands over while nobody else reads the socket. See is_receive_thread_reading.
+        :return: True if a datagram was processed, False on timeout, None on a socket error
+        """
+        name = "receive_datagram"
+
+        socket_timeout_s = self.udp_response_socket.gettimeout()
+        self.udp_response_socket.settimeout(timeout_s)
+
+        try:
+            response_from_logger, host_timestamp_ns = receive_timestamped(self.udp_response_socket,
+                                                                          self.recv_buffer_size,
+                                                                          self.kernel_timestamps_enabled)
+        except socket.timeout:
+            return False
+        except socket.error as e:
+            self.log.exception(name + ": ")
+            return None
+        finally:
+            self.udp_response_socket.settimeout(socket_timeout_s)
+
+        self.process_response(response_from_logger, host_timestamp_ns)
+
+        return True
+
+    def add_foreign_datagram_handler(self, foreign_datagram_handler):
+        """
+        :param foreign_datagram_handler: callable taking the raw datagram, for anything on the response socket that
+        isn't DQADCDATA or DQRESPONSE. Discovery replies land here while this manager holds
+        logger_discovery_remote_port, see DQDeviceDiscovery.
+        """
+        self.foreign_datagram_handlers.append(foreign_datagram_handler)
+
+    def remove_foreign_datagram_handler(self, foreign_datagram_handler):
+        self.foreign_datagram_handlers.remove(foreign_datagram_handler)
+
+    def send_keep_alive(self, device_order):
+        """
+        Called by the process wide keep alive scheduler, only for loggers that haven't been sent anything else lately.
+        """
+        dq_command = DQCommandResponseStructures.DQCommand(
+            id=DQEnums.ID.DQCOMMAND,
+            public_key=self.device_configuration.device_group_key_id,
+            command=DQEnums.Command.KEEPALIVE,
+            par1=0,
+            par2=0,
+            par3=0,
+            payload="keepalive\r"
+        )
+
+        # keep alives don't echo
+        self.send_command(dq_command, True, device_order)
 
     def receive_data_runnable(self):
         name = "receive_data_runnable"
 
         while True:
 
-            # start_time = time.time()
-
             if self.receive_data_thread_enable is False:
                 self.log.info(name + ": told to exit thread")
                 break
@@ -662,24 +1357,166 @@ class DataqCommsManager:
                 self.log.info(name + ": got receive event")
 
             try:
-                response = self.udp_response_socket.recv(self.recv_buffer_size)
-                self.process_response(response)
-                # start_time = time.time()
+                receive_start_ns = self.profiler.begin()
+                response, host_timestamp_ns = receive_timestamped(self.udp_response_socket, self.recv_buffer_size,
+                                                                  self.kernel_timestamps_enabled)
+                processing_start_ns = time.perf_counter_ns()
+                # mostly time blocked until the datagram arrived, not the cost of receiving it
+                self.profiler.record("socket_wait", receive_start_ns, processing_start_ns)
+
+                is_adc_data = int.from_bytes(response[0:4], byteorder=self.byte_order) == DQEnums.ID.DQADCDATA
+
+                self.process_response(response, host_timestamp_ns)
+
+                handler_start_ns = time.perf_counter_ns()
+                self.profiler.record("process_response", processing_start_ns, handler_start_ns)
+                self.metric_receive_to_handler_seconds.observe((time.monotonic_ns() - host_timestamp_ns) * 1e-9)
+
                 self.receive_data_handler(self.dataq_group_container)
-                # print("--- %s seconds ---" % (time.time() - start_time))
+
+                processing_end_ns = time.perf_counter_ns()
+                self.profiler.record("receive_data_handler", handler_start_ns, processing_end_ns)
+                self.metric_receive_handler_seconds.observe((processing_end_ns - handler_start_ns) * 1e-9)
+
+                # echoes would skew the per packet cost calibrate_packet_size fits
+                if is_adc_data:
+                    self.packet_processing_ns += processing_end_ns - processing_start_ns
+                    self.packets_processed += 1
+            except socket.timeout:
+                # nothing arrived, don't leave a partial batch sitting with the coordinator
+                if self.sharded_decode_coordinator is not None:
+                    self.sharded_decode_coordinator.flush()
+
+                if self.acquisition_running and self.receive_data_thread_enable:
+                    self.recover_connection()
             except socket.error as e:
                 self.log.exception(name + ": ")
-                self.log.warning(name + ": Code to handle exception needed!")
 
-            # print("--- %s seconds ---" % (time.time() - start_time))
+                if self.sharded_decode_coordinator is not None:
+                    self.sharded_decode_coordinator.flush()
 
         self.log.info(name + ": exiting...")
 
+    def recover_connection(self):
+        """
+        Called from the receive thread once nothing has arrived for the stall timeout. Reconnects, uploads the
+        configuration again and restarts the group, retrying until data flows or acquisition is stopped. Runs on
+        the receive thread so nothing else reads the socket meanwhile.
+        """
+        name = "recover_connection"
+
+        self.connection_supervisor.on_stall()
+        self.log.warning(name + ": no data for " + str(self.connection_supervisor.get_stall_timeout_s()) +
+                         " s, reconnecting")
+
+        retry_interval_s = self.recovery_retry_interval_s
+
+        while self.acquisition_running and self.receive_data_thread_enable:
+            self.connection_supervisor.on_recovering()
+            self.metric_recoveries.inc()
+
+            # a logger that is still streaming to a stale session would interleave old counts with the new ones
+            dq_command = DQCommandResponseStructures.DQCommand(
+                id=DQEnums.ID.DQCOMMAND,
+                public_key=self.device_configuration.device_group_key_id,
+                command=DQEnums.Command.SYNCSTOP,
+                par1=0,
+                par2=0,
+                par3=0,
+                payload="stop\r"
+            )
+            self.send_command(dq_command, True)
+
+            stall_timeout_s = self.connection_supervisor.get_stall_timeout_s()
+
+            if self.connect_devices(response_timeout_s=stall_timeout_s):
+                self.resync_after_outage()
+
+                # the outage is closed by the first packet that arrives, see process_response
+                if self.send_start_commands(stall_timeout_s):
+                    return
+
+            self.log.warning(name + ": attempt " + str(self.connection_supervisor.recovery_attempts) +
+                             " failed, retrying in " + str(retry_interval_s) + " s")
+
+            # receive_data_thread_event stays set while the thread runs, so it can't be waited on here
+            self.recovery_stop_event.wait(retry_interval_s)
+            retry_interval_s = min(2 * retry_interval_s, self.recovery_retry_max_interval_s)
+
+    def resync_after_outage(self):
+        """
+        The loggers count from 0 again after a restart. Move every decoder past the scans lost in the outage and
+        note them in the gap index.
+        """
+        outage_start_host_ns = self.connection_supervisor.outage_start_host_ns
+        now_ns = time.monotonic_ns()
+
+        skipped_scans = int(round((now_ns - outage_start_host_ns) * 1e-9 * self.get_scan_rate_hz()))
+
+        # the decoder scan index offsets cover everything up to here
+        self.sample_clock_cumulative_counts = [0] * self.sync_device_count
+        self.sample_clock_scan_offsets = [0.0] * self.sync_device_count
+
+        for device_container in self.dataq_group_container:
+            dq_decoder = device_container.dq_decoder
+
+            # sharded decode keeps its decoders in the workers, they resync off the count going backwards
+            if self.sharded_decode_coordinator is None:
+                first_scan_index = dq_decoder.scans_decoded
+                dq_decoder.resync(skipped_scans)
+            else:
+                first_scan_index = None
+
+            self.connection_supervisor.add_gap(DQGapRecord(
+                device_order=device_container.device_order,
+                first_scan_index=first_scan_index,
+                scans=skipped_scans,
+                kind=GAP_KIND_OUTAGE,
+                start_host_ns=outage_start_host_ns
+            ))
+
+    def get_gap_index(self):
+        """
+        :return: list of DQGapRecord, missing sample runs and outages in the order they were found
+        """
+        return self.connection_supervisor.get_gap_index()
+
+    def get_channel_kind(self, channel_in_list):
+        if channel_in_list in DQDataStructures.DQ4108.AnalogChannelFields:
+            return CHANNEL_KIND_ANALOG
+        elif channel_in_list in DQDataStructures.DQ4108.DigitalChannelFields:
+            return CHANNEL_KIND_DIGITAL
+        elif channel_in_list in DQDataStructures.DQ4108.CounterChannelFields:
+            return CHANNEL_KIND_COUNTER
+        else:
+            return None
+
+    def get_channel_kinds(self):
+        name = "get_channel_kinds"
+
+        channel_kinds = []
+
+        for channel_in_list in self.device_configuration.s_list:
+            channel_kind = self.get_channel_kind(channel_in_list)
+
+            if channel_kind is None:
+                # keep the position so the rest of the scan still lines up, the word is just carried raw
+                self.log.warning(name + ": channel not decoded: " + str(channel_in_list))
+                channel_kind = CHANNEL_KIND_RAW
+
+            channel_kinds.append(channel_kind)
+
+        return channel_kinds
+
     def get_voltage_scale_for_channel(self, channel_index):
         name = "get_voltage_scale_for_channel"
 
         scale_key = list(self.device_configuration.s_list)[channel_index]
 
+        # digital and counter inputs have no voltage
+        if self.get_channel_kind(scale_key) != CHANNEL_KIND_ANALOG:
+            return 0.0
+
         configured_scale = self.device_configuration.s_list[scale_key]
 
         if configured_scale == DQMasks.DQ4108.ScanListDefinition.AnalogScale.PN_10V0:
@@ -697,12 +1534,12 @@ class DataqCommsManager:
         else:
             return 0.0
 
-    def set_sample_rate(self, sample_rate_hz: DQEnums.SampleRate):
+    def set_sample_rate(self, sample_rate_hz, number_of_channels=None):
         """
-        :param dec: decimation/oversampling value
-        :param deca: decimation/oversampling multiplier
-        :param sample_rate_hz: rate to sample given device limitations. See page 47 of Dataq-Instruments-Protocol.pdf
-        :return:
+        :param sample_rate_hz: rate to sample given device limitations, any rate not just DQEnums.SampleRate. See
+        page 47 of Dataq-Instruments-Protocol.pdf and DQSampleRatePlanner
+        :param number_of_channels: entries in the scan list, taken from the device configuration if not given
+        :return: DQSampleRatePlan that was applied, None if the rate can't be reached
         """
         """
         it seems an srate of 375 causes the device to get lost in the weeds...? ~3000 srate for all 8 channels seems to be OK
@@ -714,24 +1551,29 @@ class DataqCommsManager:
         name = "set_desired_sample_rate"
         self.log.info(name)
 
-        self.set_sample_rate_hz = sample_rate_hz
+        if number_of_channels is None:
+            if self.device_configuration is not None:
+                number_of_channels = len(self.device_configuration.s_list)
+            else:
+                # assume the worst case, every analog input
+                number_of_channels = len(DQDataStructures.DQ4108.AnalogChannelFields)
 
-        dividend = DQEnums.DQ4108.ScanRateLimits.DIVIDEND
-        # default values if nothing is found
-        dec = 10
-        deca = 1
+        sample_rate_plan = self.sample_rate_planner.plan(sample_rate_hz, number_of_channels)
 
-        for rate_to_compare in DQEnums.SampleRate:
-            if int(sample_rate_hz) == int(rate_to_compare):
-                dec_deca = DQEnums.DQ4108.PreCalculatedDecDecaDict[int(sample_rate_hz)]
+        if sample_rate_plan is None:
+            self.log.error(name + ": " + str(sample_rate_hz) + " Hz not reachable, sample configuration unchanged")
+            return None
 
-                dec = self.device_sample_configuration.dec = dec_deca[0]
-                deca = self.device_sample_configuration.deca = dec_deca[1]
+        self.set_sample_rate_hz = sample_rate_hz
 
-        self.device_sample_configuration.s_rate = int(dividend / (sample_rate_hz * dec * deca))
+        self.device_sample_configuration.s_rate = sample_rate_plan.s_rate
+        self.device_sample_configuration.dec = sample_rate_plan.dec
+        self.device_sample_configuration.deca = sample_rate_plan.deca
 
         self.log.info(name + ": " + repr(self.device_sample_configuration))
 
+        return sample_rate_plan
+
     def set_srate_dec_and_deca(self, s_rate, dec, deca):
         """
         Incorrect settings can cause the logger to stop working, requiring a power cycle to correct.
@@ -744,20 +1586,186 @@ class DataqCommsManager:
         self.log.info(name)
 
         # only allow change if within bounds
-        if s_rate <= DQEnums.DQ4108.ScanRateLimits.SRATE_MAX or s_rate >= DQEnums.DQ4108.ScanRateLimits.SRATE_MIN:
+        if DQEnums.DQ4108.ScanRateLimits.SRATE_MIN <= s_rate <= DQEnums.DQ4108.ScanRateLimits.SRATE_MAX:
             self.device_sample_configuration.s_rate = s_rate
+        elif s_rate != 0:
+            self.log.warning(name + ": s_rate " + str(s_rate) + " out of bounds, ignored")
 
-        if dec <= DQEnums.DQ4108.ScanRateLimits.DEC_MAX or dec >= DQEnums.DQ4108.ScanRateLimits.DEC_MIN:
+        if DQEnums.DQ4108.ScanRateLimits.DEC_MIN <= dec <= DQEnums.DQ4108.ScanRateLimits.DEC_MAX:
             self.device_sample_configuration.dec = dec
+        elif dec != 0:
+            self.log.warning(name + ": dec " + str(dec) + " out of bounds, ignored")
 
-        if deca <= DQEnums.DQ4108.ScanRateLimits.DECA_MAX or deca >= DQEnums.DQ4108.ScanRateLimits.DECA_MIN:
+        if DQEnums.DQ4108.ScanRateLimits.DECA_MIN <= deca <= DQEnums.DQ4108.ScanRateLimits.DECA_MAX:
             self.device_sample_configuration.deca = deca
+        elif deca != 0:
+            self.log.warning(name + ": deca " + str(deca) + " out of bounds, ignored")
 
     def get_srate_dec_and_deca(self):
         name = "get_srate_dec_and_deca"
         self.log.info(name)
         return self.device_sample_configuration.s_rate, self.device_sample_configuration.dec, self.device_sample_configuration.deca
 
+    def get_scan_rate_hz(self):
+        # rate at which each channel of the scan list is sampled, see page 47 of Dataq-Instruments-Protocol.pdf
+        return DQEnums.DQ4108.ScanRateLimits.DIVIDEND / (self.device_sample_configuration.s_rate *
+                                                         self.device_sample_configuration.dec *
+                                                         self.device_sample_configuration.deca)
+
+    def get_capture_metadata(self, device_order=0):
+        """
+        :return: dict describing the running configuration, for the exporters in dataqExport
+        """
+        scan_list = self.device_configuration.s_list
+        channel_scales = [self.get_voltage_scale_for_channel(channel_index)
+                          for channel_index in range(len(scan_list))]
+
+        return make_capture_metadata(self.device_configuration, self.device_sample_configuration, channel_scales,
+                                     self.get_channel_kinds(), self.get_scan_rate_hz(), device_order)
+
+    def find_out_slave_delay(self, device_order):
+        """
+        Ask a slave how far (in microseconds) its start lags the master's sync pulse.
+        :return: delay in microseconds, negative if it starts ahead. None if the device did not answer with one
+        """
+        name = "find_out_slave_delay"
+        self.log.info(name + ": device " + str(device_order))
+
+        dq_command = DQCommandResponseStructures.DQCommand(
+            id=DQEnums.ID.DQCOMMAND,
+            public_key=self.device_configuration.device_group_key_id,
+            command=DQEnums.Command.FINDOUTSLAVEDELAY,
+            par1=0,
+            par2=0,
+            par3=0,
+            payload=""
+        )
+
+        payload = self.request_response(dq_command, device_order)
+
+        if payload is None:
+            self.log.error(name + " command error")
+            return None
+
+        delay_us = parse_slave_delay_response(payload)
+
+        if delay_us is None:
+            self.log.error(name + ": unexpected response " + repr(payload))
+
+        return delay_us
+
+    def query_info(self, info_request: DQEnums.InfoRequests, device_order=0, response_timeout_s=1.0):
+        """
+        Ask a logger for one "info" value. Always goes to the device, see get_device_info for the cached values.
+        :return: value text, None if the device did not answer
+        """
+        name = "query_info"
+
+        dq_command = DQCommandResponseStructures.DQCommand(
+            id=DQEnums.ID.DQCOMMAND,
+            public_key=self.device_configuration.device_group_key_id,
+            command=DQEnums.Command.SECONDCOMMAND,
+            par1=0,
+            par2=0,
+            par3=0,
+            payload="info " + str(int(info_request)) + "\r"
+        )
+
+        payload = self.request_response(dq_command, device_order, response_timeout_s)
+        info_response = parse_info_response(payload) if payload is not None else None
+
+        if info_response is None or info_response[0] != int(info_request):
+            self.log.error(name + ": no answer to info " + str(int(info_request)) + " from device " +
+                           str(device_order))
+            return None
+
+        return info_response[1]
+
+    def use_discovered_devices(self, discovered_devices):
+        """
+        Take the serial numbers of the group's loggers from discovery, so get_device_info can go straight to the
+        cache.
+        :param discovered_devices: DQDiscoveredDevice list, e.g. from DQDeviceDiscovery.discover
+        """
+        for discovered_device in discovered_devices:
+            if discovered_device.ip in self.logger_ips and discovered_device.serial_no:
+                self.device_serial_numbers[self.logger_ips.index(discovered_device.ip)] = discovered_device.serial_no
+
+    def get_device_info(self, device_order=0, refresh=False) -> DQDeviceInfo:
+        """
+        The attributes of a logger that never change. Only the serial number is asked for when it isn't known yet,
+        the rest comes from device_info_cache unless it doesn't have this logger.
+        :param refresh: query every attribute again and update the cache
+        :return: DQDeviceInfo, None if the device did not give its serial number
+        """
+        name = "get_device_info"
+
+        serial_no = self.device_serial_numbers[device_order]
+
+        if serial_no is None or refresh:
+            serial_no = self.query_info(DQEnums.InfoRequests.SERIAL_NO, device_order)
+
+            if serial_no is None:
+                return None
+
+            self.device_serial_numbers[device_order] = serial_no
+
+        device_info = self.device_info_cache.get(serial_no)
+
+        if device_info is not None and device_info.is_complete() and not refresh:
+            self.log.info(name + ": device " + str(device_order) + " " + serial_no + " from cache")
+            return device_info
+
+        device_info = DQDeviceInfo(serial_no=serial_no)
+
+        for info_request, info_field in STATIC_INFO_FIELDS.items():
+            if info_request == DQEnums.InfoRequests.SERIAL_NO:
+                continue
+
+            setattr(device_info, info_field, self.query_info(info_request, device_order))
+
+        if device_info.is_complete():
+            self.device_info_cache.put(device_info)
+
+        return device_info
+
+    def measure_and_compensate_slave_delays(self, compensate_on_device=True):
+        """
+        Measure the start delay of every slave and line the group up on the master's timeline. Call after
+        configure_and_connect_device and before start_acquisition.
+        :param compensate_on_device: send the delays back with SETSLAVEDELAY so the slaves shift their own start.
+        Otherwise the delays are applied on the host as timeline offsets in the frame assembler.
+        :return: measured delay in microseconds per device order, the master is always 0
+        """
+        name = "measure_and_compensate_slave_delays"
+        self.log.info(name)
+
+        delays_us = [0] * self.sync_device_count
+        scan_rate_hz = self.get_scan_rate_hz()
+
+        for device_order in range(1, self.sync_device_count):
+            delay_us = self.find_out_slave_delay(device_order)
+
+            if delay_us is None:
+                continue
+
+            delays_us[device_order] = delay_us
+
+            # SETSLAVEDELAY takes the delay in an unsigned parameter, a slave that starts ahead is lined up on the host
+            if compensate_on_device and delay_us >= 0:
+                self.set_slave_delay(device_order, delay_us)
+                self.sync_frame_assembler.set_device_timeline_offset(device_order, 0)
+            else:
+                # a late start means the slave's scan 0 lines up with a later master scan, an early one with an
+                # earlier scan
+                offset_scans = int(round(delay_us * 1e-6 * scan_rate_hz))
+                self.sync_frame_assembler.set_device_timeline_offset(device_order, offset_scans)
+
+        self.log.info(name + ": delays (us) " + repr(delays_us) + " timeline offsets " +
+                      repr(self.sync_frame_assembler.get_device_timeline_offsets().tolist()))
+
+        return delays_us
+
     """
     # this version of process_response is an attempted port of the parse_udp function demonstrated in the 4208UDP
     # C# example provide by dataq
@@ -863,545 +1871,257 @@ class DataqCommsManager:
         return 0
     """
 
-    def process_response(self, response_from_logger):
-        name = "process_response"
-        self.log.info(name)
-
-        response_id = int.from_bytes(response_from_logger[0:4], byteorder=self.byte_order)
-        # key not implemented to tell different loggers apart
-        response_public_key = 0
-        responding_device_order = 0
-
-        # check if the response carriers a group ID
-        if len(response_from_logger) > 8:
-            response_public_key = int.from_bytes(response_from_logger[4:8], byteorder=self.byte_order)
-        else:
-            response_public_key = 0
-
-        # logger order for multi logger setups
-        if len(response_from_logger) > 12:
-            responding_device_order = int.from_bytes(response_from_logger[8:12], byteorder=self.byte_order)
-        else:
-            responding_device_order = 0
-
-        # this may cap the number of devices, ignore orders beyond the count?
-        if responding_device_order >= self.sync_device_count:
-            responding_device_order = self.sync_device_count
-        if responding_device_order < 0:
-            responding_device_order = 0
-
-        if response_id == DQEnums.ID.DQADCDATA:
-            self.log.info(name + ": processing DQADCDATA")
-
-            # init to something so its not a null reference
-            current_channel_index = 0
-
-            cumulative_sample_count_from_device = int.from_bytes(response_from_logger[12:16], byteorder=self.byte_order)
-            payload_sample_count_from_device = int.from_bytes(response_from_logger[16:20], byteorder=self.byte_order)
+    def store_decoded_block(self, device_container: DQDataContainer, decoded_block):
+        """
+        Hand a decoded block to the per device channel lists and, for sync groups, the frame assembler.
+        """
+        dq_decoder = device_container.dq_decoder
+        dq_data_structure = device_container.dq_data_structure
 
-            tracked_samples_received_per_device = self.dataq_group_container[
-                responding_device_order].dq_data_structure.cumulative_samples_received_this_device
+        dq_data_structure.channel_packet_carryover_index = dq_decoder.get_channel_packet_carryover_index()
+        dq_data_structure.cumulative_samples_received_this_device = dq_decoder.cumulative_samples_received
+        dq_data_structure.cumulative_missing_samples_this_device = dq_decoder.cumulative_missing_samples
 
-            missing_sample_count = cumulative_sample_count_from_device - tracked_samples_received_per_device
+        if decoded_block.number_of_scans() == 0:
+            return
 
-            # create fake data to fill any gaps
-            if missing_sample_count != 0:
+        if self.sync_frame_assembly_enable:
+            span_start_ns = self.profiler.begin()
+            self.sync_frame_assembler.add_block(decoded_block)
+            self.profiler.end("sync_frame_assembler", span_start_ns)
 
-                missing_sample_count_this_device = self.dataq_group_container[
-                    responding_device_order].dq_data_structure.cumulative_missing_samples_this_device
+        if self.decoded_block_handlers:
+            handler_start_ns = time.perf_counter_ns()
 
-                if missing_sample_count_this_device % self.set_sample_rate_hz == 0:
-                    if cumulative_sample_count_from_device > 0:
-                        percent_loss = int((1 - (
-                                    cumulative_sample_count_from_device - missing_sample_count_this_device) / cumulative_sample_count_from_device) * 100)
-                    else:
-                        percent_loss = 0.0
-                    print(
-                        "Missing Samples! Loss: " + str(percent_loss) + "%"
-                        + " Sent: " + str(cumulative_sample_count_from_device)
-                        + " Missing Cumulative: " + str(missing_sample_count_this_device)
-                        + " Missing Now: " + str(missing_sample_count)
-                        + ": Overflow exception count: " + str(self.buffer_overflow_exception_count)
-                    )
+            for decoded_block_handler in self.decoded_block_handlers:
+                decoded_block_handler(decoded_block)
 
-                self.buffer_overflow_detected = True
-                self.buffer_overflow_exception_count += 1
+            handler_end_ns = time.perf_counter_ns()
+            self.profiler.record("decoded_block_handlers", handler_start_ns, handler_end_ns)
+            self.metric_block_handler_seconds.observe((handler_end_ns - handler_start_ns) * 1e-9)
 
-                for missing_sample_index in range(missing_sample_count):
-                    # fill in the blanks across all enabled channels
+        span_start_ns = self.profiler.begin()
+        self.store_channels(device_container, decoded_block)
+        self.profiler.end("store_channels", span_start_ns)
 
-                    raw_bytes = 3  # value taken from C# example, not sure of significance
+    def store_channels(self, device_container: DQDataContainer, decoded_block):
+        """
+        Write a decoded block to the count ring or, without one, append it to the channel lists. The block was
+        decoded packet by packet for the handlers and the frame assembler, so the count ring gets a plain write here.
+        Only the sharded decode workers, which have no such consumers, decode batches straight into their rings with
+        dataqDecodeKernel.
+        """
+        dq_data_structure = device_container.dq_data_structure
 
-                    current_channel_index = (missing_sample_index + self.dataq_group_container[
-                        responding_device_order].dq_data_structure.channel_packet_carryover_index) % len(
-                        self.device_configuration.s_list)
+        if device_container.count_buffer is not None:
+            device_container.count_buffer.write(decoded_block.counts)
+            return
 
-                    current_channel_in_list = list(self.device_configuration.s_list.keys())[current_channel_index]
+        voltages = decoded_block.voltages()
 
-                    # get the channel voltage scale from the s_list
-                    configured_voltage_scale = self.get_voltage_scale_for_channel(current_channel_index)
+        counter_index = 0
 
-                    byte_modifier = int('0xfffc', 0)
+        for channel_index, channel_in_list in enumerate(self.device_configuration.s_list):
+            if channel_in_list in DQDataStructures.DQ4108.AnalogChannelFields:
+                channel_field = DQDataStructures.DQ4108.AnalogChannelFields[channel_in_list]
+                getattr(dq_data_structure, channel_field).extend(voltages[channel_index].tolist())
 
-                    result = int(raw_bytes & byte_modifier)
+            elif channel_in_list in DQDataStructures.DQ4108.DigitalChannelFields:
+                channel_field = DQDataStructures.DQ4108.DigitalChannelFields[channel_in_list]
+                getattr(dq_data_structure, channel_field).extend(
+                    pack_digital_lines(decoded_block.counts[channel_index]).tolist())
 
-                    # check if negative, perform twos complement conversion
-                    if result & 0x8000:
-                        result = (result ^ 65535) + 1
-                        result = result * -1
+            elif channel_in_list in DQDataStructures.DQ4108.CounterChannelFields:
+                channel_field = DQDataStructures.DQ4108.CounterChannelFields[channel_in_list]
+                getattr(dq_data_structure, channel_field).extend(decoded_block.counters[counter_index].tolist())
+                counter_index += 1
 
-                    # convert count into a voltage, from page 67 of Protocol pdf
-                    calculated_voltage = int(configured_voltage_scale * (result / 32768))
+    def add_decoded_block_handler(self, decoded_block_handler):
+        """
+        :param decoded_block_handler: callable taking a DQDecodedBlock, run on the receive thread for every block
+        decoded in process (not in sharded decode mode) so it has to keep up with the packet rate
+        """
+        self.decoded_block_handlers.append(decoded_block_handler)
 
-                    if current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch1:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog1.append(
-                            calculated_voltage)
+    def remove_decoded_block_handler(self, decoded_block_handler):
+        self.decoded_block_handlers.remove(decoded_block_handler)
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch2:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog2.append(
-                            calculated_voltage)
+    def get_aligned_frame(self):
+        """
+        :return: (first_timeline_index, voltages) covering the same instants on every device in the group,
+        channels stacked device by device. None if no common scans are buffered yet.
+        """
+        return self.sync_frame_assembler.get_aligned_frame()
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch3:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog3.append(
-                            calculated_voltage)
+    def update_sample_clock(self, device_order, response_from_logger, host_timestamp_ns):
+        name = "update_sample_clock"
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch4:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog4.append(
-                            calculated_voltage)
+        number_of_channels = len(self.device_configuration.s_list)
+        expected_count = self.sample_clock_cumulative_counts[device_order]
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch5:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog5.append(
-                            calculated_voltage)
+        # the datagram leaves the device once its last sample is taken
+        cumulative_count = unwrap_cumulative_count(int.from_bytes(response_from_logger[12:16],
+                                                                  byteorder=self.byte_order),
+                                                   expected_count)
+        payload_sample_count = int.from_bytes(response_from_logger[16:20], byteorder=self.byte_order)
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch6:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog6.append(
-                            calculated_voltage)
+        if cumulative_count < expected_count:
+            # the decoder resyncs onto the lower count and carries on its scan index, do the same here. How long
+            # the device was away isn't known, so the fit starts over rather than take a step in time
+            self.log.debug(name + ": device " + str(device_order) + " count went backwards, restarting the fit")
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch7:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog7.append(
-                            calculated_voltage)
+            self.sample_clock_scan_offsets[device_order] += (expected_count - cumulative_count) / number_of_channels
+            self.sample_clock_models[device_order].reset()
 
-                    elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch8:
-                        self.dataq_group_container[responding_device_order].dq_data_structure.analog8.append(
-                            calculated_voltage)
+        self.sample_clock_cumulative_counts[device_order] = cumulative_count + payload_sample_count
 
-                    else:
-                        self.log.warning(name + ": channel not found in list: " + current_channel_in_list)
+        scan_index = self.dataq_group_container[device_order].dq_decoder.scan_index_offset + \
+            self.sample_clock_scan_offsets[device_order] + \
+            (cumulative_count + payload_sample_count) / number_of_channels
 
-                # update the tracked sample count to reflect the "new" faked samples
-                self.dataq_group_container[
-                    responding_device_order].dq_data_structure.cumulative_missing_samples_this_device += missing_sample_count
-                self.dataq_group_container[
-                    responding_device_order].dq_data_structure.cumulative_samples_received_this_device = cumulative_sample_count_from_device
+        self.sample_clock_models[device_order].add_observation(scan_index, host_timestamp_ns)
 
-            # the payload length is defined by the chosen packet size. The bytes sent are divided amongst the number
-            # of channels being read in
-            for payload_index in range(payload_sample_count_from_device):
-                sample_start_index = 20 + payload_index * 2
-                raw_bytes = int.from_bytes(response_from_logger[sample_start_index:sample_start_index + 2],
-                                           byteorder=self.byte_order)
+    def get_sample_clock_model(self, device_order=0) -> DQSampleClockModel:
+        return self.sample_clock_models[device_order]
 
-                current_channel_index = (payload_index + self.dataq_group_container[
-                    responding_device_order].dq_data_structure.channel_packet_carryover_index) % len(
-                    self.device_configuration.s_list)
+    def process_response(self, response_from_logger, host_timestamp_ns=None):
+        """
+        :param response_from_logger: raw datagram
+        :param host_timestamp_ns: host monotonic receive time of the datagram, if known
+        """
+        name = "process_response"
+        self.log.info(name)
 
-                self.log.debug(
-                    name + ": " +
-                    "\n\tcurrent_channel_index: " + str(current_channel_index) +
-                    "\n\tpayload_index: " + str(payload_index) +
-                    "\n\tchannel_carryover_index: " + str(self.dataq_group_container[
-                                                              responding_device_order].dq_data_structure.channel_packet_carryover_index)
-                )
+        response_id = int.from_bytes(response_from_logger[0:4], byteorder=self.byte_order)
 
-                current_channel_in_list = list(self.device_configuration.s_list.keys())[current_channel_index]
+        # a text record such as a discovery reply, there is no device order to check
+        if response_id != DQEnums.ID.DQADCDATA and response_id != DQEnums.ID.DQRESPONSE and \
+                self.foreign_datagram_handlers:
+            for foreign_datagram_handler in self.foreign_datagram_handlers:
+                foreign_datagram_handler(response_from_logger)
 
-                # get the channel voltage scale from the s_list
-                configured_voltage_scale = self.get_voltage_scale_for_channel(current_channel_index)
+            return 1
 
-                # print("raw: {0:16b}".format(raw_bytes))
+        # key not implemented to tell different loggers apart
+        response_public_key = 0
+        responding_device_order = 0
 
-                byte_modifier = int('0xfffc', 0)
+        # check if the response carriers a group ID
+        if len(response_from_logger) > 8:
+            response_public_key = int.from_bytes(response_from_logger[4:8], byteorder=self.byte_order)
+        else:
+            response_public_key = 0
 
-                result = int(raw_bytes & byte_modifier)
+        # logger order for multi logger setups
+        if len(response_from_logger) > 12:
+            responding_device_order = int.from_bytes(response_from_logger[8:12], byteorder=self.byte_order)
+        else:
+            responding_device_order = 0
 
-                # print("mod: {0:16b}".format(result))
+        # CONNECT gave each logger device_group_order + its place in the group as its order
+        if self.device_configuration is not None:
+            responding_device_order -= self.device_configuration.device_group_order
 
-                # check if negative, perform twos complement conversion
-                if result & 0x8000:
-                    result = (result ^ 65535) + 1
-                    result = result * -1
+        # orders outside the group have no decoder or buffers to go to
+        if responding_device_order >= self.sync_device_count or responding_device_order < 0:
+            self.log.warning(name + ": rejecting packet from device order " + str(responding_device_order))
+            self.metric_packets_rejected.inc()
+            return 0
 
-                # convert count into a voltage, from page 67 of Protocol pdf
-                calculated_voltage = configured_voltage_scale * (result / 32768)
+        if response_id == DQEnums.ID.DQADCDATA:
+            self.metric_packets_received[responding_device_order].inc()
 
-                if current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch1:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog1.append(
-                        calculated_voltage)
-                    # print("ch1: " + str(calculated_voltage))
+        if response_id == DQEnums.ID.DQADCDATA and self.acquisition_running:
+            self.connection_supervisor.on_packet(time.monotonic_ns())
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch2:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog2.append(
-                        calculated_voltage)
+        if response_id == DQEnums.ID.DQADCDATA and host_timestamp_ns is not None:
+            self.update_sample_clock(responding_device_order, response_from_logger, host_timestamp_ns)
 
-                    # print("ch2: " + str(calculated_voltage))
+        if response_id == DQEnums.ID.DQADCDATA and self.sharded_decode_coordinator is not None:
+            span_start_ns = self.profiler.begin()
+            self.sharded_decode_coordinator.dispatch(responding_device_order, response_from_logger)
+            self.profiler.end("sharded_dispatch", span_start_ns)
+            return 1
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch3:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog3.append(
-                        calculated_voltage)
+        elif response_id == DQEnums.ID.DQADCDATA:
+            self.log.info(name + ": processing DQADCDATA")
 
-                    # print("ch3: " + str(calculated_voltage))
+            device_container = self.dataq_group_container[responding_device_order]
+            dq_decoder = device_container.dq_decoder
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch4:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog4.append(
-                        calculated_voltage)
+            cumulative_sample_count_from_device = int.from_bytes(response_from_logger[12:16], byteorder=self.byte_order)
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch5:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog5.append(
-                        calculated_voltage)
+            decode_start_ns = time.perf_counter_ns()
+            decoded_block = dq_decoder.decode_packet(response_from_logger)
+            decode_end_ns = time.perf_counter_ns()
+            self.profiler.record("decode", decode_start_ns, decode_end_ns)
+            self.metric_decode_seconds.observe((decode_end_ns - decode_start_ns) * 1e-9)
+            decoded_block.host_timestamp_ns = host_timestamp_ns
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch6:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog6.append(
-                        calculated_voltage)
+            self.metric_samples_decoded[responding_device_order].inc(
+                int.from_bytes(response_from_logger[16:20], byteorder=self.byte_order))
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch7:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog7.append(
-                        calculated_voltage)
+            if decoded_block.missing_samples != 0:
+                missing_sample_count = decoded_block.missing_samples
+                self.metric_samples_gap_filled[responding_device_order].inc(missing_sample_count)
 
-                elif current_channel_in_list == DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch8:
-                    self.dataq_group_container[responding_device_order].dq_data_structure.analog8.append(
-                        calculated_voltage)
+                self.connection_supervisor.add_gap(DQGapRecord(
+                    device_order=responding_device_order,
+                    first_scan_index=decoded_block.first_scan_index,
+                    scans=-(-missing_sample_count // len(self.device_configuration.s_list)),
+                    kind=GAP_KIND_MISSING_SAMPLES
+                ))
+                missing_sample_count_this_device = dq_decoder.cumulative_missing_samples - missing_sample_count
 
-                else:
-                    self.log.warning(name + ": channel not found in list: " + current_channel_in_list)
+                if missing_sample_count_this_device % self.set_sample_rate_hz == 0:
+                    if cumulative_sample_count_from_device > 0:
+                        percent_loss = int((1 - (
+                                    cumulative_sample_count_from_device - missing_sample_count_this_device) / cumulative_sample_count_from_device) * 100)
+                    else:
+                        percent_loss = 0.0
+                    print(
+                        "Missing Samples! Device: " + str(responding_device_order)
+                        + " Loss: " + str(percent_loss) + "%"
+                        + " Sent: " + str(cumulative_sample_count_from_device)
+                        + " Missing Cumulative: " + str(missing_sample_count_this_device)
+                        + " Missing Now: " + str(missing_sample_count)
+                        + ": Overflow exception count: " + str(self.buffer_overflow_exception_count)
+                    )
 
-            self.dataq_group_container[
-                responding_device_order].dq_data_structure.cumulative_samples_received_this_device = \
-                self.dataq_group_container[
-                    responding_device_order].dq_data_structure.cumulative_samples_received_this_device + payload_sample_count_from_device
+                self.buffer_overflow_detected = True
+                self.buffer_overflow_exception_count += 1
 
-            self.dataq_group_container[
-                responding_device_order].dq_data_structure.channel_packet_carryover_index = current_channel_index + 1
+            self.store_decoded_block(device_container, decoded_block)
 
             self.log.debug(
                 name + ": " +
                 "\n\tcumulative_sample_count_from_device: " + str(cumulative_sample_count_from_device) +
-                "\n\tcumulative_samples_received: " + str(self.dataq_group_container[
-                                                              responding_device_order].dq_data_structure.cumulative_samples_received_this_device)
+                "\n\tcumulative_samples_received: " + str(dq_decoder.cumulative_samples_received)
             )
 
             return 1
 
         elif response_id == DQEnums.ID.DQRESPONSE:
             self.log.info(name + ": processing DQRESPONSE")
+            self.metric_responses_received.inc()
             payload_sample_count = int.from_bytes(response_from_logger[12:16], byteorder=self.byte_order)
             payload = response_from_logger[16:16 + payload_sample_count]
             payload = payload.decode("utf-8").replace('\r', '')
             self.log.debug(name + ": response: " + payload)
 
-            # drowan_TODO_20200624: create code that actually checks against the responses
-            self.log.warning(name + ": code to assess response not implemented yet!")
+            # echoes and answers go to whoever waits in receive_response
+            with self.command_response_condition:
+                self.command_responses.append((responding_device_order, payload))
+                self.command_response_condition.notify_all()
+
             return 1
         else:
             self.log.warning(name + ": rejecting unknown command")
+            self.metric_packets_rejected.inc()
             return 0
 
 
-# fastest, cleanest way to do this
-@dataclass()
-class AnalogVoltages:
-    channel = [
-        [],
-        [],
-        [],
-        [],
-
-        [],
-        [],
-        [],
-        []
-    ]
-
-
-# make a quick copy of the data
-def dataq_data_handler(data_container: DQDataContainer):
-    name = "consume_data"
-    # self.log.info(name)
-
-    # start_time = time.time()
-    for i in range(len(data_container[0].dq_data_structure.analog1)):
-        voltage = data_container[0].dq_data_structure.analog1.pop()
-        analog_voltages.channel[0].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog2)):
-        voltage = data_container[0].dq_data_structure.analog2.pop()
-        analog_voltages.channel[1].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog3)):
-        voltage = data_container[0].dq_data_structure.analog3.pop()
-        analog_voltages.channel[2].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog4)):
-        voltage = data_container[0].dq_data_structure.analog4.pop()
-        analog_voltages.channel[3].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog5)):
-        voltage = data_container[0].dq_data_structure.analog5.pop()
-        analog_voltages.channel[4].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog6)):
-        voltage = data_container[0].dq_data_structure.analog6.pop()
-        analog_voltages.channel[5].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog7)):
-        voltage = data_container[0].dq_data_structure.analog7.pop()
-        analog_voltages.channel[6].append(voltage)
-
-    for i in range(len(data_container[0].dq_data_structure.analog8)):
-        voltage = data_container[0].dq_data_structure.analog8.pop()
-        analog_voltages.channel[7].append(voltage)
-
-    # print("--- %s seconds ---" % (time.time() - start_time))
-    """
-    # start with first channel and fill with the first available data set
-    # for channel in channel_data:
-    minimum_samples_to_take = len(channel_data[0])
-
-    if len(data_container[0].dq_data_structure.analog1) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-                voltage = data_container[0].dq_data_structure.analog1.pop()
-                channel_data[0][i] = voltage
-                
-    if len(data_container[0].dq_data_structure.analog2) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog2.pop()
-            channel_data[1][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog3) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog3.pop()
-            channel_data[2][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog4) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog4.pop()
-            channel_data[3][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog5) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog5.pop()
-            channel_data[4][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog6) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog6.pop()
-            channel_data[5][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog7) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog7.pop()
-            channel_data[6][i] = voltage
-
-    if len(data_container[0].dq_data_structure.analog8) > minimum_samples_to_take:
-        for i in range(minimum_samples_to_take):
-            voltage = data_container[0].dq_data_structure.analog8.pop()
-            channel_data[7][i] = voltage
-    """
-
-
-def voltage_data_source_manager_runnable(voltage_channel_data: np.ndarray, sink_handler):
-    name = "voltage_data_source_manager_runnable"
-
-    while True:
-        # start_time = time.time()
-
-        if voltage_data_source_manager_thread_enable is False:
-            print("exiting " + name)
-            break
-
-        # extract analog voltages, store into ndarray
-        ndarray_index = 0
-
-        call_hanlder = False
-
-        global analog_voltages
-        # start_time = time.time()
-        # for i, channel in enumerate(analog_voltages.channel):
-        for channel in analog_voltages.channel:
-
-            if len(channel) > voltage_channel_data.shape[1]:
-                for i in range(voltage_channel_data.shape[1]):
-                    voltage_channel_data[ndarray_index][i] = channel.pop()
-
-                ndarray_index += 1
-
-            if ndarray_index >= voltage_channel_data.shape[0]:
-                call_hanlder = True
-
-        if call_hanlder:
-            sink_handler(voltage_channel_data)
-
-            """
-            print("\nch1: ", end=" ")
-            for v in voltage_channel_data[0]:
-                print("{:10.2f}".format(v), end=" ")
-
-            print("\nch2: ", end=" ")
-            for v in voltage_channel_data[1]:
-                print("{:10.2f}".format(v), end=" ")
-            
-            print("\nch3: ", end=" ")            
-            for v in voltage_channel_data[2]:
-                print("{:10.2f}".format(v), end=" ")
-            
-            print("\nch4: ", end=" ")
-            for v in voltage_channel_data[3]:
-                print("{:10.2f}".format(v), end=" ")
-
-            print("\nch5: ", end=" ")
-            for v in voltage_channel_data[4]:
-                print("{:10.2f}".format(v), end=" ")
-
-            print("\nch6: ", end=" ")
-            for v in voltage_channel_data[5]:
-                print("{:10.2f}".format(v), end=" ")
-
-            print("\nch7: ", end=" ")
-            for v in voltage_channel_data[6]:
-                print("{:10.2f}".format(v), end=" ")
-
-            print("\nch8: ", end=" ")
-            for v in voltage_channel_data[7]:
-                print("{:10.2f}".format(v), end=" ")
-            print("\n")
-            """
-
-        # print("--- %s seconds ---" % (time.time() - start_time))
-
-
-# Debug level and console print statements will influence scripts ability to handle large amounts of data
-# https://www.loggly.com/ultimate-guide/python-logging-basics/
-logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
-
-voltage_data_source_manager_thread_enable = True
-# channel_data = None
-analog_voltages = None
-
-
-def dummy_handler(voltage_channel_data: np.ndarray):
-    name = "dummy_handler"
-    print('dummy handler')
-
-
-global start_time
-
-
-def main():
-    print("Entering main")
-
-    global analog_voltages
-    analog_voltages = AnalogVoltages()
-
-    # debug plot code
-
-    # input("Press enter to continue...")
-
-    # define ports, IPs, keys
-    dq_ports = DQPorts(
-        logger_discovery_local_port=1235,
-        logger_discovery_remote_port=1234,
-        logger_command_local_port=51235,
-        logger_command_data_client_port=1427
-    )
-
-    logger_ip = "192.168.9.2"
-    client_ip = "192.168.9.4"
-
-    my_group_key_id = int("0x06681444", 0)
-
-    # define channel config - channel 1 must be configured and first in the list even if ch 1 is not used
-    voltage_scale = DQMasks.DQ4108.ScanListDefinition.AnalogScale.PN_0V5
-    # from protocol doc: • slist positions must be defined sequentially beginning with position 0
-    # DO NOT skip channels or mix the order as this will completely screw up the measurement capture.
-    scan_list_configuration = {
-        DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch1: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch2: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch3: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch4: voltage_scale
-
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch5: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch6: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch7: voltage_scale
-        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch8: voltage_scale
-    }
-
-    # buffer should be sized so that one periods worth of data is rendered once a second
-    sample_rate = DQEnums.SampleRate.SAMPLE_100HZ
-    per_channel_data_buffer_size = sample_rate
-    voltage_positive_reference = 0.5
-    voltage_negative_reference = -1 * voltage_positive_reference
-
-    # setup size of channel_data object
-    # global channel_data
-    channel_data = np.zeros(shape=(len(scan_list_configuration), per_channel_data_buffer_size), dtype=float)
-
-    # setup the matplot sink
-    # matplot_sink = MatplotSink(len(scan_list_configuration), per_channel_data_buffer_size, voltage_negative_reference, voltage_positive_reference, 1)
-
-    # setup the thread that will pass data onto the sink
-    global voltage_data_source_manager_thread_enable
-    voltage_data_source_manager_thread = threading.Thread(target=voltage_data_source_manager_runnable,
-                                                          args=(channel_data, dummy_handler)) # matplot_sink.voltage_data_sink_handler))
-
-    dataq_comms = DataqCommsManager(dq_ports, logger_ip, client_ip)
-
-    dataq_comms.set_sample_rate(sample_rate)
-    dataq_comms.set_receive_buffer_size(sample_rate * 2 * 2 * len(scan_list_configuration))
-
-    print(dataq_comms.recv_buffer_size)
-
-    if dataq_comms.initialize_socket():
-        print("socket initialized")
-    else:
-        print("failed to initialize socket")
-        return -1
-
-    # create configuration
-    dataq_config = DQDeviceConfiguration(
-        encode=DQEnums.Encoding.BINARY_DEFAULT,
-        ps=DQEnums.PacketSize.PS_512_BYTES,
-        s_list=scan_list_configuration,
-        device_role=DQEnums.DeviceRole.MASTER,
-        device_group_key_id=my_group_key_id,
-        device_group_order=0
-    )
-
-    dataq_comms.configure_and_connect_device(dataq_config, dataq_data_handler)
-
-    # set device time
-    # TBD
-
-    # start a demo thread to print out the voltages
-    voltage_data_source_manager_thread.start()
-
-    # sync start/start acquisition
-    dataq_comms.start_acquisition()
-
-    matplot_sink.show_graph()
-
-    input("Press enter to stop...")
-
-    matplot_sink.close_graph()
-
-    # stop
-    dataq_comms.stop_acquisition()
-
-    # disconnect
-    dataq_comms.disconnect_device()
-
-    # stop thread that is printing out voltages
-    voltage_data_source_manager_thread_enable = False
-
-
 if __name__ == "__main__":
-    # cProfile.run('main()')
+    # the demo runs through an AcquisitionSession now
+    from dataqSession import main
     main()
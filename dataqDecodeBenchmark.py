@@ -0,0 +1,131 @@
+import sys
+import time
+import numpy as np
+
+from dataqBuffers import DQScanRingBuffer
+from dataqDecodeKernel import decode_datagrams_into_ring, decode_compiled, decode_scans_kernel, \
+    get_compiled_kernel, parse_datagrams
+from dataqDecoder import DQDeviceDecoder, unwrap_cumulative_counts
+
+"""
+Decode benchmark. Times packet by packet decode_packet plus DQScanRingBuffer.write against the batch decode of
+dataqDecodeKernel (NumPy, and numba if installed) on synthetic DQADCDATA packets with lost packets and partial
+scans. Before timing, every path is checked to leave the ring and the decoder bit for bit the same.
+
+    python dataqDecodeBenchmark.py [channels] [samples per packet] [packets per batch]
+"""
+
+# what a DI-4108 streams with every analog input at 10 kHz
+TARGET_SAMPLES_PER_SECOND = 8 * 10000
+
+
+def make_datagrams(number_of_packets, samples_per_packet, drop_every=0, restart_at=None, seed=0):
+    """
+    :param drop_every: leave out every n-th packet so the decoder has to gap fill
+    :param restart_at: packet index where the device count starts over from 0
+    """
+    random_generator = np.random.default_rng(seed)
+    datagrams = []
+    cumulative_count = 0
+
+    for packet_index in range(number_of_packets):
+        if packet_index == restart_at:
+            cumulative_count = 0
+
+        payload = random_generator.integers(0, 1 << 16, samples_per_packet, dtype=np.uint16).astype('<u2')
+        header = np.array([0, 0, 0, cumulative_count, samples_per_packet], dtype='<u4')
+        cumulative_count += samples_per_packet
+
+        if drop_every and packet_index % drop_every == drop_every - 1:
+            continue
+
+        datagrams.append(header.tobytes() + payload.tobytes())
+
+    return datagrams
+
+
+def decode_reference(dq_decoder, datagrams, scan_ring, batch_size):
+    for datagram in datagrams:
+        scan_ring.write(dq_decoder.decode_packet(datagram).counts)
+
+
+def decode_batched(dq_decoder, datagrams, scan_ring, batch_size, use_compiled):
+    for batch_start in range(0, len(datagrams), batch_size):
+        decode_datagrams_into_ring(dq_decoder, datagrams[batch_start:batch_start + batch_size], scan_ring,
+                                   use_compiled)
+
+
+def decode_python_kernel(dq_decoder, datagrams, scan_ring, batch_size):
+    # the loop numba compiles, run uncompiled to check it without numba installed
+    for batch_start in range(0, len(datagrams), batch_size):
+        words, cumulative_counts, payload_counts = parse_datagrams(datagrams[batch_start:batch_start + batch_size])
+        unwrap_cumulative_counts(cumulative_counts, payload_counts, dq_decoder.cumulative_samples_received)
+        missing_total, backwards = decode_compiled(decode_scans_kernel, dq_decoder, words, cumulative_counts,
+                                                   payload_counts, scan_ring)
+        dq_decoder.cumulative_missing_samples += missing_total
+
+
+def get_state(dq_decoder, scan_ring):
+    return (scan_ring.counts.tobytes(), scan_ring.get_scans_written(), dq_decoder.partial_scan_samples.tobytes(),
+            dq_decoder.cumulative_samples_received, dq_decoder.cumulative_missing_samples, dq_decoder.scans_decoded)
+
+
+def run(decode, number_of_channels, datagrams, capacity_scans, batch_size, *args):
+    dq_decoder = DQDeviceDecoder(0, np.full(number_of_channels, 10.0))
+    scan_ring = DQScanRingBuffer(number_of_channels, capacity_scans, dq_decoder.scales)
+
+    start_ns = time.perf_counter_ns()
+    decode(dq_decoder, datagrams, scan_ring, batch_size, *args)
+    elapsed_ns = time.perf_counter_ns() - start_ns
+
+    return get_state(dq_decoder, scan_ring), elapsed_ns
+
+
+def main():
+    number_of_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    samples_per_packet = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    paths = {
+        "numpy batch": (decode_batched, False),
+    }
+
+    if get_compiled_kernel() is not None:
+        paths["numba batch"] = (decode_batched, True)
+    else:
+        print("numba not installed, checking the kernel uncompiled")
+
+    # bit identity, with gaps, a device restart, partial scans and a ring that wraps
+    check_datagrams = make_datagrams(300, samples_per_packet, drop_every=7, restart_at=150)
+    reference_state, _ = run(decode_reference, number_of_channels, check_datagrams, 1000, batch_size)
+
+    for path_name, path in list(paths.items()) + [("python kernel", (decode_python_kernel,))]:
+        state, _ = run(path[0], number_of_channels, check_datagrams, 1000, batch_size, *path[1:])
+
+        if state != reference_state:
+            raise AssertionError(path_name + " differs from decode_packet")
+
+        print("%-16s bit identical" % path_name)
+
+    datagrams = make_datagrams(5000, samples_per_packet, drop_every=50)
+    number_of_samples = sum(len(datagram) - 20 for datagram in datagrams) // 2
+
+    _, reference_ns = run(decode_reference, number_of_channels, datagrams, 100000, batch_size)
+
+    print("%-16s %10s %12s %10s" % ("path", "ns/sample", "Msamples/s", "loggers"))
+    print("%-16s %10.2f %12.2f %10.1f" % ("decode_packet", reference_ns / number_of_samples,
+                                          number_of_samples / reference_ns * 1e3,
+                                          number_of_samples / (reference_ns * 1e-9) / TARGET_SAMPLES_PER_SECOND))
+
+    for path_name, path in paths.items():
+        # the first call compiles
+        run(path[0], number_of_channels, datagrams[:batch_size], 100000, batch_size, *path[1:])
+        _, elapsed_ns = run(path[0], number_of_channels, datagrams, 100000, batch_size, *path[1:])
+
+        print("%-16s %10.2f %12.2f %10.1f" % (path_name, elapsed_ns / number_of_samples,
+                                              number_of_samples / elapsed_ns * 1e3,
+                                              number_of_samples / (elapsed_ns * 1e-9) / TARGET_SAMPLES_PER_SECOND))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import logging
+import struct
+import numpy as np
+
+from dataqDecoder import DQDeviceDecoder, CHANNEL_KIND_ANALOG, DQADCDATA_HEADER_BYTES, GAP_FILL_RAW_VALUE, \
+    unwrap_cumulative_counts
+from dataqLazy import lazy_import
+
+"""
+Batch decode of DQADCDATA packets straight into the slots of a DQScanRingBuffer. Decoding packet by packet builds
+a sample array, a de-interleaved block and a masked copy for every packet before the ring gets its own copy. Here
+a batch of packets goes through once: carried partial scan, gap fill, masking and de-interleave happen while each
+word is written to its ring slot.
+
+The loop is compiled with numba when it is installed. Without numba the batch is decoded with NumPy in one
+concatenate, mask and transpose for the whole batch. Both leave the ring and the DQDeviceDecoder exactly as
+decode_packet plus DQScanRingBuffer.write would have, see dataqDecodeBenchmark. Scan lists with digital or counter
+positions need the forward fill of DQDeviceDecoder and always take the packet by packet path, so does a batch of
+one packet without numba.
+"""
+
+DQADCDATA_HEADER = struct.Struct("<5I")
+
+# loaded and compiled on first use, importing numba takes longer than everything else in the package
+numba = lazy_import("numba")
+compiled_kernel = None
+
+
+def decode_scans_kernel(words, cumulative_counts, payload_counts, masks, scan_buffer, carried, samples_received,
+                        ring_words, ring_position):
+    """
+    Plain loops so numba can compile it, also runs as is (slowly) without numba.
+    :param words: uint16 payloads of every packet back to back
+    :param cumulative_counts: int64 device sample count before each packet
+    :param payload_counts: int64 samples in each packet
+    :param masks: uint16 mask of each scan list position
+    :param scan_buffer: uint16, one scan. Holds the carried partial scan on the way in and the new one on the way out
+    :param carried: samples of scan_buffer in use on the way in
+    :param samples_received: decoder's cumulative_samples_received
+    :param ring_words: (channels x capacity) uint16 view of the ring counts
+    :param ring_position: ring scans_written
+    :return: (scans written, samples in scan_buffer, samples received, samples gap filled, packets that went back)
+    """
+    number_of_channels = masks.shape[0]
+    capacity = ring_words.shape[1]
+
+    position = carried
+    scans = 0
+    missing_total = 0
+    backwards = 0
+    word_index = 0
+
+    for packet_index in range(cumulative_counts.shape[0]):
+        missing = cumulative_counts[packet_index] - samples_received
+
+        if missing < 0:
+            backwards += 1
+
+        # gap fill, then the payload
+        for sample_index in range(max(missing, 0) + payload_counts[packet_index]):
+            if sample_index < missing:
+                word = GAP_FILL_RAW_VALUE
+            else:
+                word = words[word_index]
+                word_index += 1
+
+            scan_buffer[position] = word & masks[position]
+            position += 1
+
+            if position == number_of_channels:
+                column = (ring_position + scans) % capacity
+
+                for channel_index in range(number_of_channels):
+                    ring_words[channel_index, column] = scan_buffer[channel_index]
+
+                position = 0
+                scans += 1
+
+        if missing > 0:
+            missing_total += missing
+
+        samples_received = cumulative_counts[packet_index] + payload_counts[packet_index]
+
+    return scans, position, samples_received, missing_total, backwards
+
+
+def get_compiled_kernel():
+    """
+    :return: numba compiled decode_scans_kernel, None without numba
+    """
+    global compiled_kernel
+
+    if compiled_kernel is None and numba.is_module_available():
+        compiled_kernel = numba.njit(cache=True, nogil=True)(decode_scans_kernel)
+
+    return compiled_kernel
+
+
+def parse_datagrams(datagrams):
+    """
+    :return: (payload words back to back, int64 cumulative counts, int64 payload counts)
+    """
+    cumulative_counts = np.empty(len(datagrams), dtype=np.int64)
+    payload_counts = np.empty(len(datagrams), dtype=np.int64)
+    payloads = []
+
+    for packet_index, datagram in enumerate(datagrams):
+        header = DQADCDATA_HEADER.unpack_from(datagram)
+        cumulative_counts[packet_index] = header[3]
+        payload_counts[packet_index] = header[4]
+        payloads.append(memoryview(datagram)[DQADCDATA_HEADER_BYTES:DQADCDATA_HEADER_BYTES + 2 * header[4]])
+
+    words = np.frombuffer(b"".join(payloads), dtype='<u2')
+
+    return words, cumulative_counts, payload_counts
+
+
+def decode_datagrams_into_ring(dq_decoder: DQDeviceDecoder, datagrams, scan_ring, use_compiled=True):
+    """
+    Decode a batch of DQADCDATA datagrams into scan_ring, same result as decode_packet and scan_ring.write for
+    each of them in turn.
+    :param dq_decoder: decoder of the device, its carry and counters are updated
+    :param scan_ring: DQScanRingBuffer (or DQSharedScanRing) to write to
+    :param use_compiled: use the numba kernel if numba is installed
+    :return: samples gap filled in this batch
+    """
+    name = "decode_datagrams_into_ring"
+
+    if not datagrams:
+        return 0
+
+    kernel = get_compiled_kernel() if use_compiled else None
+
+    # a single packet gains nothing from the NumPy batch, it only adds the setup
+    if (dq_decoder.channel_kinds != CHANNEL_KIND_ANALOG).any() or (kernel is None and len(datagrams) == 1):
+        missing_before = dq_decoder.cumulative_missing_samples
+
+        for datagram in datagrams:
+            scan_ring.write(dq_decoder.decode_packet(datagram).counts)
+
+        return dq_decoder.cumulative_missing_samples - missing_before
+
+    words, cumulative_counts, payload_counts = parse_datagrams(datagrams)
+    unwrap_cumulative_counts(cumulative_counts, payload_counts, dq_decoder.cumulative_samples_received)
+
+    if kernel is not None:
+        missing_total, backwards = decode_compiled(kernel, dq_decoder, words, cumulative_counts, payload_counts,
+                                                   scan_ring)
+    else:
+        missing_total, backwards = decode_numpy(dq_decoder, words, cumulative_counts, payload_counts, scan_ring)
+
+    if backwards:
+        logging.getLogger("DQDeviceDecoder").warning(name + ": device " + str(dq_decoder.device_order) +
+                                                     " count went backwards " + str(backwards) +
+                                                     " times, resyncing")
+
+    dq_decoder.cumulative_missing_samples += missing_total
+
+    return missing_total
+
+
+def decode_compiled(kernel, dq_decoder: DQDeviceDecoder, words, cumulative_counts, payload_counts, scan_ring):
+    number_of_channels = dq_decoder.number_of_channels
+
+    scan_buffer = np.zeros(number_of_channels, dtype=np.uint16)
+    carried = dq_decoder.partial_scan_samples.shape[0]
+    scan_buffer[:carried] = dq_decoder.partial_scan_samples
+
+    # scans the batch ends up writing, announced before the kernel overwrites their slots
+    received_before = np.concatenate(([dq_decoder.cumulative_samples_received],
+                                      cumulative_counts[:-1] + payload_counts[:-1]))
+    batch_samples = carried + int(np.maximum(cumulative_counts - received_before, 0).sum() + payload_counts.sum())
+    ring_position = scan_ring.reserve(batch_samples // number_of_channels)
+
+    scans, position, samples_received, missing_total, backwards = kernel(
+        words, cumulative_counts, payload_counts, dq_decoder.position_masks, scan_buffer, carried,
+        dq_decoder.cumulative_samples_received, scan_ring.counts.view(np.uint16), ring_position)
+
+    dq_decoder.partial_scan_samples = scan_buffer[:position].copy()
+    dq_decoder.cumulative_samples_received = int(samples_received)
+    dq_decoder.scans_decoded += int(scans)
+
+    # publish only after the data is in place
+    scan_ring.commit(int(scans))
+
+    return int(missing_total), int(backwards)
+
+
+def decode_numpy(dq_decoder: DQDeviceDecoder, words, cumulative_counts, payload_counts, scan_ring):
+    # samples the device sent before each packet that never arrived
+    received_before = np.concatenate(([dq_decoder.cumulative_samples_received],
+                                      cumulative_counts[:-1] + payload_counts[:-1]))
+    missing = cumulative_counts - received_before
+    gap_fills = np.maximum(missing, 0)
+
+    segments = [dq_decoder.partial_scan_samples]
+    word_index = 0
+
+    for packet_index in range(cumulative_counts.shape[0]):
+        if gap_fills[packet_index]:
+            segments.append(np.full(gap_fills[packet_index], GAP_FILL_RAW_VALUE, dtype=np.uint16))
+
+        segments.append(words[word_index:word_index + payload_counts[packet_index]])
+        word_index += payload_counts[packet_index]
+
+    samples = np.concatenate(segments)
+
+    number_of_channels = dq_decoder.number_of_channels
+    number_of_scans = samples.shape[0] // number_of_channels
+    scan_samples = number_of_scans * number_of_channels
+
+    dq_decoder.partial_scan_samples = samples[scan_samples:].copy()
+    dq_decoder.cumulative_samples_received = int(cumulative_counts[-1] + payload_counts[-1])
+    dq_decoder.scans_decoded += number_of_scans
+
+    # de-interleaved and masked as it is copied into the ring
+    scan_words = samples[:scan_samples].reshape(number_of_scans, number_of_channels)
+    scan_words &= dq_decoder.position_masks
+    scan_ring.write(scan_words.T.view(np.int16))
+
+    return int(gap_fills.sum()), int((missing < 0).sum())
@@ -0,0 +1,301 @@
+from dataclasses import dataclass
+import logging
+import numpy as np
+
+"""
+Vectorized decode of DQADCDATA payloads. Each logger in a sync group gets its own DQDeviceDecoder so that
+gap tracking and the partial scan carried between packets never mix between devices.
+"""
+
+# analog samples are 14 bits left justified in a 16 bit word, the lower two bits are flags
+ADC_COUNT_MASK = np.uint16(0xfffc)
+ADC_FULL_SCALE_COUNTS = 32768
+
+# digital and counter words are used as is
+RAW_WORD_MASK = np.uint16(0xffff)
+
+# value taken from C# example, not sure of significance. Masks down to a count of 0
+GAP_FILL_RAW_VALUE = 3
+
+DQADCDATA_HEADER_BYTES = 20
+
+# what kind of input each scan list position samples
+CHANNEL_KIND_ANALOG = 0
+CHANNEL_KIND_DIGITAL = 1
+CHANNEL_KIND_COUNTER = 2
+# carried through untouched, e.g. the rate input
+CHANNEL_KIND_RAW = 3
+
+# digital input word: the state of D0..D6, see the slist section of the Protocol pdf
+DIGITAL_IN_BIT_SHIFT = 8
+DIGITAL_IN_LINES = 7
+
+COUNTER_WRAP = 1 << 16
+
+# the cumulative count in the DQADCDATA header is 32 bits, it wraps after 2^32 samples
+CUMULATIVE_COUNT_WRAP = 1 << 32
+
+
+@dataclass()
+class DQDecodedBlock:
+    device_order: int
+    # index of the first scan (one sample from every channel in the scan list) in this block
+    first_scan_index: int
+    # masked, signed ADC counts - one row per scan list position. Digital and counter positions hold the raw word
+    counts: np.ndarray
+    # full scale voltage for each row of counts, 0 for positions that aren't analog
+    scales: np.ndarray
+    # fake samples inserted in front of this block to cover lost packets
+    missing_samples: int
+    # host monotonic receive time of the datagram that completed this block
+    host_timestamp_ns: int = None
+    # (digital positions x DIGITAL_IN_LINES x scans) uint8 line states, None without digital positions
+    digital_lines: np.ndarray = None
+    # (counter positions x scans) int64 counts with 16 bit wraparound removed, None without counter positions
+    counters: np.ndarray = None
+
+    def number_of_scans(self):
+        return self.counts.shape[1]
+
+    def voltages(self):
+        # convert count into a voltage, from page 67 of Protocol pdf
+        return self.scales[:, None] * (self.counts / ADC_FULL_SCALE_COUNTS)
+
+
+def unpack_digital_lines(raw_words: np.ndarray):
+    """
+    :param raw_words: (positions x scans) digital input words
+    :return: (positions x DIGITAL_IN_LINES x scans) uint8 array of 0/1 line states
+    """
+    line_shifts = np.arange(DIGITAL_IN_BIT_SHIFT, DIGITAL_IN_BIT_SHIFT + DIGITAL_IN_LINES, dtype=np.uint16)
+    words = raw_words.view(np.uint16)
+    return ((words[:, None, :] >> line_shifts[None, :, None]) & 1).astype(np.uint8)
+
+
+def pack_digital_lines(raw_words: np.ndarray):
+    # D0..D6 as one integer per scan
+    return (raw_words.view(np.uint16) >> DIGITAL_IN_BIT_SHIFT) & ((1 << DIGITAL_IN_LINES) - 1)
+
+
+def unwrap_cumulative_count(cumulative_count, expected_count):
+    """
+    Put back the high word the 32 bit header field drops. The count is taken to be within half the range of the
+    expected one, forwards after a wrap or backwards for a late packet. A device that starts over from 0 well
+    before the first wrap still shows up as the count going backwards.
+    :param cumulative_count: cumulative count as sent in the DQADCDATA header
+    :param expected_count: unwrapped count the next packet should report, i.e. samples received so far
+    :return: unwrapped cumulative count, never negative
+    """
+    unwrapped = expected_count + (cumulative_count - expected_count + CUMULATIVE_COUNT_WRAP // 2) % \
+        CUMULATIVE_COUNT_WRAP - CUMULATIVE_COUNT_WRAP // 2
+
+    return unwrapped if unwrapped >= 0 else unwrapped + CUMULATIVE_COUNT_WRAP
+
+
+def unwrap_cumulative_counts(cumulative_counts: np.ndarray, payload_counts: np.ndarray, expected_count):
+    """
+    unwrap_cumulative_count for a batch of packets in arrival order, in place. Each packet is unwrapped against
+    the end of the one before it.
+    :param cumulative_counts: int64 header counts of each packet
+    :param payload_counts: samples in each packet
+    """
+    # the first quarter of the range can't be more than half the range off, the common case needs no work
+    if expected_count < CUMULATIVE_COUNT_WRAP // 4 and int(cumulative_counts.max()) < CUMULATIVE_COUNT_WRAP // 4:
+        return
+
+    previous_ends = np.concatenate(([expected_count], cumulative_counts[:-1] + payload_counts[:-1]))
+    steps = (cumulative_counts - previous_ends + CUMULATIVE_COUNT_WRAP // 2) % CUMULATIVE_COUNT_WRAP - \
+        CUMULATIVE_COUNT_WRAP // 2
+
+    steps[1:] += payload_counts[:-1]
+    unwrapped = expected_count + np.cumsum(steps)
+
+    if unwrapped.min() < 0:
+        # only for counts that make no sense, e.g. close to 2^32 right after a start, go one at a time
+        for packet_index in range(cumulative_counts.shape[0]):
+            cumulative_counts[packet_index] = unwrap_cumulative_count(int(cumulative_counts[packet_index]),
+                                                                      expected_count)
+            expected_count = int(cumulative_counts[packet_index] + payload_counts[packet_index])
+        return
+
+    cumulative_counts[:] = unwrapped
+
+
+class DQDeviceDecoder:
+
+    def __init__(self, device_order, channel_scales, channel_kinds=None):
+        """
+        :param device_order: order of the logger within its sync group
+        :param channel_scales: full scale voltage for each position of the scan list
+        :param channel_kinds: CHANNEL_KIND_* of each scan list position, all analog if not given
+        """
+        self.log = logging.getLogger("DQDeviceDecoder")
+
+        self.device_order = device_order
+        self.scales = np.asarray(channel_scales, dtype=float)
+        self.number_of_channels = self.scales.shape[0]
+
+        if channel_kinds is None:
+            channel_kinds = [CHANNEL_KIND_ANALOG] * self.number_of_channels
+
+        self.channel_kinds = np.asarray(channel_kinds)
+        self.digital_positions = np.flatnonzero(self.channel_kinds == CHANNEL_KIND_DIGITAL)
+        self.counter_positions = np.flatnonzero(self.channel_kinds == CHANNEL_KIND_COUNTER)
+        self.raw_positions = np.flatnonzero(self.channel_kinds != CHANNEL_KIND_ANALOG)
+
+        # analog positions drop the flag bits, everything else is kept as sent
+        self.position_masks = np.where(self.channel_kinds == CHANNEL_KIND_ANALOG, ADC_COUNT_MASK,
+                                       RAW_WORD_MASK).astype(np.uint16)
+
+        self.reset()
+
+    def get_channel_packet_carryover_index(self):
+        # the scan list position the first sample of the next packet belongs to
+        return self.partial_scan_samples.shape[0]
+
+    def reset(self):
+        # raw samples from the end of the last packet that did not complete a scan, and which of them were faked
+        self.partial_scan_samples = np.empty(0, dtype=np.uint16)
+        self.partial_scan_gap = np.empty(0, dtype=bool)
+
+        # last real word of each digital/counter position, stands in for samples lost in a gap
+        self.last_raw_words = np.zeros(self.raw_positions.shape[0], dtype=np.uint16)
+        # counter value (wraps removed) of the last word in last_raw_words
+        self.counter_totals = np.zeros(self.counter_positions.shape[0], dtype=np.int64)
+
+        self.cumulative_samples_received = 0
+        self.cumulative_missing_samples = 0
+        self.scans_decoded = 0
+        # scan index of the device's cumulative count 0, moves on when the device restarts mid run
+        self.scan_index_offset = 0
+
+    def resync(self, skipped_scans):
+        """
+        The device was restarted and counts from 0 again. Whatever partial scan was pending is dropped and the
+        scan index moves on by skipped_scans, so scan indexes keep following time across the outage.
+        """
+        self.partial_scan_samples = np.empty(0, dtype=np.uint16)
+        self.partial_scan_gap = np.empty(0, dtype=bool)
+
+        self.cumulative_samples_received = 0
+        self.scans_decoded += skipped_scans
+        self.scan_index_offset = self.scans_decoded
+
+    def decode_packet(self, response_from_logger):
+        """
+        Decode the payload of a whole DQADCDATA packet, header included.
+        :return: DQDecodedBlock holding every scan completed by this packet
+        """
+        header = np.frombuffer(response_from_logger, dtype='<u4', count=5)
+        cumulative_sample_count_from_device = unwrap_cumulative_count(int(header[3]),
+                                                                      self.cumulative_samples_received)
+        payload_sample_count_from_device = int(header[4])
+
+        payload = np.frombuffer(response_from_logger, dtype='<u2', count=payload_sample_count_from_device,
+                                offset=DQADCDATA_HEADER_BYTES)
+
+        return self.decode_samples(cumulative_sample_count_from_device, payload)
+
+    def decode_samples(self, cumulative_sample_count_from_device, raw_samples):
+        """
+        :param cumulative_sample_count_from_device: samples the device reports having sent before this payload,
+        already unwrapped, see unwrap_cumulative_count
+        :param raw_samples: uint16 words straight from the packet payload
+        """
+        name = "decode_samples"
+
+        missing_sample_count = cumulative_sample_count_from_device - self.cumulative_samples_received
+
+        gap_fill_count = 0
+
+        if missing_sample_count > 0:
+            # create fake data to fill any gaps
+            gap_fill_count = missing_sample_count
+            self.cumulative_missing_samples += missing_sample_count
+        elif missing_sample_count < 0:
+            self.log.warning(name + ": device " + str(self.device_order) + " count went backwards by " +
+                             str(-missing_sample_count) + ", resyncing")
+
+        self.cumulative_samples_received = cumulative_sample_count_from_device + raw_samples.shape[0]
+
+        carried = self.partial_scan_samples.shape[0]
+        total = carried + gap_fill_count + raw_samples.shape[0]
+
+        # samples always start at scan list position 0, the partial scan makes up the difference
+        samples = np.empty(total, dtype=np.uint16)
+        samples[:carried] = self.partial_scan_samples
+        samples[carried:carried + gap_fill_count] = GAP_FILL_RAW_VALUE
+        samples[carried + gap_fill_count:] = raw_samples
+
+        number_of_scans = total // self.number_of_channels
+        scan_samples = number_of_scans * self.number_of_channels
+
+        self.partial_scan_samples = samples[scan_samples:].copy()
+
+        # de-interleave into one row per scan list position
+        block_words = np.ascontiguousarray(samples[:scan_samples].reshape(number_of_scans, self.number_of_channels).T)
+
+        # mask off the flag bits then reinterpret as two's complement
+        block_words &= self.position_masks[:, None]
+
+        block = DQDecodedBlock(
+            device_order=self.device_order,
+            first_scan_index=self.scans_decoded,
+            counts=block_words.view(np.int16),
+            scales=self.scales,
+            missing_samples=gap_fill_count
+        )
+
+        if self.raw_positions.shape[0]:
+            gap = np.zeros(total, dtype=bool)
+            gap[:carried] = self.partial_scan_gap
+            gap[carried:carried + gap_fill_count] = True
+            self.partial_scan_gap = gap[scan_samples:].copy()
+
+            block_gap = gap[:scan_samples].reshape(number_of_scans, self.number_of_channels).T
+
+            self.__decode_raw_positions(block, block_words, block_gap)
+
+        self.scans_decoded += number_of_scans
+
+        return block
+
+    def __decode_raw_positions(self, block, block_words, block_gap):
+        """
+        Digital and counter positions. Faked samples would look like real edges or counter jumps, so they repeat
+        the last real word instead.
+        """
+        raw_words = block_words[self.raw_positions]
+        raw_gap = block_gap[self.raw_positions]
+
+        if raw_gap.any():
+            # forward fill, column 0 is the last real word from before this block
+            filled = np.concatenate((self.last_raw_words[:, None], raw_words), axis=1)
+            valid = np.concatenate((np.ones((raw_words.shape[0], 1), dtype=bool), ~raw_gap), axis=1)
+            source_index = np.maximum.accumulate(np.where(valid, np.arange(filled.shape[1]), 0), axis=1)
+            raw_words = np.take_along_axis(filled, source_index, axis=1)[:, 1:]
+
+            # keep the block's own copy in step
+            block_words[self.raw_positions] = raw_words
+
+        if raw_words.shape[1] == 0:
+            return
+
+        digital_rows = np.searchsorted(self.raw_positions, self.digital_positions)
+        counter_rows = np.searchsorted(self.raw_positions, self.counter_positions)
+
+        if digital_rows.shape[0]:
+            block.digital_lines = unpack_digital_lines(raw_words[digital_rows])
+
+        if counter_rows.shape[0]:
+            counter_words = raw_words[counter_rows].astype(np.int64)
+            previous = self.last_raw_words[counter_rows].astype(np.int64)
+
+            # every step backwards is one trip through 65535 -> 0
+            steps = np.diff(np.concatenate((previous[:, None], counter_words), axis=1), axis=1)
+            wraps = np.cumsum(steps < 0, axis=1)
+
+            block.counters = self.counter_totals[:, None] - previous[:, None] + counter_words + wraps * COUNTER_WRAP
+            self.counter_totals = block.counters[:, -1].copy()
+
+        self.last_raw_words = raw_words[:, -1].copy()
@@ -0,0 +1,107 @@
+from dataclasses import dataclass, asdict
+from enum import IntEnum
+import json
+import logging
+import os
+import threading
+
+"""
+Answers to "info" queries. Everything except the sample rate is fixed for a given logger, so once read it is kept
+by serial number and a later startup, or another manager talking to the same logger, doesn't ask again.
+"""
+
+
+class DQInfoRequests(IntEnum):
+    """
+    Argument of the "info" command, also DQEnums.InfoRequests.
+    """
+    MFG = 0
+    MODEL = 1
+    FIRMWARE_REV = 2
+    DEVICE_STRING = 5
+    SERIAL_NO = 6
+    SAMPLE_RATE = 9
+
+
+# requests whose answer never changes for a logger, with the DQDeviceInfo field they fill
+STATIC_INFO_FIELDS = {
+    DQInfoRequests.MFG: "mfg",
+    DQInfoRequests.MODEL: "model",
+    DQInfoRequests.FIRMWARE_REV: "firmware_rev",
+    DQInfoRequests.DEVICE_STRING: "device_string",
+    DQInfoRequests.SERIAL_NO: "serial_no"
+}
+
+
+@dataclass()
+class DQDeviceInfo:
+    serial_no: str
+    mfg: str = None
+    model: str = None
+    firmware_rev: str = None
+    device_string: str = None
+
+    def is_complete(self):
+        return None not in asdict(self).values()
+
+
+def parse_info_response(payload):
+    """
+    :param payload: DQRESPONSE text, "info <request> <value>"
+    :return: (request, value), None if the payload isn't an info response
+    """
+    tokens = payload.strip().split(None, 2)
+
+    if len(tokens) < 2 or tokens[0] != "info" or not tokens[1].isdigit():
+        return None
+
+    value = tokens[2].strip() if len(tokens) > 2 else ""
+
+    return int(tokens[1]), value
+
+
+class DQDeviceInfoCache:
+
+    def __init__(self, cache_file=None):
+        """
+        :param cache_file: JSON file the cache is loaded from and saved to, kept in memory only if None
+        """
+        self.log = logging.getLogger("DQDeviceInfoCache")
+
+        self.cache_file = cache_file
+        self.device_info = {}
+        self.lock = threading.Lock()
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load()
+
+    def load(self):
+        name = "load"
+
+        try:
+            with open(self.cache_file) as cache:
+                self.device_info = {serial_no: DQDeviceInfo(**device_info)
+                                    for serial_no, device_info in json.load(cache).items()}
+        except (OSError, ValueError, TypeError):
+            self.log.exception(name + ": ignoring " + str(self.cache_file))
+            self.device_info = {}
+
+    def save(self):
+        if self.cache_file is None:
+            return
+
+        with self.lock:
+            device_info = {serial_no: asdict(info) for serial_no, info in self.device_info.items()}
+
+        with open(self.cache_file, "w") as cache:
+            json.dump(device_info, cache, indent=2)
+
+    def get(self, serial_no) -> DQDeviceInfo:
+        with self.lock:
+            return self.device_info.get(serial_no)
+
+    def put(self, device_info: DQDeviceInfo):
+        with self.lock:
+            self.device_info[device_info.serial_no] = device_info
+
+        self.save()
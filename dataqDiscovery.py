@@ -0,0 +1,281 @@
+from dataclasses import dataclass, field
+import logging
+import queue
+import socket
+import threading
+import time
+
+"""
+Discovery of DI-4108 loggers. One broadcast on the discovery port reaches every logger on the subnet, they all
+answer at once, so bringing up a rack takes a single round trip instead of probing each IP in turn.
+
+The reply is a comma separated text record. DISCOVERY_REPLY_FIELDS gives the order, see the discovery section
+of the Protocol pdf. The sender address of the datagram is used as the IP, whatever the record says.
+
+The loggers always answer on logger_discovery_remote_port, which a connected DataqCommsManager holds for its
+responses. Give DQDeviceDiscovery that manager and the replies are taken from its socket instead.
+"""
+
+DISCOVERY_REQUEST = b"dataq_instruments"
+
+# field order of a discovery reply, fields past the end of a short reply are left empty
+DISCOVERY_REPLY_FIELDS = ("mac", "ip", "serial_no", "firmware_rev", "description", "model")
+
+# discovery replies don't carry it, every DI-4108 is made by DATAQ
+DEFAULT_MFG = "DATAQ"
+
+
+@dataclass()
+class DQDiscoveredDevice:
+    ip: str
+    # same names as DQEnums.InfoRequests, lower case
+    mfg: str = DEFAULT_MFG
+    model: str = ""
+    firmware_rev: str = ""
+    serial_no: str = ""
+    mac: str = ""
+    description: str = ""
+    # reply as received
+    reply: str = ""
+    # time.monotonic() of the last reply
+    last_seen_s: float = field(default=0.0, compare=False)
+
+
+def parse_discovery_reply(reply, sender_ip):
+    """
+    :param reply: datagram payload from a logger
+    :param sender_ip: source address of the datagram, None to go by the ip field of the record
+    :return: DQDiscoveredDevice, None if the reply isn't a discovery record
+    """
+    try:
+        text = reply.decode("utf-8", errors="replace").strip("\x00\r\n ")
+    except AttributeError:
+        text = str(reply)
+
+    if not text or text == DISCOVERY_REQUEST.decode():
+        # our own broadcast looped back
+        return None
+
+    values = [value.strip() for value in text.split(",")]
+    fields = dict(zip(DISCOVERY_REPLY_FIELDS, values))
+
+    if sender_ip is not None:
+        fields["ip"] = sender_ip
+
+    return DQDiscoveredDevice(reply=text, last_seen_s=time.monotonic(), **fields)
+
+
+class DQDeviceDiscovery:
+
+    def __init__(self, dq_ports, broadcast_address="255.255.255.255", cache_lifetime_s=60.0, dataq_comms=None):
+        """
+        :param dq_ports: DQPorts, the request goes to logger_discovery_local_port and the replies come back on
+        logger_discovery_remote_port
+        :param broadcast_address: e.g. the subnet broadcast address
+        :param cache_lifetime_s: discover returns the cached result while it is younger than this
+        :param dataq_comms: DataqCommsManager with its sockets initialized on the same dq_ports. It already holds
+        logger_discovery_remote_port, so the replies are taken from its response socket.
+        """
+        self.log = logging.getLogger("DQDeviceDiscovery")
+
+        self.dq_ports = dq_ports
+        self.broadcast_address = broadcast_address
+        self.cache_lifetime_s = cache_lifetime_s
+        self.dataq_comms = dataq_comms
+
+        # DQDiscoveredDevice by serial number, or by IP for loggers that didn't report one
+        self.discovered_devices = {}
+        self.last_discovery_s = None
+
+        self.lock = threading.Lock()
+
+    def discover(self, timeout_s=0.5, expected_count=None, refresh=False):
+        """
+        Broadcast once and collect every reply that arrives within timeout_s.
+        :param expected_count: stop listening as soon as this many loggers have answered
+        :param refresh: ignore the cache
+        :return: list of DQDiscoveredDevice sorted by IP
+        """
+        name = "discover"
+
+        with self.lock:
+            if not refresh and self.last_discovery_s is not None and \
+                    time.monotonic() - self.last_discovery_s < self.cache_lifetime_s:
+                return self.get_cached_devices()
+
+        if self.dataq_comms is None:
+            found = self.discover_on_own_socket(timeout_s, expected_count)
+        else:
+            found = self.discover_through_manager(timeout_s, expected_count)
+
+        # the request never went out, what is cached is still the best there is
+        if found is None:
+            return self.get_cached_devices()
+
+        self.log.info(name + ": " + str(len(found)) + " loggers answered")
+
+        with self.lock:
+            self.discovered_devices = found
+            self.last_discovery_s = time.monotonic()
+
+            return self.get_cached_devices()
+
+    def discover_on_own_socket(self, timeout_s, expected_count):
+        """
+        :return: DQDiscoveredDevice by serial number (or IP), None if the port could not be bound or the request
+        not sent
+        """
+        name = "discover_on_own_socket"
+
+        discovery_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        found = {}
+
+        try:
+            discovery_socket.bind(("0.0.0.0", self.dq_ports.logger_discovery_remote_port))
+            discovery_socket.sendto(DISCOVERY_REQUEST,
+                                    (self.broadcast_address, self.dq_ports.logger_discovery_local_port))
+        except socket.error:
+            self.log.exception(name + ": ")
+            discovery_socket.close()
+            return None
+
+        try:
+            deadline_s = time.monotonic() + timeout_s
+
+            while expected_count is None or len(found) < expected_count:
+                remaining_s = deadline_s - time.monotonic()
+
+                if remaining_s <= 0:
+                    break
+
+                discovery_socket.settimeout(remaining_s)
+
+                try:
+                    reply, sender = discovery_socket.recvfrom(1024)
+                except socket.timeout:
+                    break
+
+                self.add_reply(found, reply, sender[0])
+        except socket.error:
+            self.log.exception(name + ": ")
+        finally:
+            discovery_socket.close()
+
+        return found
+
+    def discover_through_manager(self, timeout_s, expected_count):
+        """
+        Broadcast from a socket of our own and collect the replies the manager's process_response hands over.
+        The manager's socket is only read here while its receive thread isn't running.
+        """
+        name = "discover_through_manager"
+
+        replies = queue.Queue()
+
+        broadcast_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        self.dataq_comms.add_foreign_datagram_handler(replies.put)
+
+        try:
+            try:
+                broadcast_socket.sendto(DISCOVERY_REQUEST,
+                                        (self.broadcast_address, self.dq_ports.logger_discovery_local_port))
+            except socket.error:
+                self.log.exception(name + ": ")
+                return None
+            finally:
+                broadcast_socket.close()
+
+            found = {}
+            deadline_s = time.monotonic() + timeout_s
+
+            while expected_count is None or len(found) < expected_count:
+                remaining_s = deadline_s - time.monotonic()
+
+                if remaining_s <= 0:
+                    break
+
+                if self.dataq_comms.is_receive_thread_reading():
+                    wait_s = remaining_s
+                else:
+                    # an idle manager has nobody reading its socket, any data that arrives is processed as usual
+                    if self.dataq_comms.receive_datagram(remaining_s) is None:
+                        break
+
+                    wait_s = 0
+
+                try:
+                    reply = replies.get(timeout=wait_s)
+                except queue.Empty:
+                    continue
+
+                # the manager's socket doesn't tell who sent it, the record's own ip field has to do
+                self.add_reply(found, reply, None)
+        finally:
+            self.dataq_comms.remove_foreign_datagram_handler(replies.put)
+
+        return found
+
+    def add_reply(self, found, reply, sender_ip):
+        discovered_device = parse_discovery_reply(reply, sender_ip)
+
+        if discovered_device is not None:
+            found[discovered_device.serial_no or discovered_device.ip] = discovered_device
+
+    def get_cached_devices(self):
+        return sorted(self.discovered_devices.values(), key=lambda discovered_device: discovered_device.ip)
+
+    def get_cached_device(self, ip):
+        for discovered_device in list(self.discovered_devices.values()):
+            if discovered_device.ip == ip:
+                return discovered_device
+
+        return None
+
+
+class DQDiscoveryResponder:
+
+    def __init__(self, dq_ports, discovered_device: DQDiscoveredDevice, bind_ip="0.0.0.0"):
+        """
+        Answers discovery requests the way a logger would, for trying discovery without hardware. Several
+        responders can share the port to stand in for a rack, each answers every broadcast. They all reply from
+        the host's address, so tell them apart by serial number.
+        """
+        self.log = logging.getLogger("DQDiscoveryResponder")
+
+        self.dq_ports = dq_ports
+        self.discovered_device = discovered_device
+
+        self.responder_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.responder_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.responder_socket.bind((bind_ip, dq_ports.logger_discovery_local_port))
+        self.responder_socket.settimeout(0.1)
+
+        self.responder_thread_enable = True
+        self.responder_thread = threading.Thread(target=self.responder_runnable, daemon=True)
+        self.responder_thread.start()
+
+    def get_reply(self):
+        return ",".join(str(getattr(self.discovered_device, reply_field)) for reply_field in DISCOVERY_REPLY_FIELDS)
+
+    def responder_runnable(self):
+        while self.responder_thread_enable:
+            try:
+                request, sender = self.responder_socket.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            if request.strip() == DISCOVERY_REQUEST:
+                self.responder_socket.sendto(self.get_reply().encode(),
+                                             (sender[0], self.dq_ports.logger_discovery_remote_port))
+
+    def stop(self):
+        self.responder_thread_enable = False
+        self.responder_thread.join()
+        self.responder_socket.close()
@@ -0,0 +1,289 @@
+import ast
+import json
+import logging
+import queue
+import threading
+import numpy as np
+
+from dataqLazy import lazy_import
+
+# loaded on first use, pyarrow alone takes longer to import than the rest of the package
+h5py = lazy_import("h5py")
+pyarrow = lazy_import("pyarrow")
+pyarrow_parquet = lazy_import("pyarrow.parquet")
+
+"""
+Columnar export of captures. Blocks are handed over to a background thread which collects them into chunks and
+writes each chunk in one go, one column per channel. The receive path only ever copies a block into a queue.
+
+NPY needs nothing beyond NumPy. HDF5 needs h5py and Parquet needs pyarrow, both are optional.
+"""
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+# fixed so the header can be rewritten in place once the final length is known
+NPY_HEADER_BYTES = 128
+
+
+def make_capture_metadata(device_configuration, sample_configuration, channel_scales, channel_kinds,
+                          scan_rate_hz, device_order=0):
+    """
+    :param device_configuration: DQDeviceConfiguration the capture was taken with
+    :param sample_configuration: DQSampleConfiguration the capture was taken with
+    :return: plain dict that can go into JSON, HDF5 attributes or Parquet schema metadata
+    """
+    return {
+        "device_order": int(device_order),
+        "device_group_order": int(device_configuration.device_group_order),
+        "encode": int(device_configuration.encode),
+        "packet_size": int(device_configuration.ps),
+        "scan_list": [int(scan_list_entry) for scan_list_entry in device_configuration.s_list],
+        "channel_scales": [float(scale) for scale in channel_scales],
+        "channel_kinds": [int(kind) for kind in channel_kinds],
+        "s_rate": int(sample_configuration.s_rate),
+        "dec": int(sample_configuration.dec),
+        "deca": int(sample_configuration.deca),
+        "scan_rate_hz": float(scan_rate_hz)
+    }
+
+
+def get_channel_column_names(number_of_channels):
+    return ["channel" + str(channel_index) for channel_index in range(number_of_channels)]
+
+
+class DQNpyColumnWriter:
+
+    def __init__(self, file_prefix, number_of_channels, metadata, dtype=np.float32):
+        """
+        One .npy file per channel plus <file_prefix>_metadata.json. The files can be opened with
+        np.load(..., mmap_mode="r") while being written, they just look shorter than they are.
+        """
+        self.file_prefix = file_prefix
+        self.number_of_channels = number_of_channels
+        self.dtype = np.dtype(dtype)
+        self.rows_written = 0
+
+        self.column_names = get_channel_column_names(number_of_channels)
+        self.column_files = []
+
+        for column_name in self.column_names:
+            column_file = open(file_prefix + "_" + column_name + ".npy", "wb")
+            self.__write_header(column_file, 0)
+            self.column_files.append(column_file)
+
+        with open(file_prefix + "_metadata.json", "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+
+    def __write_header(self, column_file, number_of_rows):
+        header = repr({"descr": self.dtype.str, "fortran_order": False, "shape": (number_of_rows,)})
+        header = header.encode("latin1")
+        header_length = NPY_HEADER_BYTES - len(NPY_MAGIC) - 2
+
+        column_file.seek(0)
+        column_file.write(NPY_MAGIC)
+        column_file.write(np.uint16(header_length).tobytes())
+        column_file.write(header.ljust(header_length - 1) + b"\n")
+
+    def write_chunk(self, channel_data: np.ndarray):
+        """
+        :param channel_data: (channels x scans)
+        """
+        for column_file, column in zip(self.column_files, channel_data.astype(self.dtype, copy=False)):
+            column_file.write(np.ascontiguousarray(column).tobytes())
+
+        self.rows_written += channel_data.shape[1]
+
+    def close(self):
+        for column_file in self.column_files:
+            self.__write_header(column_file, self.rows_written)
+            column_file.close()
+
+
+def read_npy_header(file_name):
+    # shape and dtype of a file written by DQNpyColumnWriter, mostly useful while it is still open
+    with open(file_name, "rb") as column_file:
+        column_file.seek(len(NPY_MAGIC) + 2)
+        return ast.literal_eval(column_file.read(NPY_HEADER_BYTES - len(NPY_MAGIC) - 2).decode("latin1"))
+
+
+class DQHdf5ColumnWriter:
+
+    def __init__(self, file_name, number_of_channels, metadata, dtype=np.float32, compression=None,
+                 chunk_scans=65536):
+        """
+        One resizable, chunked dataset per channel, metadata as attributes of the root group.
+        :param compression: passed through to h5py, e.g. "gzip" or "lzf"
+        """
+        if not h5py.is_module_available():
+            raise ImportError("h5py is needed to export to HDF5")
+
+        self.rows_written = 0
+        self.column_names = get_channel_column_names(number_of_channels)
+
+        self.h5_file = h5py.File(file_name, "w")
+
+        for key, value in metadata.items():
+            self.h5_file.attrs[key] = value
+
+        self.datasets = [self.h5_file.create_dataset(column_name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                     chunks=(chunk_scans,), compression=compression)
+                         for column_name in self.column_names]
+
+    def write_chunk(self, channel_data: np.ndarray):
+        number_of_scans = channel_data.shape[1]
+        end = self.rows_written + number_of_scans
+
+        for dataset, column in zip(self.datasets, channel_data):
+            dataset.resize((end,))
+            dataset[self.rows_written:end] = column
+
+        self.rows_written = end
+
+    def close(self):
+        self.h5_file.close()
+
+
+class DQParquetColumnWriter:
+
+    def __init__(self, file_name, number_of_channels, metadata, dtype=np.float32, compression=None):
+        """
+        Each chunk becomes a row group. Metadata is stored as JSON under the b"dataq" schema metadata key.
+        :param compression: passed through to pyarrow, e.g. "snappy" or "zstd"
+        """
+        if not pyarrow.is_module_available():
+            raise ImportError("pyarrow is needed to export to Parquet")
+
+        self.rows_written = 0
+        self.dtype = np.dtype(dtype)
+        self.column_names = get_channel_column_names(number_of_channels)
+
+        arrow_type = pyarrow.from_numpy_dtype(self.dtype)
+        schema = pyarrow.schema([(column_name, arrow_type) for column_name in self.column_names],
+                                metadata={b"dataq": json.dumps(metadata).encode()})
+
+        self.parquet_writer = pyarrow_parquet.ParquetWriter(file_name, schema,
+                                                            compression=compression or "none")
+
+    def write_chunk(self, channel_data: np.ndarray):
+        columns = [pyarrow.array(column) for column in channel_data.astype(self.dtype, copy=False)]
+        self.parquet_writer.write_table(pyarrow.Table.from_arrays(columns, names=self.column_names))
+
+        self.rows_written += channel_data.shape[1]
+
+    def close(self):
+        self.parquet_writer.close()
+
+
+def create_column_writer(file_format, file_prefix, number_of_channels, metadata, dtype=np.float32,
+                         compression=None):
+    """
+    :param file_format: "npy", "hdf5" or "parquet"
+    :param file_prefix: path without extension
+    """
+    if file_format == "npy":
+        return DQNpyColumnWriter(file_prefix, number_of_channels, metadata, dtype)
+    elif file_format == "hdf5":
+        return DQHdf5ColumnWriter(file_prefix + ".h5", number_of_channels, metadata, dtype, compression)
+    elif file_format == "parquet":
+        return DQParquetColumnWriter(file_prefix + ".parquet", number_of_channels, metadata, dtype, compression)
+
+    raise ValueError("unknown export format " + repr(file_format))
+
+
+class DQCaptureExporter:
+
+    def __init__(self, column_writer, chunk_scans=65536, max_queued_blocks=1024):
+        """
+        :param column_writer: one of the DQ*ColumnWriter classes, see create_column_writer
+        :param chunk_scans: scans collected before a chunk is written
+        :param max_queued_blocks: blocks are dropped, and counted, rather than stall the caller once this many are
+        waiting on the disk
+        """
+        self.log = logging.getLogger("DQCaptureExporter")
+
+        self.column_writer = column_writer
+        self.chunk_scans = chunk_scans
+
+        self.block_queue = queue.Queue(maxsize=max_queued_blocks)
+        self.dropped_blocks = 0
+        self.dropped_scans = 0
+        # set once a chunk could not be written, nothing is queued after that
+        self.write_failed = False
+
+        self.writer_thread = threading.Thread(target=self.writer_runnable, daemon=True)
+        self.writer_thread.start()
+
+    def add_block(self, channel_data: np.ndarray):
+        """
+        :param channel_data: (channels x scans), copied so the caller can reuse its buffer
+        """
+        if channel_data.shape[1] == 0 or self.write_failed:
+            return
+
+        try:
+            self.block_queue.put_nowait(np.array(channel_data))
+        except queue.Full:
+            self.dropped_blocks += 1
+            self.dropped_scans += channel_data.shape[1]
+
+    def writer_runnable(self):
+        name = "writer_runnable"
+
+        pending_blocks = []
+        pending_scans = 0
+        running = True
+
+        while running:
+            block = self.block_queue.get()
+
+            if block is None:
+                running = False
+            else:
+                pending_blocks.append(block)
+                pending_scans += block.shape[1]
+
+            if pending_blocks and (pending_scans >= self.chunk_scans or not running):
+                try:
+                    self.column_writer.write_chunk(np.concatenate(pending_blocks, axis=1))
+                except Exception as e:
+                    # whatever went wrong, e.g. a full disk or a bad dataset, the rest of the capture won't fit
+                    self.log.exception(name + ": ")
+                    self.write_failed = True
+                    running = False
+
+                pending_blocks = []
+                pending_scans = 0
+
+        try:
+            self.column_writer.close()
+        except Exception as e:
+            self.log.exception(name + ": ")
+
+        if self.dropped_blocks:
+            self.log.warning(name + ": dropped " + str(self.dropped_blocks) + " blocks (" +
+                             str(self.dropped_scans) + " scans)")
+
+        self.log.info(name + ": exiting...")
+
+    def close(self):
+        """
+        Write whatever is still queued and close the file.
+        """
+        # a writer that gave up after a failed write no longer takes blocks off a full queue
+        while self.writer_thread.is_alive():
+            try:
+                self.block_queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+        self.writer_thread.join()
+
+    def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
+        self.add_block(voltage_channel_data)
+
+    def decoded_block_handler(self, decoded_block):
+        self.add_block(decoded_block.voltages())
+
+    def decoded_block_counts_handler(self, decoded_block):
+        # raw counts instead of voltages, for dataqCapture.DQCaptureFileWriter
+        self.add_block(decoded_block.counts)
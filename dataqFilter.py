@@ -0,0 +1,283 @@
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from dataqLazy import lazy_import
+
+# loaded on first use, scipy takes longer to import than everything else here together
+scipy_signal = lazy_import("scipy.signal")
+
+"""
+Block based filtering and decimation of decoded channel data. Filters keep their state between blocks so packet
+boundaries don't show up in the output. FIR filters are evaluated only at the samples that survive decimation.
+
+scipy is optional, it is only needed to design IIR filters and makes IIR filtering considerably faster.
+"""
+
+# samples per block of the NumPy IIR fallback, each section costs this many multiplies per sample
+IIR_BLOCK_SAMPLES = 64
+
+
+def design_lowpass_fir(number_of_taps, cutoff_hz, sample_rate_hz):
+    """
+    Windowed sinc (Hamming) low pass with unity DC gain.
+    """
+    center = (number_of_taps - 1) / 2
+    normalized_cutoff = cutoff_hz / sample_rate_hz
+    taps = 2 * normalized_cutoff * np.sinc(2 * normalized_cutoff * (np.arange(number_of_taps) - center))
+    taps *= np.hamming(number_of_taps)
+    return taps / taps.sum()
+
+
+def design_decimation_fir(decimation, taps_per_phase=16):
+    """
+    Anti-aliasing low pass for decimation, cut off a little under the new Nyquist rate.
+    """
+    return design_lowpass_fir(decimation * taps_per_phase + 1, 0.4 / decimation, 1.0)
+
+
+def design_butterworth_sos(order, cutoff_hz, sample_rate_hz, btype="lowpass"):
+    if not scipy_signal.is_module_available():
+        raise ImportError("scipy is needed to design IIR filters, pass second order sections directly instead")
+
+    return scipy_signal.butter(order, cutoff_hz, btype=btype, fs=sample_rate_hz, output="sos")
+
+
+class DQFirDecimator:
+
+    def __init__(self, number_of_channels, taps, decimation=1):
+        """
+        :param number_of_channels: rows in each block
+        :param taps: 1-D taps shared by all channels, or (channels x taps) with one filter per channel
+        :param decimation: keep every decimation-th filtered sample
+        """
+        self.number_of_channels = number_of_channels
+        self.decimation = decimation
+
+        taps = np.asarray(taps, dtype=float)
+
+        if taps.ndim == 1:
+            taps = np.tile(taps, (number_of_channels, 1))
+
+        # reversed so the filter is a plain dot product with each window
+        self.reversed_taps = np.ascontiguousarray(taps[:, ::-1])
+        self.number_of_taps = taps.shape[1]
+
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros((self.number_of_channels, self.number_of_taps - 1))
+        # input sample of the next block that produces an output
+        self.phase = 0
+
+    def process(self, channel_data: np.ndarray):
+        """
+        :param channel_data: (channels x samples)
+        :return: (channels x outputs) filtered and decimated samples
+        """
+        number_of_samples = channel_data.shape[1]
+
+        extended = np.concatenate((self.history, channel_data), axis=1)
+        # window k ends on input sample k of this block
+        windows = sliding_window_view(extended, self.number_of_taps, axis=1)[:, self.phase::self.decimation]
+
+        output = np.einsum('cwt,ct->cw', windows, self.reversed_taps)
+
+        self.phase = (self.phase - number_of_samples) % self.decimation
+        self.history = extended[:, extended.shape[1] - (self.number_of_taps - 1):].copy()
+
+        return output
+
+
+class DQIirDecimator:
+
+    def __init__(self, number_of_channels, sos, decimation=1):
+        """
+        :param number_of_channels: rows in each block
+        :param sos: (sections x 6) second order sections shared by all channels, or (channels x sections x 6)
+        :param decimation: keep every decimation-th filtered sample. There is no extra anti-aliasing, the sections
+        have to take care of it
+        """
+        self.number_of_channels = number_of_channels
+        self.decimation = decimation
+
+        sos = np.asarray(sos, dtype=float)
+        self.shared_sos = sos.ndim == 2
+
+        if self.shared_sos:
+            sos = np.tile(sos, (number_of_channels, 1, 1))
+
+        # normalize so a0 is 1
+        self.sos = sos / sos[:, :, 3:4]
+        self.number_of_sections = self.sos.shape[1]
+
+        self.reset()
+
+    def reset(self):
+        # direct form II transposed state, two delays per section
+        self.state = np.zeros((self.number_of_channels, self.number_of_sections, 2))
+        self.phase = 0
+
+        # see __build_block_matrices, only built without scipy
+        self.block_matrices = None
+
+    def __filter_scipy(self, channel_data):
+        if self.shared_sos:
+            # sosfilt wants the state as (sections x channels x 2)
+            zi = self.state.transpose(1, 0, 2)
+            output, zf = scipy_signal.sosfilt(self.sos[0], channel_data, axis=1, zi=zi)
+            self.state = zf.transpose(1, 0, 2)
+            return output
+
+        output = np.empty_like(channel_data)
+
+        for channel_index in range(self.number_of_channels):
+            output[channel_index], self.state[channel_index] = scipy_signal.sosfilt(
+                self.sos[channel_index], channel_data[channel_index], zi=self.state[channel_index])
+
+        return output
+
+    def __build_block_matrices(self):
+        """
+        Each section as a state space system, z' = A z + B x and y = z[0] + b0 x, unrolled over a block of
+        IIR_BLOCK_SAMPLES so a block's output and final state are matrix products of its input and initial state.
+        :return: (impulse response as a lower triangular Toeplitz matrix, A^k for k up to the block length,
+        A^k B for k below it), all per channel and section
+        """
+        block_samples = IIR_BLOCK_SAMPLES
+        b0, b1, b2 = self.sos[:, :, 0], self.sos[:, :, 1], self.sos[:, :, 2]
+        a1, a2 = self.sos[:, :, 4], self.sos[:, :, 5]
+
+        state_matrix = np.zeros(self.sos.shape[:2] + (2, 2))
+        state_matrix[:, :, 0, 0] = -a1
+        state_matrix[:, :, 0, 1] = 1.0
+        state_matrix[:, :, 1, 0] = -a2
+        input_vector = np.stack((b1 - a1 * b0, b2 - a2 * b0), axis=-1)
+
+        powers = np.empty(self.sos.shape[:2] + (block_samples + 1, 2, 2))
+        powers[:, :, 0] = np.eye(2)
+
+        for exponent in range(1, block_samples + 1):
+            powers[:, :, exponent] = powers[:, :, exponent - 1] @ state_matrix
+
+        # A^k B, the state k samples after a unit input
+        input_responses = np.einsum('cskij,csj->cski', powers[:, :, :block_samples], input_vector)
+
+        impulse_response = np.empty(self.sos.shape[:2] + (block_samples,))
+        impulse_response[:, :, 0] = b0
+        impulse_response[:, :, 1:] = input_responses[:, :, :-1, 0]
+
+        lags = np.arange(block_samples)[:, None] - np.arange(block_samples)[None, :]
+        toeplitz = np.where(lags >= 0, impulse_response[:, :, np.maximum(lags, 0)], 0.0)
+
+        return toeplitz, powers, input_responses
+
+    def __filter_blocks(self, blocks):
+        """
+        :param blocks: (channels x blocks x block length) consecutive blocks of input
+        :return: filtered blocks, the state is carried from one block to the next in a short loop
+        """
+        toeplitz, powers, input_responses = self.block_matrices
+        block_samples = blocks.shape[2]
+
+        for section_index in range(self.number_of_sections):
+            # output of every block as if it started from a zero state
+            zero_state_output = blocks @ toeplitz[:, section_index, :block_samples, :block_samples].transpose(0, 2, 1)
+            # state each block leaves behind from its own input, input sample j lands block_samples - 1 - j steps on
+            forced_state = blocks @ input_responses[:, section_index, block_samples - 1::-1]
+            block_transition = powers[:, section_index, block_samples]
+
+            initial_states = np.empty(blocks.shape[:2] + (2,))
+            state = self.state[:, section_index]
+
+            for block_index in range(blocks.shape[1]):
+                initial_states[:, block_index] = state
+                state = (block_transition @ state[:, :, None])[:, :, 0] + forced_state[:, block_index]
+
+            self.state[:, section_index] = state
+
+            # y[k] picks up the first row of A^k z from the initial state
+            blocks = zero_state_output + initial_states @ powers[:, section_index, :block_samples, 0].transpose(0, 2, 1)
+
+        return blocks
+
+    def __filter_numpy(self, channel_data):
+        # the recursion runs block by block instead of sample by sample, vectorized across channels
+        if self.block_matrices is None:
+            self.block_matrices = self.__build_block_matrices()
+
+        number_of_samples = channel_data.shape[1]
+        full_samples = number_of_samples - number_of_samples % IIR_BLOCK_SAMPLES
+
+        output = np.empty_like(channel_data)
+
+        if full_samples:
+            output[:, :full_samples] = self.__filter_blocks(
+                channel_data[:, :full_samples].reshape(self.number_of_channels, -1, IIR_BLOCK_SAMPLES)
+            ).reshape(self.number_of_channels, full_samples)
+
+        if full_samples < number_of_samples:
+            output[:, full_samples:] = self.__filter_blocks(channel_data[:, None, full_samples:])[:, 0]
+
+        return output
+
+    def process(self, channel_data: np.ndarray):
+        """
+        :param channel_data: (channels x samples)
+        :return: (channels x outputs) filtered and decimated samples
+        """
+        channel_data = np.asarray(channel_data, dtype=float)
+
+        if scipy_signal.is_module_available():
+            filtered = self.__filter_scipy(channel_data)
+        else:
+            filtered = self.__filter_numpy(channel_data)
+
+        output = filtered[:, self.phase::self.decimation]
+        self.phase = (self.phase - channel_data.shape[1]) % self.decimation
+
+        return output
+
+
+class DQFilterStage:
+
+    def __init__(self):
+        """
+        Runs groups of channels through their own filter/decimator and hands each group's output to its handlers.
+        Groups can overlap, e.g. the same channel decimated by 10 for a recorder and by 100 for a display.
+        """
+        self.log = logging.getLogger("DQFilterStage")
+
+        self.channel_groups = []
+
+    def add_channel_group(self, channel_indices, decimator, output_handlers):
+        """
+        :param channel_indices: rows of the incoming blocks that feed the decimator, in order
+        :param decimator: DQFirDecimator or DQIirDecimator sized for len(channel_indices) channels
+        :param output_handlers: callables taking the (channels x outputs) result, same as the voltage sinks
+        """
+        name = "add_channel_group"
+        self.log.info(name + ": channels " + repr(list(channel_indices)) + " decimation " +
+                      str(decimator.decimation))
+
+        if callable(output_handlers):
+            output_handlers = [output_handlers]
+
+        self.channel_groups.append((np.asarray(channel_indices), decimator, list(output_handlers)))
+
+    def reset(self):
+        for channel_indices, decimator, output_handlers in self.channel_groups:
+            decimator.reset()
+
+    def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
+        for channel_indices, decimator, output_handlers in self.channel_groups:
+            output = decimator.process(voltage_channel_data[channel_indices])
+
+            if output.shape[1] == 0:
+                continue
+
+            for output_handler in output_handlers:
+                output_handler(output)
+
+    def decoded_block_handler(self, decoded_block):
+        self.voltage_data_sink_handler(decoded_block.voltages())
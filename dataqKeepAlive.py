@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+
+"""
+One keep alive timer for every logger in the process. A logger stops streaming when it hasn't heard from the host
+for its keepalive timeout, any command counts, so keep alives are only sent to loggers that haven't been sent
+anything else lately.
+
+Each manager keeps a DQKeepAliveRegistration for its loggers and adds it to the process wide scheduler from
+get_keep_alive_scheduler while connected, so any number of managers share one thread.
+"""
+
+# share of the logger's timeout that may pass before a keep alive goes out, leaves room for a lost datagram
+KEEP_ALIVE_TIMEOUT_FRACTION = 0.4
+
+
+class DQKeepAliveRegistration:
+
+    def __init__(self, send_keep_alive, device_count, keep_alive_timeout_ms,
+                 timeout_fraction=KEEP_ALIVE_TIMEOUT_FRACTION):
+        """
+        :param send_keep_alive: callable taking a device order, sends that logger a keep alive
+        :param device_count: loggers to keep alive
+        :param keep_alive_timeout_ms: the "keepalive" value configured on the loggers
+        :param timeout_fraction: share of the timeout between keep alives
+        """
+        self.send_keep_alive = send_keep_alive
+        self.device_count = device_count
+        self.timeout_fraction = timeout_fraction
+        self.set_keep_alive_timeout_ms(keep_alive_timeout_ms)
+
+        # monotonic time anything was last sent to each logger
+        self.last_sent_s = [0.0] * device_count
+        self.keep_alives_sent = 0
+
+        self.lock = threading.Lock()
+
+    def set_keep_alive_timeout_ms(self, keep_alive_timeout_ms):
+        self.interval_s = keep_alive_timeout_ms / 1000.0 * self.timeout_fraction
+
+    def note_command_sent(self, device_order):
+        with self.lock:
+            self.last_sent_s[device_order] = time.monotonic()
+
+    def reset(self):
+        # whatever was sent before doesn't count, the first round goes out right away
+        with self.lock:
+            self.last_sent_s = [0.0] * self.device_count
+
+    def get_due_devices(self, now_s):
+        with self.lock:
+            return [device_order for device_order in range(self.device_count)
+                    if now_s - self.last_sent_s[device_order] >= self.interval_s]
+
+    def get_next_due_s(self):
+        with self.lock:
+            return min(self.last_sent_s) + self.interval_s
+
+
+class DQKeepAliveScheduler:
+
+    def __init__(self):
+        self.log = logging.getLogger("DQKeepAliveScheduler")
+
+        self.registrations = []
+
+        # held while keep alives go out, so remove can't return with one of its sends in flight
+        self.condition = threading.Condition()
+        self.scheduler_thread = None
+
+    def add(self, registration: DQKeepAliveRegistration):
+        """
+        Start keeping the loggers of registration alive. The scheduler thread runs while anything is registered.
+        """
+        name = "add"
+        self.log.info(name + ": " + str(registration.device_count) + " loggers every " +
+                      str(registration.interval_s) + " s")
+
+        registration.reset()
+
+        with self.condition:
+            if registration not in self.registrations:
+                self.registrations.append(registration)
+
+            if self.scheduler_thread is None:
+                self.scheduler_thread = threading.Thread(target=self.scheduler_runnable, daemon=True)
+                self.scheduler_thread.start()
+
+            self.condition.notify()
+
+    def remove(self, registration: DQKeepAliveRegistration):
+        """
+        Returns as soon as the scheduler is done with registration, no keep alive for it is sent afterwards.
+        """
+        with self.condition:
+            if registration in self.registrations:
+                self.registrations.remove(registration)
+
+            self.condition.notify()
+
+    def scheduler_runnable(self):
+        name = "scheduler_runnable"
+
+        with self.condition:
+            while self.registrations:
+                now_s = time.monotonic()
+
+                for registration in self.registrations:
+                    for device_order in registration.get_due_devices(now_s):
+                        try:
+                            registration.send_keep_alive(device_order)
+                            registration.keep_alives_sent += 1
+                        except OSError:
+                            self.log.exception(name + ": device " + str(device_order))
+
+                        registration.note_command_sent(device_order)
+
+                next_due_s = min(registration.get_next_due_s() for registration in self.registrations)
+
+                self.condition.wait(max(0.0, next_due_s - time.monotonic()))
+
+            # a later add starts a new thread
+            self.scheduler_thread = None
+
+        self.log.info(name + ": exiting...")
+
+
+keep_alive_scheduler = None
+keep_alive_scheduler_lock = threading.Lock()
+
+
+def get_keep_alive_scheduler() -> DQKeepAliveScheduler:
+    """
+    :return: the scheduler shared by every manager of the process
+    """
+    global keep_alive_scheduler
+
+    with keep_alive_scheduler_lock:
+        if keep_alive_scheduler is None:
+            keep_alive_scheduler = DQKeepAliveScheduler()
+
+        return keep_alive_scheduler
@@ -0,0 +1,41 @@
+import importlib
+import importlib.util
+
+"""
+Deferred imports for optional and heavy dependencies (matplotlib, scipy, h5py, pyarrow). The module is imported
+the first time one of its attributes is used, so a recorder that never plots or filters never pays for loading
+them. is_module_available answers without importing anything.
+"""
+
+
+class DQLazyModule:
+
+    def __init__(self, module_name):
+        """
+        :param module_name: dotted name as given to import, e.g. "matplotlib.pyplot"
+        """
+        self.module_name = module_name
+        self.module = None
+
+    def load_module(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.module_name)
+
+        return self.module
+
+    def is_module_available(self):
+        if self.module is not None:
+            return True
+
+        # find_spec on a dotted name imports the parents, checking the top level package doesn't
+        try:
+            return importlib.util.find_spec(self.module_name.split(".")[0]) is not None
+        except (ImportError, ValueError):
+            return False
+
+    def __getattr__(self, attribute):
+        return getattr(self.load_module(), attribute)
+
+
+def lazy_import(module_name) -> DQLazyModule:
+    return DQLazyModule(module_name)
@@ -0,0 +1,295 @@
+from bisect import bisect_left
+import json
+import logging
+import math
+import threading
+
+"""
+Counters, gauges and histograms for the acquisition pipeline. Updating one is an attribute add or a bisect into
+fixed buckets with no lock, each metric is meant to be updated from a single thread (normally the receive thread),
+so they can stay on at full packet rate. A scrape reads the values as they are, a histogram read mid update can be
+off by the one observation in flight.
+
+Exported as Prometheus text or JSON, either directly or from a small HTTP server, see DQMetricsRegistry.serve.
+"""
+
+METRIC_TYPE_COUNTER = "counter"
+METRIC_TYPE_GAUGE = "gauge"
+METRIC_TYPE_HISTOGRAM = "histogram"
+
+# 1 us to ~4 s, doubling, in seconds
+DEFAULT_TIME_BUCKETS_S = tuple(1e-6 * 2 ** exponent for exponent in range(23))
+
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + ([extra] if extra is not None else [])
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for key, value in labels) + "}"
+
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class DQCounter:
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class DQGauge:
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        :param function: called on every scrape for the current value, for things that are cheaper to read than to
+        keep up to date, e.g. queue depths
+        """
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+
+        return self.value
+
+
+class DQHistogram:
+
+    def __init__(self, labels, buckets):
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # one more than buckets, the last one is +Inf
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        cumulative_counts = []
+        running_count = 0
+
+        for bucket_count in self.bucket_counts:
+            running_count += bucket_count
+            cumulative_counts.append(running_count)
+
+        return cumulative_counts
+
+    def get_quantile(self, quantile):
+        """
+        :return: upper bound of the bucket the quantile falls in, None before the first observation
+        """
+        if self.count == 0:
+            return None
+
+        target = quantile * self.count
+
+        for bucket_bound, cumulative_count in zip(self.buckets + (math.inf,), self.get_cumulative_counts()):
+            if cumulative_count >= target:
+                return bucket_bound
+
+        return math.inf
+
+
+class DQMetricFamily:
+
+    def __init__(self, name, metric_type, help_text, buckets=None):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.buckets = buckets
+        # metric by its sorted (label, value) tuple
+        self.metrics = {}
+
+
+class DQMetricsRegistry:
+
+    def __init__(self, prefix="dataq_"):
+        """
+        :param prefix: put in front of every metric name
+        """
+        self.log = logging.getLogger("DQMetricsRegistry")
+
+        self.prefix = prefix
+        self.families = {}
+        self.lock = threading.Lock()
+
+        self.http_server = None
+        self.http_server_thread = None
+
+    def __get_metric(self, name, metric_type, help_text, labels, buckets=None):
+        name = self.prefix + name
+        label_key = tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+        with self.lock:
+            family = self.families.get(name)
+
+            if family is None:
+                family = DQMetricFamily(name, metric_type, help_text, buckets)
+                self.families[name] = family
+            elif family.metric_type != metric_type:
+                raise ValueError(name + " is already a " + family.metric_type)
+
+            metric = family.metrics.get(label_key)
+
+            if metric is None:
+                if metric_type == METRIC_TYPE_COUNTER:
+                    metric = DQCounter(label_key)
+                elif metric_type == METRIC_TYPE_GAUGE:
+                    metric = DQGauge(label_key)
+                else:
+                    metric = DQHistogram(label_key, family.buckets)
+
+                family.metrics[label_key] = metric
+
+            return metric
+
+    def counter(self, name, help_text="", **labels) -> DQCounter:
+        """
+        Get or create a counter. Hold on to the returned object on hot paths, the lookup takes a lock.
+        """
+        return self.__get_metric(name, METRIC_TYPE_COUNTER, help_text, labels)
+
+    def gauge(self, name, help_text="", **labels) -> DQGauge:
+        return self.__get_metric(name, METRIC_TYPE_GAUGE, help_text, labels)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_TIME_BUCKETS_S, **labels) -> DQHistogram:
+        """
+        :param buckets: upper bounds, only used when the first metric of this name is created
+        """
+        return self.__get_metric(name, METRIC_TYPE_HISTOGRAM, help_text, labels, buckets)
+
+    def get_families(self):
+        with self.lock:
+            return [(family, list(family.metrics.values())) for family in self.families.values()]
+
+    def to_prometheus_text(self):
+        lines = []
+
+        for family, metrics in self.get_families():
+            lines.append("# HELP " + family.name + " " + family.help_text)
+            lines.append("# TYPE " + family.name + " " + family.metric_type)
+
+            for metric in metrics:
+                if family.metric_type != METRIC_TYPE_HISTOGRAM:
+                    lines.append(family.name + format_labels(metric.labels) + " " + format_value(metric.get()))
+                    continue
+
+                for bucket_bound, cumulative_count in zip(metric.buckets + (math.inf,),
+                                                          metric.get_cumulative_counts()):
+                    lines.append(family.name + "_bucket" +
+                                 format_labels(metric.labels, ("le", format_value(bucket_bound))) + " " +
+                                 str(cumulative_count))
+
+                lines.append(family.name + "_sum" + format_labels(metric.labels) + " " + format_value(metric.sum))
+                lines.append(family.name + "_count" + format_labels(metric.labels) + " " + str(metric.count))
+
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        metric_families = {}
+
+        for family, metrics in self.get_families():
+            samples = []
+
+            for metric in metrics:
+                sample = {"labels": dict(metric.labels)}
+
+                if family.metric_type == METRIC_TYPE_HISTOGRAM:
+                    sample["buckets"] = [[bucket_bound, cumulative_count] for bucket_bound, cumulative_count in
+                                         zip(list(metric.buckets) + ["+Inf"], metric.get_cumulative_counts())]
+                    sample["sum"] = metric.sum
+                    sample["count"] = metric.count
+                else:
+                    sample["value"] = metric.get()
+
+                samples.append(sample)
+
+            metric_families[family.name] = {"type": family.metric_type, "help": family.help_text,
+                                            "samples": samples}
+
+        return metric_families
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Answer GET /metrics with Prometheus text and GET /metrics.json with JSON on a daemon thread.
+        :param port: 0 picks a free port, see get_server_address
+        """
+        name = "serve"
+
+        # only processes that serve metrics pay for importing the HTTP server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = registry.to_prometheus_text().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = registry.to_json().encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.daemon_threads = True
+
+        self.http_server_thread = threading.Thread(target=self.http_server.serve_forever, args=(0.1,), daemon=True)
+        self.http_server_thread.start()
+
+        self.log.info(name + ": metrics on http://" + host + ":" + str(self.get_server_address()[1]) + "/metrics")
+
+    def get_server_address(self):
+        return self.http_server.server_address if self.http_server is not None else None
+
+    def stop_serving(self):
+        if self.http_server is None:
+            return
+
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.http_server_thread.join()
+
+        self.http_server = None
+        self.http_server_thread = None
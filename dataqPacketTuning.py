@@ -0,0 +1,165 @@
+from dataclasses import dataclass, field
+import logging
+import time
+import numpy as np
+
+from dataqDecoder import DQDeviceDecoder
+
+"""
+Packet size selection. Host cost is modelled as a fixed cost per packet plus a cost per sample, fitted from
+calibration measurements. Bigger packets spread the fixed cost over more samples but take longer to fill, so the
+pick is the biggest packet that still fills within the latency target and didn't drop samples during calibration.
+"""
+
+
+def packet_size_to_bytes(packet_size):
+    # PS_16_BYTES_DEFAULT is 0, every step doubles
+    return 16 << int(packet_size)
+
+
+def packet_size_to_samples(packet_size):
+    return packet_size_to_bytes(packet_size) // 2
+
+
+@dataclass()
+class DQPacketSizeMeasurement:
+    packet_size: int
+    packets: int
+    samples: int
+    # host time spent receiving and processing those packets
+    processing_ns: int
+    missing_samples: int = 0
+
+    def get_ns_per_packet(self):
+        return self.processing_ns / max(1, self.packets)
+
+    def get_drop_fraction(self):
+        return self.missing_samples / max(1, self.samples + self.missing_samples)
+
+
+@dataclass()
+class DQPacketSizeReport:
+    packet_size: int
+    # fitted cost model, ns = per_packet_ns + per_sample_ns * samples
+    per_packet_ns: float
+    per_sample_ns: float
+    # per candidate packet size
+    cpu_ns_per_sample: dict = field(default_factory=dict)
+    fill_latency_s: dict = field(default_factory=dict)
+    drop_fraction: dict = field(default_factory=dict)
+
+
+class DQPacketSizeTuner:
+
+    def __init__(self, number_of_channels, sample_rate_hz, latency_target_s=0.05, max_drop_fraction=0.0):
+        """
+        :param number_of_channels: entries in the scan list
+        :param sample_rate_hz: per channel scan rate
+        :param latency_target_s: longest acceptable time for the logger to fill one packet
+        :param max_drop_fraction: packet sizes that lost more than this share of samples during calibration are
+        never picked
+        """
+        self.log = logging.getLogger("DQPacketSizeTuner")
+
+        self.number_of_channels = number_of_channels
+        self.sample_rate_hz = float(sample_rate_hz)
+        self.latency_target_s = latency_target_s
+        self.max_drop_fraction = max_drop_fraction
+
+        self.measurements = {}
+
+    def add_measurement(self, measurement: DQPacketSizeMeasurement):
+        self.measurements[int(measurement.packet_size)] = measurement
+
+    def measure_decode_cost(self, packet_sizes, packets_per_size=200):
+        """
+        Time the decoder on synthetic packets of each size, for when there is no device to calibrate against.
+        Only covers the decode, not the socket.
+        """
+        decoder = DQDeviceDecoder(0, np.full(self.number_of_channels, 10.0))
+
+        for packet_size in packet_sizes:
+            samples_per_packet = packet_size_to_samples(packet_size)
+
+            packets = []
+            for packet_index in range(packets_per_size):
+                header = np.array([0, 0, 0, packet_index * samples_per_packet, samples_per_packet], dtype='<u4')
+                payload = np.arange(samples_per_packet, dtype='<u2') << 2
+                packets.append(header.tobytes() + payload.tobytes())
+
+            decoder.reset()
+
+            start_ns = time.perf_counter_ns()
+            for packet in packets:
+                decoder.decode_packet(packet)
+            processing_ns = time.perf_counter_ns() - start_ns
+
+            self.add_measurement(DQPacketSizeMeasurement(
+                packet_size=int(packet_size),
+                packets=packets_per_size,
+                samples=packets_per_size * samples_per_packet,
+                processing_ns=processing_ns
+            ))
+
+    def fit_cost_model(self):
+        """
+        :return: (per packet ns, per sample ns) least squares fit over every measurement
+        """
+        samples_per_packet = np.array([packet_size_to_samples(packet_size) for packet_size in self.measurements],
+                                      dtype=float)
+        ns_per_packet = np.array([measurement.get_ns_per_packet() for measurement in self.measurements.values()])
+
+        if samples_per_packet.shape[0] < 2:
+            # a single point can't separate the two costs, treat it all as per sample
+            return 0.0, float(ns_per_packet.sum() / max(1.0, samples_per_packet.sum()))
+
+        per_sample_ns, per_packet_ns = np.polyfit(samples_per_packet, ns_per_packet, 1)
+
+        return max(0.0, float(per_packet_ns)), max(0.0, float(per_sample_ns))
+
+    def choose(self, packet_sizes) -> DQPacketSizeReport:
+        """
+        :param packet_sizes: DQEnums.PacketSize candidates
+        :return: DQPacketSizeReport, packet_size is the pick
+        """
+        name = "choose"
+
+        per_packet_ns, per_sample_ns = self.fit_cost_model()
+        samples_per_second = self.sample_rate_hz * self.number_of_channels
+
+        report = DQPacketSizeReport(packet_size=None, per_packet_ns=per_packet_ns, per_sample_ns=per_sample_ns)
+
+        best_cost = None
+
+        for packet_size in packet_sizes:
+            packet_size = int(packet_size)
+            samples_per_packet = packet_size_to_samples(packet_size)
+
+            cpu_ns_per_sample = per_packet_ns / samples_per_packet + per_sample_ns
+            fill_latency_s = samples_per_packet / samples_per_second
+
+            report.cpu_ns_per_sample[packet_size] = cpu_ns_per_sample
+            report.fill_latency_s[packet_size] = fill_latency_s
+
+            drop_fraction = 0.0
+            if packet_size in self.measurements:
+                drop_fraction = self.measurements[packet_size].get_drop_fraction()
+            report.drop_fraction[packet_size] = drop_fraction
+
+            if fill_latency_s > self.latency_target_s or drop_fraction > self.max_drop_fraction:
+                continue
+
+            if best_cost is None or cpu_ns_per_sample < best_cost:
+                best_cost = cpu_ns_per_sample
+                report.packet_size = packet_size
+
+        if report.packet_size is None:
+            # nothing meets the target, the smallest packet gets closest to it
+            report.packet_size = min(int(packet_size) for packet_size in packet_sizes)
+            self.log.warning(name + ": no packet size meets the latency target, using the smallest")
+
+        self.log.info(name + ": pin ps " + str(report.packet_size) + " (" +
+                      str(packet_size_to_bytes(report.packet_size)) + " bytes), " +
+                      "%.1f ns per packet + %.2f ns per sample" % (per_packet_ns, per_sample_ns))
+
+        return report
@@ -0,0 +1,206 @@
+from collections import deque
+from contextlib import contextmanager
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+Span profiling for the acquisition path. A span is a name with perf_counter_ns start and end times, kept in a
+buffer owned by the thread that recorded it so recording never takes a lock. Off by default, a disabled profiler
+costs one attribute check per span.
+
+Set DATAQ_PROFILE to an output path to profile a process without touching its code. The spans are written at exit,
+as a Chrome trace (chrome://tracing, Perfetto) if the path ends in .json, otherwise as folded stacks for
+flamegraph.pl or speedscope. Sharded decode workers write their own file next to it, see get_worker_output_path.
+"""
+
+PROFILE_ENVIRONMENT_VARIABLE = "DATAQ_PROFILE"
+
+
+class DQThreadSpanBuffer:
+
+    def __init__(self, capacity):
+        thread = threading.current_thread()
+
+        self.thread_name = thread.name
+        self.thread_id = thread.ident
+        # (name, start_ns, end_ns), the oldest spans are dropped once full
+        self.spans = deque(maxlen=capacity)
+
+
+class DQProfiler:
+
+    def __init__(self, enabled=False, output_path=None, capacity_per_thread=1000000, origin_ns=None):
+        """
+        :param output_path: where dump writes to when not given a path
+        :param capacity_per_thread: spans kept per thread
+        :param origin_ns: perf_counter_ns that trace times count from, pass another profiler's origin_ns so the
+        traces of several processes line up
+        """
+        self.log = logging.getLogger("DQProfiler")
+
+        self.enabled = enabled
+        self.output_path = output_path
+        self.capacity_per_thread = capacity_per_thread
+
+        self.origin_ns = time.perf_counter_ns() if origin_ns is None else origin_ns
+
+        self.thread_local = threading.local()
+        self.thread_buffers = []
+        # only taken the first time a thread records a span
+        self.lock = threading.Lock()
+
+    def enable(self, output_path=None):
+        if output_path is not None:
+            self.output_path = output_path
+
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            for thread_buffer in self.thread_buffers:
+                thread_buffer.spans.clear()
+
+    def __get_thread_buffer(self):
+        thread_buffer = getattr(self.thread_local, "thread_buffer", None)
+
+        if thread_buffer is None:
+            thread_buffer = DQThreadSpanBuffer(self.capacity_per_thread)
+            self.thread_local.thread_buffer = thread_buffer
+
+            with self.lock:
+                self.thread_buffers.append(thread_buffer)
+
+        return thread_buffer
+
+    def begin(self):
+        """
+        :return: start time to hand to end, 0 while disabled
+        """
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def end(self, name, start_ns):
+        if start_ns:
+            self.__get_thread_buffer().spans.append((name, start_ns, time.perf_counter_ns()))
+
+    def record(self, name, start_ns, end_ns):
+        """
+        For code that takes the perf_counter_ns times anyway.
+        """
+        if self.enabled:
+            self.__get_thread_buffer().spans.append((name, start_ns, end_ns))
+
+    @contextmanager
+    def span(self, name):
+        """
+        Same as begin and end, for code that isn't run per packet.
+        """
+        start_ns = self.begin()
+
+        try:
+            yield
+        finally:
+            self.end(name, start_ns)
+
+    def get_spans(self):
+        """
+        :return: list of (thread buffer, spans sorted by start)
+        """
+        with self.lock:
+            thread_buffers = list(self.thread_buffers)
+
+        # copying a deque runs in C without giving up the GIL, so a thread appending meanwhile is fine
+        return [(thread_buffer, sorted(list(thread_buffer.spans), key=lambda span: (span[1], -span[2])))
+                for thread_buffer in thread_buffers]
+
+    def to_chrome_trace(self):
+        trace_events = []
+        process_id = os.getpid()
+
+        for thread_buffer, spans in self.get_spans():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_buffer.thread_id,
+                                 "args": {"name": thread_buffer.thread_name}})
+
+            for name, start_ns, end_ns in spans:
+                trace_events.append({"name": name, "ph": "X", "pid": process_id, "tid": thread_buffer.thread_id,
+                                     "ts": (start_ns - self.origin_ns) / 1000.0, "dur": (end_ns - start_ns) / 1000.0})
+
+        return {"traceEvents": trace_events, "displayTimeUnit": "ns"}
+
+    def to_folded_stacks(self):
+        """
+        :return: {"thread;outer;inner": self time in us}, spans nest by their times
+        """
+        folded_stacks = {}
+
+        for thread_buffer, spans in self.get_spans():
+            # (end_ns, stack key) of the enclosing spans
+            stack = []
+
+            for name, start_ns, end_ns in spans:
+                while stack and stack[-1][0] <= start_ns:
+                    stack.pop()
+
+                stack_key = (stack[-1][1] if stack else thread_buffer.thread_name) + ";" + name
+                duration_us = (end_ns - start_ns) / 1000.0
+
+                folded_stacks[stack_key] = folded_stacks.get(stack_key, 0.0) + duration_us
+
+                # what a child takes isn't the parent's own time
+                if stack:
+                    folded_stacks[stack[-1][1]] -= duration_us
+
+                stack.append((end_ns, stack_key))
+
+        return folded_stacks
+
+    def dump(self, output_path=None):
+        """
+        :param output_path: .json for a Chrome trace, anything else for folded stacks
+        """
+        name = "dump"
+
+        output_path = output_path or self.output_path
+
+        if output_path is None:
+            self.log.warning(name + ": no output path")
+            return
+
+        with open(output_path, "w") as output_file:
+            if output_path.endswith(".json"):
+                json.dump(self.to_chrome_trace(), output_file)
+            else:
+                for stack_key, self_time_us in sorted(self.to_folded_stacks().items()):
+                    output_file.write(stack_key.replace(" ", "_") + " " + str(max(0, int(round(self_time_us)))) +
+                                      "\n")
+
+        self.log.info(name + ": spans written to " + output_path)
+
+
+def get_worker_output_path(output_path, worker_name):
+    """
+    :return: output_path with worker_name put in front of the extension, e.g. trace.json -> trace.worker.json
+    """
+    root, extension = os.path.splitext(output_path)
+    return root + "." + worker_name + extension
+
+
+def make_profiler_from_environment():
+    output_path = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE)
+
+    dq_profiler = DQProfiler(enabled=bool(output_path), output_path=output_path or None)
+
+    if dq_profiler.enabled:
+        atexit.register(dq_profiler.dump)
+
+    return dq_profiler
+
+
+# shared by every manager and sink in the process so one dump covers the whole pipeline
+profiler = make_profiler_from_environment()
@@ -0,0 +1,280 @@
+from dataclasses import dataclass, asdict
+import json
+import logging
+import os
+import threading
+import numpy as np
+
+"""
+Picks srate, dec and deca for any requested per channel rate. See page 47 of Dataq-Instruments-Protocol.pdf:
+
+    scan rate = DIVIDEND / (srate * dec * deca)
+
+The ADC itself runs at DIVIDEND / srate scans per second and every dec * deca of those are averaged into one
+reported scan, so the planner looks for the largest dec * deca (most oversampling) that still hits the rate
+while keeping the ADC under the device throughput limit.
+
+The rate only depends on srate * dec * deca, so the search walks srate upwards and, for a batch of srates at a
+time, takes the largest dec * deca product inside the tolerance against every dec at once. It stops as soon as
+a higher srate can't allow more oversampling, so even very slow rates plan in milliseconds.
+"""
+
+# samples per second the DI-4108 can stream, all enabled channels combined
+DI4108_MAX_THROUGHPUT_HZ = 200000
+
+# the protocol allows srate down to 375 but the DI-4108 gets lost that low, around 3000 has proven safe
+DI4108_SAFE_MIN_S_RATE = 3000
+
+# srates evaluated per step of the search
+S_RATE_BATCH = 256
+
+
+@dataclass()
+class DQSampleRatePlan:
+    requested_rate_hz: float
+    number_of_channels: int
+    s_rate: int
+    dec: int
+    deca: int
+    achieved_rate_hz: float
+    # dec * deca, ADC scans averaged into each reported scan
+    oversampling: int
+    # relative difference between the achieved and requested rate
+    rate_error: float
+
+
+class DQSampleRatePlanner:
+
+    def __init__(self, scan_rate_limits, host_max_samples_per_second=None, rate_tolerance=1e-4, cache_file=None,
+                 max_throughput_hz=DI4108_MAX_THROUGHPUT_HZ, safe_min_s_rate=DI4108_SAFE_MIN_S_RATE):
+        """
+        :param scan_rate_limits: DQEnums.DQ4108.ScanRateLimits
+        :param host_max_samples_per_second: samples per second, all channels combined, the host can keep up with.
+        Requests over it are planned at the highest rate under it instead
+        :param rate_tolerance: relative rate error accepted in exchange for more oversampling
+        :param cache_file: JSON file plans are loaded from and saved to by save_cache, nothing is persisted if None
+        :param max_throughput_hz: device samples per second, all channels combined
+        :param safe_min_s_rate: lowest srate ever planned, above the protocol's SRATE_MIN
+        """
+        self.log = logging.getLogger("DQSampleRatePlanner")
+
+        self.limits = scan_rate_limits
+        self.host_max_samples_per_second = host_max_samples_per_second
+        self.rate_tolerance = rate_tolerance
+        self.cache_file = cache_file
+        self.max_throughput_hz = max_throughput_hz
+        self.safe_min_s_rate = safe_min_s_rate
+
+        self.plan_cache = {}
+        # plans made since the last save
+        self.cache_dirty = False
+        self.lock = threading.Lock()
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load_cache()
+
+    def __cache_key(self, rate_hz, number_of_channels):
+        return repr((float(rate_hz), int(number_of_channels), self.host_max_samples_per_second,
+                     self.rate_tolerance, self.safe_min_s_rate))
+
+    def load_cache(self):
+        name = "load_cache"
+
+        try:
+            with open(self.cache_file) as cache:
+                self.plan_cache = {key: DQSampleRatePlan(**plan) for key, plan in json.load(cache).items()}
+        except (OSError, ValueError, TypeError):
+            self.log.exception(name + ": ignoring " + str(self.cache_file))
+            self.plan_cache = {}
+
+    def save_cache(self):
+        """
+        Write the plans to cache_file if any were added since the last save. Planning only updates the cache in
+        memory, the owner saves once it is done, e.g. on disconnect.
+        """
+        if self.cache_file is None:
+            return
+
+        with self.lock:
+            if not self.cache_dirty:
+                return
+
+            plans = {key: asdict(plan) for key, plan in self.plan_cache.items()}
+            self.cache_dirty = False
+
+        with open(self.cache_file, "w") as cache:
+            json.dump(plans, cache, indent=2)
+
+    def get_minimum_s_rate(self, number_of_channels):
+        # slowest srate that keeps the ADC, all channels combined, under the device throughput limit
+        s_rate = int(np.ceil(self.limits.DIVIDEND * number_of_channels / self.max_throughput_hz))
+        return max(self.limits.SRATE_MIN, self.safe_min_s_rate, s_rate)
+
+    def split_oversampling(self, oversampling):
+        """
+        :return: (dec, deca) with dec * deca == oversampling inside the limits, None if there is no such pair
+        """
+        if oversampling <= self.limits.DEC_MAX:
+            return oversampling, 1
+
+        # largest dec first keeps deca, the multiplier, small
+        for dec in range(self.limits.DEC_MAX, self.limits.DEC_MIN - 1, -1):
+            if oversampling % dec == 0:
+                deca = oversampling // dec
+                if deca > self.limits.DECA_MAX:
+                    return None
+                return dec, deca
+
+        return None
+
+    def largest_oversampling_at_most(self, limits):
+        """
+        :param limits: int64 array of upper bounds
+        :return: for each bound the largest dec * deca inside the limits not above it, 0 if there is none
+        """
+        decs = np.arange(self.limits.DEC_MIN, self.limits.DEC_MAX + 1, dtype=np.int64)
+        decas = np.minimum(limits[:, None] // decs, self.limits.DECA_MAX)
+        products = np.where(decas >= self.limits.DECA_MIN, decs * decas, 0)
+
+        return products.max(axis=1)
+
+    def smallest_oversampling_at_least(self, limits):
+        """
+        :param limits: int64 array of lower bounds
+        :return: for each bound the smallest dec * deca inside the limits not below it, 0 if there is none
+        """
+        decs = np.arange(self.limits.DEC_MIN, self.limits.DEC_MAX + 1, dtype=np.int64)
+        decas = np.maximum(-(-limits[:, None] // decs), self.limits.DECA_MIN)
+        products = np.where(decas <= self.limits.DECA_MAX, decs * decas, np.iinfo(np.int64).max)
+        products = products.min(axis=1)
+
+        return np.where(products == np.iinfo(np.int64).max, 0, products)
+
+    def find_oversampling(self, ticks_per_scan, minimum_s_rate):
+        """
+        :param ticks_per_scan: DIVIDEND / target rate, the srate * dec * deca to aim for
+        :return: (srate, oversampling), the most oversampling within rate_tolerance, or if nothing is within it
+        the smallest error. None if no srate is left
+        """
+        maximum_oversampling = self.limits.DEC_MAX * self.limits.DECA_MAX
+
+        # no more oversampling than the lowest srate needs, same as the srate rounded to the target
+        highest = min(int(np.ceil(ticks_per_scan / minimum_s_rate)), maximum_oversampling)
+
+        if minimum_s_rate > self.limits.SRATE_MAX or int(ticks_per_scan / self.limits.SRATE_MAX) > highest:
+            return None
+
+        # srates outside of these can't get within the tolerance with any oversampling
+        s_rates = np.arange(max(minimum_s_rate, int(ticks_per_scan / ((1 + self.rate_tolerance) * highest))),
+                            min(self.limits.SRATE_MAX, int(ticks_per_scan / (1 - self.rate_tolerance))) + 1,
+                            dtype=np.int64)
+
+        # most oversampling within the tolerance, srate upwards until a higher one can't allow more
+        best = None
+        best_error = None
+
+        for batch_start in range(0, s_rates.shape[0], S_RATE_BATCH):
+            batch = s_rates[batch_start:batch_start + S_RATE_BATCH]
+            upper = np.minimum(np.floor(ticks_per_scan / (batch * (1 - self.rate_tolerance))), highest)
+
+            if best is not None and upper[0] < best[1]:
+                break
+
+            lower = np.ceil(ticks_per_scan / (batch * (1 + self.rate_tolerance)))
+            oversampling = self.largest_oversampling_at_most(upper.astype(np.int64))
+            within = (oversampling >= lower) & (oversampling > 0)
+
+            if not within.any():
+                continue
+
+            most = np.flatnonzero(within & (oversampling == oversampling[within].max()))
+            rate_error = np.abs(ticks_per_scan / (batch[most] * oversampling[most]) - 1)
+            candidate = most[np.argmin(rate_error)]
+
+            if best is None or oversampling[candidate] > best[1] or \
+                    (oversampling[candidate] == best[1] and rate_error.min() < best_error):
+                best = (int(batch[candidate]), int(oversampling[candidate]))
+                best_error = rate_error.min()
+
+        if best is not None:
+            return best
+
+        # nothing within the tolerance, the closest product below or above the target of each srate that could
+        # still be nearest, or the lowest srate when the target is faster than it
+        lowest_s_rate = max(minimum_s_rate, int(ticks_per_scan / maximum_oversampling))
+        highest_s_rate = max(min(self.limits.SRATE_MAX, int(np.ceil(ticks_per_scan))), lowest_s_rate)
+        s_rates = np.arange(lowest_s_rate, highest_s_rate + 1, dtype=np.int64)
+
+        for batch_start in range(0, s_rates.shape[0], S_RATE_BATCH):
+            batch = s_rates[batch_start:batch_start + S_RATE_BATCH]
+            ideal = np.clip(ticks_per_scan / batch, 1, maximum_oversampling)
+
+            for oversampling in (self.largest_oversampling_at_most(np.floor(ideal).astype(np.int64)),
+                                 self.smallest_oversampling_at_least(np.ceil(ideal).astype(np.int64))):
+                valid = np.flatnonzero(oversampling > 0)
+
+                if valid.shape[0] == 0:
+                    continue
+
+                rate_error = np.abs(ticks_per_scan / (batch[valid] * oversampling[valid]) - 1)
+                # least error, the most oversampling among equal errors
+                candidate = np.lexsort((-oversampling[valid], rate_error))[0]
+
+                if best is None or rate_error[candidate] < best_error or \
+                        (rate_error[candidate] == best_error and oversampling[valid[candidate]] > best[1]):
+                    best = (int(batch[valid[candidate]]), int(oversampling[valid[candidate]]))
+                    best_error = rate_error[candidate]
+
+        return best
+
+    def plan(self, rate_hz, number_of_channels):
+        """
+        :param rate_hz: wanted per channel rate
+        :param number_of_channels: entries in the scan list
+        :return: DQSampleRatePlan, None if nothing inside the limits comes close
+        """
+        name = "plan"
+
+        key = self.__cache_key(rate_hz, number_of_channels)
+
+        with self.lock:
+            if key in self.plan_cache:
+                return self.plan_cache[key]
+
+        target_rate_hz = float(rate_hz)
+
+        if self.host_max_samples_per_second is not None and \
+                target_rate_hz * number_of_channels > self.host_max_samples_per_second:
+            target_rate_hz = self.host_max_samples_per_second / number_of_channels
+            self.log.warning(name + ": " + str(rate_hz) + " Hz over the host budget, planning " +
+                             str(target_rate_hz) + " Hz")
+
+        dividend = float(self.limits.DIVIDEND)
+        found = self.find_oversampling(dividend / target_rate_hz, self.get_minimum_s_rate(number_of_channels))
+
+        if found is None:
+            self.log.error(name + ": no srate/dec/deca reaches " + str(target_rate_hz) + " Hz")
+            return None
+
+        s_rate, oversampling = found
+        dec, deca = self.split_oversampling(oversampling)
+        achieved_rate_hz = dividend / (s_rate * oversampling)
+
+        plan = DQSampleRatePlan(
+            requested_rate_hz=float(rate_hz),
+            number_of_channels=int(number_of_channels),
+            s_rate=s_rate,
+            dec=dec,
+            deca=deca,
+            achieved_rate_hz=achieved_rate_hz,
+            oversampling=oversampling,
+            rate_error=abs(achieved_rate_hz - target_rate_hz) / target_rate_hz
+        )
+
+        self.log.info(name + ": " + repr(plan))
+
+        with self.lock:
+            self.plan_cache[key] = plan
+            self.cache_dirty = True
+
+        return plan
@@ -0,0 +1,301 @@
+import logging
+import sys
+import threading
+import numpy as np
+
+from dataqComms import DataqCommsManager, DQDeviceConfiguration, DQEnums, DQMasks, DQPorts
+from dataqDiscovery import DQDeviceDiscovery
+from dataqProfiler import profiler
+
+"""
+One acquisition, start to stop. A session owns its DataqCommsManager, the count rings the receive thread writes to
+and a consumer thread that cuts the scans into fixed size blocks of voltages for the sinks. Nothing is kept at
+module level, so a process can run several sessions side by side. Each one binds its own client ports, give every
+session a DQPorts with different logger_command_data_client_port and logger_discovery_remote_port.
+"""
+
+
+class AcquisitionSession:
+
+    def __init__(self, dq_ports, logger_ip, client_ip, configuration: DQDeviceConfiguration, sample_rate_hz=None,
+                 points_per_block=None, ring_capacity_scans=None, device_info_cache_file=None):
+        """
+        :param dq_ports: DQPorts of this session
+        :param logger_ip: IP of the logger, or a list of IPs for a sync group, see DataqCommsManager
+        :param client_ip: IP the loggers should stream to
+        :param configuration: DQDeviceConfiguration uploaded on start
+        :param sample_rate_hz: per channel scan rate, the manager's default if None
+        :param points_per_block: scans per channel handed to a sink at a time, one second worth if None
+        :param ring_capacity_scans: scans buffered per device between the receive and consumer threads, ten
+        blocks worth if None
+        :param device_info_cache_file: JSON file that keeps device info between runs, see DataqCommsManager
+        """
+        self.log = logging.getLogger("AcquisitionSession")
+
+        self.dataq_comms = DataqCommsManager(dq_ports, logger_ip, client_ip, device_info_cache_file)
+        self.configuration = configuration
+
+        if sample_rate_hz is not None:
+            self.dataq_comms.set_sample_rate(sample_rate_hz, len(configuration.s_list))
+
+        self.points_per_block = int(points_per_block or max(1, round(self.dataq_comms.get_scan_rate_hz())))
+        self.ring_capacity_scans = ring_capacity_scans or 10 * self.points_per_block
+
+        # sink handlers per device order, each called with (channels x points_per_block) voltages, oldest first
+        self.sinks = [[] for _ in range(self.dataq_comms.sync_device_count)]
+        # voltages read from the rings that don't fill a block yet
+        self.pending_voltages = [[] for _ in range(self.dataq_comms.sync_device_count)]
+        self.pending_scan_counts = [0] * self.dataq_comms.sync_device_count
+        # scan index each device's next read should start at, and the scans lost to ring overruns
+        self.next_scan_indices = [0] * self.dataq_comms.sync_device_count
+        self.scans_overrun = [0] * self.dataq_comms.sync_device_count
+
+        self.consumer_thread = None
+        self.consumer_thread_enable = False
+        self.data_event = threading.Event()
+
+        self.started = False
+
+    def __enter__(self):
+        if not self.start():
+            raise OSError("could not start acquisition session with " + repr(self.dataq_comms.logger_ips))
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_sink(self, sink_handler, device_order=0):
+        """
+        :param sink_handler: callable taking a (channels x points_per_block) voltage ndarray, run on the consumer
+        thread, e.g. SpectralSink.voltage_data_sink_handler
+        """
+        self.sinks[device_order].append(sink_handler)
+
+    def remove_sink(self, sink_handler, device_order=0):
+        self.sinks[device_order].remove(sink_handler)
+
+    def start(self):
+        """
+        Bind the sockets, configure and connect the loggers and start streaming. Whatever got started is torn down
+        again if a step fails, the sockets are closed either way.
+        :return: True once data is on its way
+        """
+        name = "start"
+        self.log.info(name)
+
+        if self.started:
+            return True
+
+        try:
+            self.started = self.start_streaming()
+        except Exception as e:
+            self.log.exception(name + ": ")
+            self.started = False
+
+        if not self.started:
+            self.tear_down()
+
+        return self.started
+
+    def start_streaming(self):
+        name = "start_streaming"
+
+        dataq_comms = self.dataq_comms
+
+        dataq_comms.set_receive_buffer_size(max(dataq_comms.recv_buffer_size,
+                                                self.points_per_block * 2 * 2 * len(self.configuration.s_list)))
+        dataq_comms.enable_count_storage(self.ring_capacity_scans)
+
+        if not dataq_comms.initialize_socket():
+            self.log.error(name + ": failed to initialize socket")
+            return False
+
+        if not dataq_comms.configure_and_connect_device(self.configuration, self.receive_data_handler):
+            self.log.error(name + ": failed to connect " + repr(dataq_comms.logger_ips))
+            return False
+
+        self.consumer_thread_enable = True
+        self.consumer_thread = threading.Thread(target=self.consumer_runnable, daemon=True)
+        self.consumer_thread.start()
+
+        if not dataq_comms.start_acquisition():
+            self.log.error(name + ": failed to start acquisition")
+            return False
+
+        return True
+
+    def stop(self):
+        name = "stop"
+        self.log.info(name)
+
+        if not self.started:
+            return
+
+        self.tear_down()
+
+        self.started = False
+
+    def tear_down(self):
+        dataq_comms = self.dataq_comms
+
+        if dataq_comms.acquisition_running:
+            dataq_comms.stop_acquisition()
+
+        # disconnect_device also stops the keep-alives and the receive thread, it needs a configuration to send
+        if dataq_comms.device_configuration is not None:
+            dataq_comms.disconnect_device()
+        else:
+            dataq_comms.close_sockets()
+
+        if self.consumer_thread is not None:
+            self.consumer_thread_enable = False
+            self.data_event.set()
+            self.consumer_thread.join()
+            self.consumer_thread = None
+
+    def receive_data_handler(self, data_container):
+        # runs on the receive thread for every datagram, the consumer does the work
+        self.data_event.set()
+
+    def consumer_runnable(self):
+        name = "consumer_runnable"
+
+        while self.consumer_thread_enable:
+            self.data_event.wait(0.1)
+            self.data_event.clear()
+
+            for device_order in range(self.dataq_comms.sync_device_count):
+                self.consume(device_order)
+
+        self.log.info(name + ": exiting...")
+
+    def consume(self, device_order):
+        name = "consume"
+
+        count_buffer = self.dataq_comms.get_count_buffer(device_order)
+        first_scan_index, voltages = count_buffer.read_voltages()
+
+        # the receive thread lapped the ring, fill in the lost scans the way the decoder fills lost samples so the
+        # blocks stay on the device timeline
+        skipped_scans = first_scan_index - self.next_scan_indices[device_order]
+        self.next_scan_indices[device_order] = first_scan_index + voltages.shape[1]
+
+        if skipped_scans > 0:
+            self.log.warning(name + ": device " + str(device_order) + " ring overrun, " + str(skipped_scans) +
+                             " scans lost before scan " + str(first_scan_index))
+            self.scans_overrun[device_order] += skipped_scans
+            voltages = np.concatenate((np.zeros((voltages.shape[0], skipped_scans), dtype=voltages.dtype), voltages),
+                                      axis=1)
+
+        if voltages.shape[1] == 0:
+            return
+
+        self.pending_voltages[device_order].append(voltages)
+        self.pending_scan_counts[device_order] += voltages.shape[1]
+
+        if self.pending_scan_counts[device_order] < self.points_per_block:
+            return
+
+        pending = np.concatenate(self.pending_voltages[device_order], axis=1)
+        number_of_blocks = pending.shape[1] // self.points_per_block
+
+        for block_index in range(number_of_blocks):
+            block = pending[:, block_index * self.points_per_block:(block_index + 1) * self.points_per_block]
+
+            for sink_handler in self.sinks[device_order]:
+                with profiler.span("sink_handler"):
+                    sink_handler(block)
+
+        remainder = pending[:, number_of_blocks * self.points_per_block:]
+        self.pending_voltages[device_order] = [remainder]
+        self.pending_scan_counts[device_order] = remainder.shape[1]
+
+
+def main():
+    print("Entering main")
+
+    # Debug level and console print statements will influence scripts ability to handle large amounts of data
+    # https://www.loggly.com/ultimate-guide/python-logging-basics/
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    # plotting is only needed here, recorders that embed sessions never load matplotlib
+    from matplotSink import MatplotSink
+
+    # define ports, IPs, keys
+    dq_ports = DQPorts(
+        logger_discovery_local_port=1235,
+        logger_discovery_remote_port=1234,
+        logger_command_local_port=51235,
+        logger_command_data_client_port=1427
+    )
+
+    # find the logger with one broadcast, fall back to the usual address if nothing answers
+    discovered_devices = DQDeviceDiscovery(dq_ports).discover(expected_count=1)
+
+    if discovered_devices:
+        logger_ip = discovered_devices[0].ip
+        print("discovered " + repr(discovered_devices[0]))
+    else:
+        logger_ip = "192.168.9.2"
+    client_ip = "192.168.9.4"
+
+    my_group_key_id = int("0x06681444", 0)
+
+    # define channel config - channel 1 must be configured and first in the list even if ch 1 is not used
+    voltage_scale = DQMasks.DQ4108.ScanListDefinition.AnalogScale.PN_0V5
+    # from protocol doc: • slist positions must be defined sequentially beginning with position 0
+    # DO NOT skip channels or mix the order as this will completely screw up the measurement capture.
+    scan_list_configuration = {
+        DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch1: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch2: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch3: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch4: voltage_scale
+
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch5: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch6: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch7: voltage_scale
+        , DQMasks.DQ4108.ScanListDefinition.AnalogIn.ch8: voltage_scale
+    }
+
+    # buffer should be sized so that one periods worth of data is rendered once a second
+    sample_rate = DQEnums.SampleRate.SAMPLE_100HZ
+    per_channel_data_buffer_size = sample_rate
+    voltage_positive_reference = 0.5
+    voltage_negative_reference = -1 * voltage_positive_reference
+
+    # create configuration
+    dataq_config = DQDeviceConfiguration(
+        encode=DQEnums.Encoding.BINARY_DEFAULT,
+        ps=DQEnums.PacketSize.PS_512_BYTES,
+        s_list=scan_list_configuration,
+        device_role=DQEnums.DeviceRole.MASTER,
+        device_group_key_id=my_group_key_id,
+        device_group_order=0
+    )
+
+    acquisition_session = AcquisitionSession(dq_ports, logger_ip, client_ip, dataq_config,
+                                             sample_rate_hz=sample_rate,
+                                             points_per_block=per_channel_data_buffer_size)
+
+    matplot_sink = MatplotSink(len(scan_list_configuration), per_channel_data_buffer_size,
+                               voltage_negative_reference, voltage_positive_reference, 1)
+    # update_graph draws each block reversed
+    acquisition_session.add_sink(lambda voltage_channel_data:
+                                 matplot_sink.voltage_data_sink_handler(voltage_channel_data[:, ::-1]))
+
+    with acquisition_session:
+        # serial number from discovery, the other attributes only get queried the first time this logger is seen
+        acquisition_session.dataq_comms.use_discovered_devices(discovered_devices)
+        print("device info " + repr(acquisition_session.dataq_comms.get_device_info()))
+
+        matplot_sink.show_graph()
+
+        input("Press enter to stop...")
+
+        matplot_sink.close_graph()
+
+
+if __name__ == "__main__":
+    # DATAQ_PROFILE=trace.json python dataqSession.py for a Chrome trace of the run, see dataqProfiler
+    main()
@@ -0,0 +1,69 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+"""
+Startup benchmark. Imports each module in a fresh interpreter a number of times and reports the median import time
+and which heavy dependencies came along with it. A headless recorder should stay clear of all of them.
+
+    python dataqStartupBenchmark.py [repeats] [module ...]
+"""
+
+DEFAULT_MODULES = ("dataqDecoder", "dataqComms", "dataqSession", "dataqExport", "dataqFilter", "spectralSink",
+                   "matplotSink")
+
+# loading any of these at import time is a regression
+HEAVY_MODULES = ("matplotlib", "scipy", "h5py", "pyarrow", "http.server", "multiprocessing.shared_memory")
+
+IMPORT_PROBE = """
+import json, sys, time
+start_ns = time.perf_counter_ns()
+import {module_name}
+import_ns = time.perf_counter_ns() - start_ns
+print(json.dumps({{"import_ns": import_ns, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(module_name, repeats=5):
+    """
+    :return: (median import seconds, heavy modules loaded by the import)
+    """
+    import_times_s = []
+    heavy_modules = []
+
+    for _ in range(repeats):
+        probe = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module_name=module_name,
+                                                                          heavy=HEAVY_MODULES)],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+
+        if probe.returncode != 0:
+            raise ImportError(probe.stderr.strip().splitlines()[-1])
+
+        result = json.loads(probe.stdout.strip().splitlines()[-1])
+
+        import_times_s.append(result["import_ns"] * 1e-9)
+        heavy_modules = result["heavy"]
+
+    return statistics.median(import_times_s), heavy_modules
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    module_names = sys.argv[2:] or DEFAULT_MODULES
+
+    print("%-16s %10s  %s" % ("module", "import ms", "heavy modules loaded"))
+
+    for module_name in module_names:
+        try:
+            import_time_s, heavy_modules = measure_import(module_name, repeats)
+        except ImportError as e:
+            print("%-16s %10s  %s" % (module_name, "failed", e))
+            continue
+
+        print("%-16s %10.1f  %s" % (module_name, import_time_s * 1e3, ", ".join(heavy_modules) or "-"))
+
+
+if __name__ == "__main__":
+    main()
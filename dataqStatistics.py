@@ -0,0 +1,206 @@
+from collections import deque
+from dataclasses import dataclass
+import threading
+import numpy as np
+
+"""
+Running per channel statistics over a sliding window of decoded blocks. Each block is reduced to its moments,
+extremes and histogram once with NumPy, the window is then just a merge of those summaries so a dashboard polling
+get_statistics never touches the samples.
+"""
+
+
+@dataclass()
+class DQChannelStatistics:
+    # scans covered by the window
+    count: int
+    mean: np.ndarray
+    rms: np.ndarray
+    std: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+    # (channels x bins) sample counts, edges are shared by every channel
+    histogram: np.ndarray
+    histogram_edges: np.ndarray
+    # same values over the whole run, not just the window
+    total_count: int
+    total_mean: np.ndarray
+    total_std: np.ndarray
+    total_minimum: np.ndarray
+    total_maximum: np.ndarray
+
+
+@dataclass()
+class DQBlockSummary:
+    count: int
+    mean: np.ndarray
+    m2: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+    histogram: np.ndarray
+
+
+def merge_summaries(a: DQBlockSummary, b: DQBlockSummary):
+    """
+    Combine two summaries with Chan's parallel form of Welford's update.
+    """
+    if a.count == 0:
+        return b
+    if b.count == 0:
+        return a
+
+    count = a.count + b.count
+    delta = b.mean - a.mean
+
+    return DQBlockSummary(
+        count=count,
+        mean=a.mean + delta * (b.count / count),
+        m2=a.m2 + b.m2 + delta * delta * (a.count * b.count / count),
+        minimum=np.minimum(a.minimum, b.minimum),
+        maximum=np.maximum(a.maximum, b.maximum),
+        histogram=a.histogram + b.histogram
+    )
+
+
+class DQStreamingStatistics:
+
+    def __init__(self, number_of_channels, window_scans, histogram_bins=64, histogram_range=(-10.0, 10.0)):
+        """
+        :param number_of_channels: rows in each block
+        :param window_scans: approximate length of the sliding window. Whole blocks leave the window, so it spans
+        between window_scans and window_scans plus one block
+        :param histogram_bins: fixed bins per channel
+        :param histogram_range: (low, high) of the bins, samples outside land in the first or last bin
+        """
+        self.number_of_channels = number_of_channels
+        self.window_scans = window_scans
+
+        self.histogram_bins = histogram_bins
+        self.histogram_edges = np.linspace(histogram_range[0], histogram_range[1], histogram_bins + 1)
+        self.histogram_low = float(histogram_range[0])
+        self.histogram_bin_width = (histogram_range[1] - histogram_range[0]) / histogram_bins
+
+        # bincount offset of each channel so every channel's histogram is done in one call
+        self.histogram_channel_offsets = (np.arange(number_of_channels) * histogram_bins)[:, None]
+
+        self.window_summaries = deque()
+        self.window_count = 0
+        self.total_summary = self.empty_summary()
+
+        self.snapshot = None
+
+        self.lock = threading.Lock()
+
+    def empty_summary(self):
+        return DQBlockSummary(
+            count=0,
+            mean=np.zeros(self.number_of_channels),
+            m2=np.zeros(self.number_of_channels),
+            minimum=np.full(self.number_of_channels, np.inf),
+            maximum=np.full(self.number_of_channels, -np.inf),
+            histogram=np.zeros((self.number_of_channels, self.histogram_bins), dtype=np.int64)
+        )
+
+    def reset(self):
+        with self.lock:
+            self.window_summaries.clear()
+            self.window_count = 0
+            self.total_summary = self.empty_summary()
+            self.snapshot = None
+
+    def summarize(self, voltage_channel_data: np.ndarray):
+        count = voltage_channel_data.shape[1]
+
+        mean = voltage_channel_data.mean(axis=1)
+        deviations = voltage_channel_data - mean[:, None]
+
+        bin_index = np.floor((voltage_channel_data - self.histogram_low) / self.histogram_bin_width).astype(np.int64)
+        np.clip(bin_index, 0, self.histogram_bins - 1, out=bin_index)
+        histogram = np.bincount((bin_index + self.histogram_channel_offsets).ravel(),
+                                minlength=self.number_of_channels * self.histogram_bins)
+
+        return DQBlockSummary(
+            count=count,
+            mean=mean,
+            m2=np.einsum('ij,ij->i', deviations, deviations),
+            minimum=voltage_channel_data.min(axis=1),
+            maximum=voltage_channel_data.max(axis=1),
+            histogram=histogram.reshape(self.number_of_channels, self.histogram_bins)
+        )
+
+    def add_block(self, voltage_channel_data: np.ndarray):
+        """
+        :param voltage_channel_data: (channels x scans) voltages
+        """
+        if voltage_channel_data.shape[1] == 0:
+            return
+
+        block_summary = self.summarize(voltage_channel_data)
+
+        with self.lock:
+            self.window_summaries.append(block_summary)
+            self.window_count += block_summary.count
+
+            while self.window_count - self.window_summaries[0].count >= self.window_scans:
+                self.window_count -= self.window_summaries.popleft().count
+
+            self.total_summary = merge_summaries(self.total_summary, block_summary)
+
+            # the window is only merged again when someone asks for it
+            self.snapshot = None
+
+    def merge_window(self):
+        """
+        Merge every block summary in the window in one vectorized pass.
+        """
+        counts = np.array([summary.count for summary in self.window_summaries], dtype=float)
+        means = np.stack([summary.mean for summary in self.window_summaries])
+        count = counts.sum()
+        mean = counts @ means / count
+        deviations = means - mean
+
+        return DQBlockSummary(
+            count=int(count),
+            mean=mean,
+            m2=np.sum([summary.m2 for summary in self.window_summaries], axis=0) + counts @ (deviations * deviations),
+            minimum=np.min([summary.minimum for summary in self.window_summaries], axis=0),
+            maximum=np.max([summary.maximum for summary in self.window_summaries], axis=0),
+            histogram=np.sum([summary.histogram for summary in self.window_summaries], axis=0)
+        )
+
+    def __make_snapshot(self, window_summary, total_summary):
+        variance = window_summary.m2 / window_summary.count
+        total_variance = total_summary.m2 / total_summary.count
+
+        return DQChannelStatistics(
+            count=window_summary.count,
+            mean=window_summary.mean,
+            rms=np.sqrt(window_summary.mean * window_summary.mean + variance),
+            std=np.sqrt(variance),
+            minimum=window_summary.minimum,
+            maximum=window_summary.maximum,
+            histogram=window_summary.histogram,
+            histogram_edges=self.histogram_edges,
+            total_count=total_summary.count,
+            total_mean=total_summary.mean,
+            total_std=np.sqrt(total_variance),
+            total_minimum=total_summary.minimum,
+            total_maximum=total_summary.maximum
+        )
+
+    def get_statistics(self) -> DQChannelStatistics:
+        """
+        :return: latest statistics, None before the first block. The returned object is not updated afterwards,
+        repeated calls between blocks return the same object.
+        """
+        with self.lock:
+            if self.snapshot is None and self.window_summaries:
+                self.snapshot = self.__make_snapshot(self.merge_window(), self.total_summary)
+
+            return self.snapshot
+
+    def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
+        self.add_block(voltage_channel_data)
+
+    def decoded_block_handler(self, decoded_block):
+        self.add_block(decoded_block.voltages())
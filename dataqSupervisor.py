@@ -0,0 +1,134 @@
+from dataclasses import dataclass
+from enum import IntEnum
+import logging
+import threading
+
+"""
+Connection supervision. The expected packet cadence follows from the scan rate, scan list length and packet size,
+so a silent logger is noticed after a handful of packet periods instead of a fixed socket timeout. Every stretch
+of lost data, a short run of missing samples or a whole outage, goes into one gap index.
+"""
+
+GAP_KIND_MISSING_SAMPLES = 0
+GAP_KIND_OUTAGE = 1
+
+
+class DQConnectionState(IntEnum):
+    IDLE = 0
+    STREAMING = 1
+    STALLED = 2
+    RECOVERING = 3
+
+
+@dataclass()
+class DQGapRecord:
+    device_order: int
+    # first scan index, on the decoder's timeline, that has no real data
+    first_scan_index: int
+    scans: int
+    kind: int
+    # host monotonic times the gap was noticed and closed, outages only
+    start_host_ns: int = None
+    end_host_ns: int = None
+
+
+class DQConnectionSupervisor:
+
+    def __init__(self, stall_packet_periods=8, minimum_stall_s=0.05, maximum_stall_s=1.0,
+                 minimum_stall_packet_periods=3):
+        """
+        :param stall_packet_periods: packet periods without data before the link counts as stalled
+        :param minimum_stall_s: lower bound at high packet rates, so ordinary jitter isn't taken for a stall
+        :param maximum_stall_s: upper bound for slow packet rates so detection stays quick
+        :param minimum_stall_packet_periods: packet periods the timeout never goes under, whatever maximum_stall_s
+        says. At slow rates a packet can take longer than maximum_stall_s and a healthy logger would otherwise be
+        restarted between every two packets
+        """
+        self.log = logging.getLogger("DQConnectionSupervisor")
+
+        self.stall_packet_periods = stall_packet_periods
+        self.minimum_stall_s = minimum_stall_s
+        self.maximum_stall_s = maximum_stall_s
+        self.minimum_stall_packet_periods = minimum_stall_packet_periods
+
+        self.packet_interval_s = None
+        self.stall_timeout_s = maximum_stall_s
+
+        self.state = DQConnectionState.IDLE
+        self.last_packet_host_ns = None
+        self.outage_start_host_ns = None
+
+        self.gap_index = []
+        # how long each completed recovery took, last packet before the outage to first packet after it
+        self.recovery_durations_ns = []
+        self.recovery_attempts = 0
+
+        self.lock = threading.Lock()
+
+    def set_cadence(self, scan_rate_hz, number_of_channels, samples_per_packet):
+        name = "set_cadence"
+
+        self.packet_interval_s = samples_per_packet / (scan_rate_hz * number_of_channels)
+        maximum_stall_s = max(self.maximum_stall_s, self.minimum_stall_packet_periods * self.packet_interval_s)
+        self.stall_timeout_s = min(max(self.stall_packet_periods * self.packet_interval_s, self.minimum_stall_s),
+                                   maximum_stall_s)
+
+        self.log.info(name + ": packet every " + str(self.packet_interval_s) + " s, stall after " +
+                      str(self.stall_timeout_s) + " s")
+
+    def get_stall_timeout_s(self):
+        return self.stall_timeout_s
+
+    def get_state(self):
+        return self.state
+
+    def on_streaming_started(self, host_ns):
+        with self.lock:
+            self.state = DQConnectionState.STREAMING
+            self.last_packet_host_ns = host_ns
+
+    def on_stopped(self):
+        with self.lock:
+            self.state = DQConnectionState.IDLE
+
+    def on_packet(self, host_ns):
+        """
+        :return: True if this packet ended an outage
+        """
+        with self.lock:
+            self.last_packet_host_ns = host_ns
+
+            if self.state == DQConnectionState.STREAMING or self.state == DQConnectionState.IDLE:
+                return False
+
+            self.recovery_durations_ns.append(host_ns - self.outage_start_host_ns)
+
+            for gap_record in self.gap_index:
+                if gap_record.kind == GAP_KIND_OUTAGE and gap_record.end_host_ns is None:
+                    gap_record.end_host_ns = host_ns
+
+            self.state = DQConnectionState.STREAMING
+
+        self.log.info("on_packet: recovered after " + str(self.recovery_durations_ns[-1] / 1e6) + " ms")
+
+        return True
+
+    def on_stall(self):
+        with self.lock:
+            if self.state == DQConnectionState.STREAMING:
+                self.outage_start_host_ns = self.last_packet_host_ns
+
+            self.state = DQConnectionState.STALLED
+
+    def on_recovering(self):
+        with self.lock:
+            self.state = DQConnectionState.RECOVERING
+            self.recovery_attempts += 1
+
+    def add_gap(self, gap_record: DQGapRecord):
+        with self.lock:
+            self.gap_index.append(gap_record)
+
+    def get_gap_index(self):
+        with self.lock:
+            return list(self.gap_index)
@@ -0,0 +1,187 @@
+from collections import deque
+import logging
+import threading
+import numpy as np
+
+from dataqDecoder import DQDecodedBlock
+
+"""
+Joins the decoded blocks of every logger in a sync group into frames that cover the same instants on all devices.
+
+Each device counts its own scans from the sync start. A device whose first scan happened after the master's is
+given a timeline offset (in scans) so that:
+
+    timeline index = device scan index + device timeline offset
+
+Offsets normally come from the slave delays measured with FINDOUTSLAVEDELAY, see
+DataqCommsManager.measure_and_compensate_slave_delays.
+"""
+
+
+class DQSyncFrameAssembler:
+
+    def __init__(self, device_count, max_pending_scans=1000000):
+        """
+        :param device_count: number of loggers in the sync group
+        :param max_pending_scans: per device limit on buffered scans, oldest blocks are dropped past this so a
+        stalled device can't grow memory without bound
+        """
+        self.log = logging.getLogger("DQSyncFrameAssembler")
+
+        self.device_count = device_count
+        self.max_pending_scans = max_pending_scans
+
+        self.pending_blocks = [deque() for _ in range(device_count)]
+        self.pending_scan_counts = [0] * device_count
+
+        self.device_timeline_offsets = np.zeros(device_count, dtype=np.int64)
+
+        # first timeline index not yet handed out in a frame
+        self.next_frame_timeline_index = None
+
+        self.dropped_scans = 0
+
+        self.lock = threading.Lock()
+
+    def set_device_timeline_offset(self, device_order, offset_scans):
+        with self.lock:
+            self.device_timeline_offsets[device_order] = offset_scans
+
+    def get_device_timeline_offsets(self):
+        return self.device_timeline_offsets.copy()
+
+    def scan_index_to_timeline(self, device_order, scan_indices):
+        """
+        Vectorized mapping of one device's scan indices onto the group timeline.
+        """
+        return np.asarray(scan_indices, dtype=np.int64) + self.device_timeline_offsets[device_order]
+
+    def cumulative_count_to_timeline(self, device_order, cumulative_counts, number_of_channels):
+        """
+        Map DQAdcData.cumulative_count values (samples, not scans) onto the group timeline. Counts that fall
+        inside a scan map onto that scan.
+        """
+        scan_indices = np.asarray(cumulative_counts, dtype=np.int64) // number_of_channels
+        return self.scan_index_to_timeline(device_order, scan_indices)
+
+    def add_block(self, block: DQDecodedBlock):
+        name = "add_block"
+
+        if block.number_of_scans() == 0:
+            return
+
+        with self.lock:
+            device_blocks = self.pending_blocks[block.device_order]
+            device_blocks.append(block)
+            self.pending_scan_counts[block.device_order] += block.number_of_scans()
+
+            while self.pending_scan_counts[block.device_order] > self.max_pending_scans:
+                dropped = device_blocks.popleft()
+                self.pending_scan_counts[block.device_order] -= dropped.number_of_scans()
+                self.dropped_scans += dropped.number_of_scans()
+                self.log.warning(name + ": device " + str(block.device_order) + " backlog full, dropped " +
+                                 str(dropped.number_of_scans()) + " scans")
+
+    def __block_timeline_range(self, device_order, block: DQDecodedBlock):
+        offset = int(self.device_timeline_offsets[device_order])
+        return block.first_scan_index + offset, block.first_scan_index + block.number_of_scans() + offset
+
+    def __contiguous_timeline_end(self, device_order):
+        """
+        :return: end of the run of blocks that follow on from the device's first one without a hole, a resync or
+        a drop leaves one between blocks
+        """
+        device_blocks = self.pending_blocks[device_order]
+        _, contiguous_end = self.__block_timeline_range(device_order, device_blocks[0])
+
+        for block_index in range(1, len(device_blocks)):
+            block_first, block_last = self.__block_timeline_range(device_order, device_blocks[block_index])
+
+            if block_first != contiguous_end:
+                break
+
+            contiguous_end = block_last
+
+        return contiguous_end
+
+    def get_aligned_frame(self):
+        """
+        :return: (first_timeline_index, voltages) where voltages stacks the channels of device 0, then device 1,
+        etc. into one (total channels x scans) array. None until every device has data covering the same span
+        of the timeline.
+        """
+        with self.lock:
+            while True:
+                if not all(self.pending_blocks):
+                    return None
+
+                frame_start = max(self.__block_timeline_range(device_order, self.pending_blocks[device_order][0])[0]
+                                  for device_order in range(self.device_count))
+
+                if self.next_frame_timeline_index is not None:
+                    frame_start = max(frame_start, self.next_frame_timeline_index)
+
+                # blocks ending before the frame can't be matched on every device any more, e.g. the part of a
+                # device's data that another device has a hole for
+                stale_blocks = False
+
+                for device_order in range(self.device_count):
+                    device_blocks = self.pending_blocks[device_order]
+
+                    while device_blocks and self.__block_timeline_range(device_order, device_blocks[0])[1] <= \
+                            frame_start:
+                        stale = device_blocks.popleft()
+                        self.pending_scan_counts[device_order] -= stale.number_of_scans()
+                        stale_blocks = True
+
+                if not stale_blocks:
+                    break
+
+            # every device's first block covers frame_start now, the frame stops at the first hole on any device
+            frame_end = min(self.__contiguous_timeline_end(device_order) for device_order in range(self.device_count))
+
+            device_frames = []
+
+            for device_order in range(self.device_count):
+                device_blocks = self.pending_blocks[device_order]
+                offset = int(self.device_timeline_offsets[device_order])
+
+                # only the part of each block inside the frame is copied, not the whole backlog
+                frame_slices = []
+                next_block_first = None
+
+                for block in device_blocks:
+                    block_first = block.first_scan_index + offset
+
+                    # past the frame, or a block that overlaps the run after the device counted backwards
+                    if block_first >= frame_end or (next_block_first is not None and block_first != next_block_first):
+                        break
+
+                    next_block_first = block_first + block.number_of_scans()
+
+                    slice_start = max(frame_start - block_first, 0)
+                    slice_end = min(frame_end - block_first, block.number_of_scans())
+
+                    if slice_end > slice_start:
+                        frame_slices.append(block.counts[:, slice_start:slice_end])
+
+                frame_counts = frame_slices[0] if len(frame_slices) == 1 else np.concatenate(frame_slices, axis=1)
+
+                # scale only the slice that goes out
+                device_frames.append(DQDecodedBlock(
+                    device_order=device_order,
+                    first_scan_index=frame_start - offset,
+                    counts=frame_counts,
+                    scales=device_blocks[0].scales,
+                    missing_samples=0
+                ).voltages())
+
+                # keep only what is past the end of this frame
+                while device_blocks and device_blocks[0].first_scan_index + device_blocks[0].number_of_scans() + \
+                        int(self.device_timeline_offsets[device_order]) <= frame_end:
+                    consumed = device_blocks.popleft()
+                    self.pending_scan_counts[device_order] -= consumed.number_of_scans()
+
+            self.next_frame_timeline_index = frame_end
+
+            return frame_start, np.concatenate(device_frames, axis=0)
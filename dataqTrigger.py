@@ -0,0 +1,280 @@
+from dataclasses import dataclass
+import logging
+import os
+import queue
+import threading
+import numpy as np
+
+"""
+Trigger detection on the decoded stream. Conditions are evaluated on whole blocks with NumPy, only actual
+trigger events are handled one at a time. A pre-trigger history is kept so every event carries the samples
+leading up to it as well as the ones after.
+"""
+
+TRIGGER_RISING = 1
+TRIGGER_FALLING = -1
+TRIGGER_EITHER = 0
+
+
+@dataclass()
+class DQTriggerCondition:
+    channel_index: int
+    # volts for a level trigger, volts per second for a slope trigger
+    threshold: float
+    direction: int = TRIGGER_RISING
+    # level triggers fire when the signal crosses threshold, slope triggers when the rate of change does
+    slope: bool = False
+
+
+@dataclass()
+class DQTriggerEvent:
+    # index, counted from the first sample fed to the engine, of the sample that met the condition
+    trigger_sample_index: int
+    condition_index: int
+    condition: DQTriggerCondition
+    # (channels x samples) with the trigger sample at column pre_trigger_scans
+    data: np.ndarray
+    pre_trigger_scans: int
+
+
+class DQTriggerEngine:
+
+    def __init__(self, number_of_channels, conditions, pre_trigger_scans, post_trigger_scans, sample_rate_hz=1.0,
+                 holdoff_scans=None):
+        """
+        :param number_of_channels: rows in each block
+        :param conditions: list of DQTriggerCondition, any of them fires the trigger
+        :param pre_trigger_scans: samples kept before the trigger sample
+        :param post_trigger_scans: samples kept from the trigger sample on
+        :param sample_rate_hz: used to turn slope thresholds into a per sample difference
+        :param holdoff_scans: samples after a trigger during which further triggers are ignored, defaults to the
+        post trigger length so captures don't overlap
+        """
+        self.log = logging.getLogger("DQTriggerEngine")
+
+        self.number_of_channels = number_of_channels
+        self.conditions = list(conditions)
+        self.pre_trigger_scans = pre_trigger_scans
+        self.post_trigger_scans = post_trigger_scans
+        self.sample_rate_hz = float(sample_rate_hz)
+
+        if holdoff_scans is None:
+            holdoff_scans = post_trigger_scans
+
+        self.holdoff_scans = max(1, holdoff_scans)
+
+        self.event_handlers = []
+
+        self.reset()
+
+    def add_event_handler(self, event_handler):
+        """
+        :param event_handler: callable taking a DQTriggerEvent
+        """
+        self.event_handlers.append(event_handler)
+
+    def reset(self):
+        self.history = np.zeros((self.number_of_channels, 0))
+        # last sample of the previous block, crossings between blocks need it
+        self.previous_sample = None
+        self.previous_slope = np.zeros(self.number_of_channels)
+        self.samples_seen = 0
+        self.next_trigger_allowed_index = 0
+
+        # events still waiting on post trigger samples: [event, chunks, remaining]
+        self.pending_captures = []
+
+        self.events_emitted = 0
+
+    def __condition_positions(self, condition: DQTriggerCondition, channel_data, previous):
+        """
+        :return: positions within the block where the condition is met
+        """
+        row = channel_data[condition.channel_index]
+        before = np.concatenate(([previous[condition.channel_index]], row[:-1]))
+
+        if condition.slope:
+            # compare the per sample step against the threshold in V/s
+            signal_now = (row - before) * self.sample_rate_hz
+            signal_before = np.concatenate(([self.previous_slope[condition.channel_index]], signal_now[:-1]))
+        else:
+            signal_before = before
+            signal_now = row
+
+        rising = (signal_before < condition.threshold) & (signal_now >= condition.threshold)
+        falling = (signal_before > condition.threshold) & (signal_now <= condition.threshold)
+
+        if condition.direction == TRIGGER_RISING:
+            crossed = rising
+        elif condition.direction == TRIGGER_FALLING:
+            crossed = falling
+        else:
+            crossed = rising | falling
+
+        return np.flatnonzero(crossed)
+
+    def __detect(self, channel_data):
+        if self.previous_sample is None:
+            # nothing to cross from on the very first sample
+            previous = channel_data[:, 0]
+        else:
+            previous = self.previous_sample
+
+        positions = []
+        condition_indices = []
+
+        for condition_index, condition in enumerate(self.conditions):
+            condition_positions = self.__condition_positions(condition, channel_data, previous)
+            positions.append(condition_positions)
+            condition_indices.append(np.full(condition_positions.shape[0], condition_index))
+
+        positions = np.concatenate(positions)
+        condition_indices = np.concatenate(condition_indices)
+
+        order = np.argsort(positions, kind="stable")
+
+        return positions[order], condition_indices[order]
+
+    def add_block(self, voltage_channel_data: np.ndarray):
+        """
+        :param voltage_channel_data: (channels x samples)
+        :return: events completed by this block
+        """
+        number_of_samples = voltage_channel_data.shape[1]
+
+        if number_of_samples == 0:
+            return []
+
+        completed_events = self.__continue_captures(voltage_channel_data)
+
+        extended = np.concatenate((self.history, voltage_channel_data), axis=1)
+        history_length = self.history.shape[1]
+
+        positions, condition_indices = self.__detect(voltage_channel_data)
+
+        # walk trigger to trigger, skipping everything inside each holdoff
+        first_allowed = max(0, self.next_trigger_allowed_index - self.samples_seen)
+        candidate = np.searchsorted(positions, first_allowed)
+
+        while candidate < positions.shape[0]:
+            position = int(positions[candidate])
+            condition_index = int(condition_indices[candidate])
+
+            start = max(0, history_length + position - self.pre_trigger_scans)
+            pre_data = extended[:, start:history_length + position]
+            post_data = extended[:, history_length + position:history_length + position + self.post_trigger_scans]
+
+            event = DQTriggerEvent(
+                trigger_sample_index=self.samples_seen + position,
+                condition_index=condition_index,
+                condition=self.conditions[condition_index],
+                data=None,
+                pre_trigger_scans=pre_data.shape[1]
+            )
+
+            remaining = self.post_trigger_scans - post_data.shape[1]
+
+            if remaining == 0:
+                event.data = np.concatenate((pre_data, post_data), axis=1)
+                completed_events.append(event)
+            else:
+                self.pending_captures.append([event, [pre_data.copy(), post_data.copy()], remaining])
+
+            self.next_trigger_allowed_index = self.samples_seen + position + self.holdoff_scans
+            candidate = np.searchsorted(positions, position + self.holdoff_scans)
+
+        if number_of_samples > 1:
+            self.previous_slope = (voltage_channel_data[:, -1] - voltage_channel_data[:, -2]) * self.sample_rate_hz
+        elif self.previous_sample is not None:
+            self.previous_slope = (voltage_channel_data[:, -1] - self.previous_sample) * self.sample_rate_hz
+
+        self.previous_sample = voltage_channel_data[:, -1].copy()
+        self.history = extended[:, max(0, extended.shape[1] - self.pre_trigger_scans):].copy()
+        self.samples_seen += number_of_samples
+
+        for event in completed_events:
+            self.__emit(event)
+
+        return completed_events
+
+    def __continue_captures(self, voltage_channel_data):
+        completed_events = []
+        still_pending = []
+
+        for event, chunks, remaining in self.pending_captures:
+            chunk = voltage_channel_data[:, :remaining]
+            chunks.append(chunk.copy())
+            remaining -= chunk.shape[1]
+
+            if remaining == 0:
+                event.data = np.concatenate(chunks, axis=1)
+                completed_events.append(event)
+            else:
+                still_pending.append([event, chunks, remaining])
+
+        self.pending_captures = still_pending
+
+        return completed_events
+
+    def __emit(self, event: DQTriggerEvent):
+        self.events_emitted += 1
+
+        for event_handler in self.event_handlers:
+            event_handler(event)
+
+    def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
+        self.add_block(voltage_channel_data)
+
+    def decoded_block_handler(self, decoded_block):
+        self.add_block(decoded_block.voltages())
+
+
+class DQTriggerEventFileWriter:
+
+    def __init__(self, directory, file_prefix="trigger"):
+        """
+        Saves every event as its own .npz file from a background thread so the trigger engine never waits on
+        the disk.
+        """
+        self.log = logging.getLogger("DQTriggerEventFileWriter")
+
+        self.directory = directory
+        self.file_prefix = file_prefix
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.event_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.writer_runnable, daemon=True)
+        self.writer_thread.start()
+
+    def event_handler(self, event: DQTriggerEvent):
+        self.event_queue.put(event)
+
+    def writer_runnable(self):
+        name = "writer_runnable"
+
+        while True:
+            event = self.event_queue.get()
+
+            if event is None:
+                break
+
+            file_name = os.path.join(self.directory, self.file_prefix + "_" +
+                                     str(event.trigger_sample_index) + ".npz")
+
+            try:
+                np.savez(file_name,
+                         data=event.data,
+                         trigger_sample_index=event.trigger_sample_index,
+                         pre_trigger_scans=event.pre_trigger_scans,
+                         condition_index=event.condition_index,
+                         channel_index=event.condition.channel_index,
+                         threshold=event.condition.threshold)
+            except OSError:
+                self.log.exception(name + ": ")
+
+        self.log.info(name + ": exiting...")
+
+    def close(self):
+        self.event_queue.put(None)
+        self.writer_thread.join()
@@ -0,0 +1,296 @@
+import logging
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import sys
+import threading
+import time
+import numpy as np
+
+from dataqBuffers import DQScanRingBuffer
+from dataqDecodeKernel import decode_datagrams_into_ring
+from dataqDecoder import DQDeviceDecoder, DQDecodedBlock
+from dataqProfiler import DQProfiler, get_worker_output_path, profiler
+
+"""
+Runs the decode of each logger in a sync group in its own process so that several devices are not all
+fighting over one GIL. The coordinator (the receive thread of DataqCommsManager) owns the socket and forwards
+raw DQADCDATA datagrams to the worker for their device order. Workers decode into a ring of int16 counts in
+shared memory which the coordinator reads back without any pickling of sample data.
+"""
+
+# header slots at the start of each shared ring
+RING_SCANS_WRITTEN = 0
+RING_CUMULATIVE_SAMPLES_RECEIVED = 1
+RING_CUMULATIVE_MISSING_SAMPLES = 2
+RING_PACKETS_DECODED = 3
+RING_SCANS_RESERVED = 4
+RING_HEADER_SLOTS = 5
+
+
+def attach_shared_memory(shared_memory_name):
+    """
+    Attach to a segment created by another process without taking ownership of it. Before Python 3.13 attaching
+    registers the segment with the resource tracker, which unlinks it when the attaching process exits
+    (bpo-39959). Processes started through multiprocessing share the tracker of the creator though, there the
+    registration has to stay or the creator's unlink makes the tracker complain about an unknown segment. So it is
+    only undone when this process started a tracker of its own.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shared_memory_name, track=False)
+
+    # set when the tracker was inherited from the process that started this one
+    shares_tracker = getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+
+    attached_memory = shared_memory.SharedMemory(name=shared_memory_name)
+
+    if not shares_tracker:
+        resource_tracker.unregister(attached_memory._name, "shared_memory")
+
+    return attached_memory
+
+
+class DQSharedScanRing(DQScanRingBuffer):
+
+    def __init__(self, number_of_channels, capacity_scans, shared_memory_name=None, scales=None):
+        """
+        DQScanRingBuffer whose counts and header live in shared memory.
+        :param shared_memory_name: attach to an existing ring instead of creating one
+        """
+        header_bytes = RING_HEADER_SLOTS * np.dtype(np.int64).itemsize
+        data_bytes = number_of_channels * capacity_scans * np.dtype(np.int16).itemsize
+
+        self.owner = shared_memory_name is None
+
+        if self.owner:
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=header_bytes + data_bytes)
+        else:
+            self.shared_memory = attach_shared_memory(shared_memory_name)
+
+        self.header = np.ndarray((RING_HEADER_SLOTS,), dtype=np.int64, buffer=self.shared_memory.buf)
+
+        if self.owner:
+            self.header[:] = 0
+
+        counts = np.ndarray((number_of_channels, capacity_scans), dtype=np.int16, buffer=self.shared_memory.buf,
+                            offset=header_bytes)
+
+        super().__init__(number_of_channels, capacity_scans, scales, counts,
+                         self.header[RING_SCANS_WRITTEN:RING_SCANS_WRITTEN + 1],
+                         self.header[RING_SCANS_RESERVED:RING_SCANS_RESERVED + 1])
+
+    def get_name(self):
+        return self.shared_memory.name
+
+    def close(self):
+        # views into the buffer have to go before it can be closed
+        self.header = None
+        self.counts = None
+        self.scans_written = None
+        self.scans_reserved = None
+
+        self.shared_memory.close()
+
+        if self.owner:
+            self.shared_memory.unlink()
+
+
+def device_decode_worker(device_order, channel_scales, channel_kinds, capacity_scans, shared_memory_name,
+                         datagram_queue, profile_output_path=None, profile_origin_ns=None):
+    """
+    Worker process entry point. Decodes datagrams until a None is received.
+    :param profile_output_path: where this worker's decode spans are written on exit, not profiled if None
+    :param profile_origin_ns: origin_ns of the coordinator's profiler
+    """
+    log = logging.getLogger("device_decode_worker")
+    log.info("device_decode_worker: device " + str(device_order) + " starting")
+
+    # the profiler of the parent, if it was forked, never dumps from here, and the spans are per process anyway
+    worker_profiler = DQProfiler(enabled=profile_output_path is not None, output_path=profile_output_path,
+                                 origin_ns=profile_origin_ns)
+    threading.current_thread().name = "device_decode_worker_" + str(device_order)
+
+    dq_decoder = DQDeviceDecoder(device_order, channel_scales, channel_kinds)
+    scan_ring = DQSharedScanRing(len(channel_scales), capacity_scans, shared_memory_name)
+
+    while True:
+        datagrams = datagram_queue.get()
+
+        if datagrams is None:
+            break
+
+        span_start_ns = worker_profiler.begin()
+
+        # one pass per batch straight into the shared ring, numba compiled if it is installed
+        decode_datagrams_into_ring(dq_decoder, datagrams, scan_ring)
+
+        worker_profiler.end("worker_decode", span_start_ns)
+
+        scan_ring.header[RING_CUMULATIVE_SAMPLES_RECEIVED] = dq_decoder.cumulative_samples_received
+        scan_ring.header[RING_CUMULATIVE_MISSING_SAMPLES] = dq_decoder.cumulative_missing_samples
+        scan_ring.header[RING_PACKETS_DECODED] += len(datagrams)
+
+    scan_ring.close()
+
+    # multiprocessing leaves without running atexit, so the worker dumps its own spans
+    if worker_profiler.enabled:
+        worker_profiler.dump()
+
+    log.info("device_decode_worker: device " + str(device_order) + " exiting...")
+
+
+class DQShardedDecodeCoordinator:
+
+    def __init__(self, device_count, channel_scales, channel_kinds, capacity_scans=1000000, batch_size=1,
+                 max_batch_delay_s=0.05):
+        """
+        :param device_count: number of loggers, one worker process is started per logger
+        :param channel_scales: full scale voltage for each scan list position
+        :param channel_kinds: CHANNEL_KIND_* of each scan list position
+        :param capacity_scans: scans each shared ring can hold before unread data is overwritten
+        :param batch_size: datagrams forwarded per queue put, larger batches trade latency for less IPC overhead
+        :param max_batch_delay_s: a batch that would take longer than this to fill at the current packet rate is
+        forwarded early, so slow scan rates are not held back by a large batch_size
+        """
+        self.log = logging.getLogger("DQShardedDecodeCoordinator")
+
+        self.device_count = device_count
+        self.channel_scales = np.asarray(channel_scales, dtype=float)
+        self.channel_kinds = list(channel_kinds)
+        self.capacity_scans = capacity_scans
+        self.batch_size = batch_size
+        self.max_batch_delay_s = max_batch_delay_s
+
+        self.scan_rings = []
+        self.datagram_queues = []
+        self.pending_datagrams = []
+        self.batch_start_s = []
+        self.last_dispatch_s = []
+        self.workers = []
+
+    def start(self):
+        name = "start"
+        self.log.info(name)
+
+        # every acquisition calls this, the workers keep running until stop
+        if self.workers:
+            return
+
+        for device_order in range(self.device_count):
+            scan_ring = DQSharedScanRing(len(self.channel_scales), self.capacity_scans, scales=self.channel_scales)
+            datagram_queue = multiprocessing.Queue()
+
+            profile_output_path = None
+
+            if profiler.enabled and profiler.output_path is not None:
+                profile_output_path = get_worker_output_path(profiler.output_path,
+                                                             "decode_worker_" + str(device_order))
+
+            worker = multiprocessing.Process(
+                target=device_decode_worker,
+                args=(device_order, self.channel_scales.tolist(), self.channel_kinds, self.capacity_scans,
+                      scan_ring.get_name(), datagram_queue, profile_output_path, profiler.origin_ns),
+                daemon=True
+            )
+            worker.start()
+
+            self.scan_rings.append(scan_ring)
+            self.datagram_queues.append(datagram_queue)
+            self.pending_datagrams.append([])
+            self.batch_start_s.append(0.0)
+            self.last_dispatch_s.append(None)
+            self.workers.append(worker)
+
+    def dispatch(self, device_order, datagram):
+        """
+        Queue a raw DQADCDATA datagram for the worker of its device.
+        """
+        now_s = time.monotonic()
+        pending = self.pending_datagrams[device_order]
+
+        if not pending:
+            self.batch_start_s[device_order] = now_s
+
+        pending.append(bytes(datagram))
+
+        last_dispatch_s = self.last_dispatch_s[device_order]
+        packet_interval_s = 0.0 if last_dispatch_s is None else now_s - last_dispatch_s
+        self.last_dispatch_s[device_order] = now_s
+
+        # when the batch will be full if packets keep arriving at the rate of the last one
+        fill_delay_s = now_s - self.batch_start_s[device_order] + \
+            packet_interval_s * (self.batch_size - len(pending))
+
+        if len(pending) >= self.batch_size or fill_delay_s > self.max_batch_delay_s:
+            self.datagram_queues[device_order].put(pending)
+            self.pending_datagrams[device_order] = []
+
+    def flush(self):
+        for device_order, pending in enumerate(self.pending_datagrams):
+            if pending:
+                self.datagram_queues[device_order].put(pending)
+                self.pending_datagrams[device_order] = []
+
+    def read_decoded_block(self, device_order):
+        """
+        :return: DQDecodedBlock with every scan the worker decoded since the last call
+        """
+        first_scan_index, counts = self.scan_rings[device_order].read()
+
+        return DQDecodedBlock(
+            device_order=device_order,
+            first_scan_index=first_scan_index,
+            counts=counts,
+            scales=self.channel_scales,
+            missing_samples=0
+        )
+
+    def get_queue_depth(self, device_order):
+        """
+        :return: datagrams waiting for the worker, queued batches count as batch_size each, 0 when not started
+        """
+        if device_order >= len(self.datagram_queues):
+            return 0
+
+        try:
+            queued_batches = self.datagram_queues[device_order].qsize()
+        except NotImplementedError:
+            # no qsize on macOS
+            queued_batches = 0
+
+        return queued_batches * self.batch_size + len(self.pending_datagrams[device_order])
+
+    def get_device_counters(self, device_order):
+        header = self.scan_rings[device_order].header
+
+        return {
+            "scans_written": int(header[RING_SCANS_WRITTEN]),
+            "cumulative_samples_received": int(header[RING_CUMULATIVE_SAMPLES_RECEIVED]),
+            "cumulative_missing_samples": int(header[RING_CUMULATIVE_MISSING_SAMPLES]),
+            "packets_decoded": int(header[RING_PACKETS_DECODED]),
+            "scans_overrun": self.scan_rings[device_order].scans_overrun
+        }
+
+    def stop(self):
+        name = "stop"
+        self.log.info(name)
+
+        self.flush()
+
+        for datagram_queue in self.datagram_queues:
+            datagram_queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        for datagram_queue in self.datagram_queues:
+            datagram_queue.close()
+
+        for scan_ring in self.scan_rings:
+            scan_ring.close()
+
+        self.scan_rings = []
+        self.datagram_queues = []
+        self.pending_datagrams = []
+        self.batch_start_s = []
+        self.last_dispatch_s = []
+        self.workers = []
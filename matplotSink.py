@@ -5,12 +5,15 @@ Matplot example this is derived from
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import math
-import random
 import time
 
+from dataqLazy import lazy_import
+from syntheticSource import SyntheticSignalSource
+
+# matplotlib is only imported once a MatplotSink is created
+plt = lazy_import("matplotlib.pyplot")
+animation = lazy_import("matplotlib.animation")
+
 
 class MatplotSink:
 
@@ -40,23 +43,19 @@ class MatplotSink:
         return self.lines
 
     def data_gen_demo(self):
-        phase_offset = math.pi / 2
-
         demo_freq_hz = 10
-        demo_rad_s = 2 * math.pi * demo_freq_hz
 
         print("data_gen()")
 
-        while True:
+        # one plot window per second of synthetic data, scaled into 0..1 like the original demo
+        demo_source = SyntheticSignalSource(self.number_of_plots,
+                                            sample_rate_hz=self.number_of_points_to_plot,
+                                            frequencies_hz=demo_freq_hz,
+                                            amplitudes=0.5,
+                                            offsets=0.5,
+                                            noise_amplitudes=0.05)
 
-            channel_data = np.zeros(shape=(self.number_of_plots, self.number_of_points_to_plot), dtype=float)
-
-            for channel_index in range(self.number_of_plots):
-                for sample_index in range(self.number_of_points_to_plot):
-                    value = math.sin(demo_freq_hz * (sample_index/self.number_of_points_to_plot)) + random.uniform(0.0, 0.1)
-                    channel_data[channel_index][sample_index] = (value + 1.0) * 0.5
-
-            yield channel_data
+        yield from demo_source.data_gen(self.number_of_points_to_plot)
 
     def data_transfer(self):
         print("data_transfer")
@@ -84,6 +83,11 @@ class MatplotSink:
     def get_plot_update_intervale_ms(self):
         return self.plot_update_interval_ms
 
+    def psd_data_sink_handler(self, psd_channel_data: np.ndarray):
+        # for SpectralSink output, create the sink with fft_size // 2 + 1 points per channel. update_graph plots
+        # the data reversed, so store it reversed to keep frequency increasing left to right
+        self.channel_data = psd_channel_data[:, ::-1].copy()
+
     def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
         name = "voltage_data_sink_handler"
         # print(name)
@@ -0,0 +1,160 @@
+"""
+Streaming spectral analysis of channel data. Samples are collected into overlapping windows as they arrive and
+every window that completes is transformed with one batched rfft covering all channels.
+"""
+
+from dataclasses import dataclass
+import logging
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+@dataclass()
+class DQPsdFrame:
+    # samples fed into the sink before the first sample of the newest window
+    first_sample_index: int
+    frequencies_hz: np.ndarray
+    # (channels x bins) power spectral density in V^2/Hz
+    psd: np.ndarray
+    # windows averaged into psd
+    windows_averaged: int
+
+
+class SpectralSink:
+
+    def __init__(self, number_of_channels, sample_rate_hz, fft_size=1024, overlap=0.5, window=np.hanning,
+                 averaging=1.0):
+        """
+        :param number_of_channels: rows in each block
+        :param sample_rate_hz: per channel sample rate of the incoming blocks
+        :param fft_size: samples per window
+        :param overlap: fraction of each window shared with the next one, 0 <= overlap < 1
+        :param window: function returning the taper for a given length
+        :param averaging: exponential averaging weight of each new window, 1.0 publishes every window on its own
+        """
+        self.log = logging.getLogger("SpectralSink")
+
+        self.number_of_channels = number_of_channels
+        self.sample_rate_hz = float(sample_rate_hz)
+        self.fft_size = fft_size
+        self.hop_size = max(1, int(round(fft_size * (1 - overlap))))
+        self.averaging = averaging
+
+        self.window = np.asarray(window(fft_size), dtype=float)
+        self.frequencies_hz = np.fft.rfftfreq(fft_size, 1.0 / self.sample_rate_hz)
+
+        # one sided density scaling, the DC and Nyquist bins aren't doubled
+        self.psd_scale = np.full(self.frequencies_hz.shape[0], 2.0 / (self.sample_rate_hz * np.sum(self.window ** 2)))
+        self.psd_scale[0] /= 2
+        if fft_size % 2 == 0:
+            self.psd_scale[-1] /= 2
+
+        # preallocated: enough room for a window's worth of history plus a large incoming block
+        self.pending_samples = np.zeros((number_of_channels, 4 * fft_size))
+        self.pending_count = 0
+        # sample index of pending_samples[:, 0]
+        self.pending_first_sample_index = 0
+
+        self.averaged_psd = None
+        self.windows_averaged = 0
+        self.latest_psd_frame = None
+
+        self.psd_handlers = []
+
+        self.lock = threading.Lock()
+
+    def add_psd_handler(self, psd_handler, decibels=False):
+        """
+        :param psd_handler: callable taking a (channels x bins) ndarray, e.g. MatplotSink.psd_data_sink_handler
+        :param decibels: hand over 10*log10 of the density instead
+        """
+        self.psd_handlers.append((psd_handler, decibels))
+
+    def reset(self):
+        with self.lock:
+            self.pending_count = 0
+            self.pending_first_sample_index = 0
+            self.averaged_psd = None
+            self.windows_averaged = 0
+            self.latest_psd_frame = None
+
+    def __append(self, channel_data):
+        number_of_samples = channel_data.shape[1]
+        needed = self.pending_count + number_of_samples
+
+        if needed > self.pending_samples.shape[1]:
+            grown = np.zeros((self.number_of_channels, max(needed, 2 * self.pending_samples.shape[1])))
+            grown[:, :self.pending_count] = self.pending_samples[:, :self.pending_count]
+            self.pending_samples = grown
+
+        self.pending_samples[:, self.pending_count:needed] = channel_data
+        self.pending_count = needed
+
+    def add_block(self, voltage_channel_data: np.ndarray):
+        """
+        :param voltage_channel_data: (channels x samples)
+        :return: DQPsdFrame if the block completed at least one window, otherwise None
+        """
+        with self.lock:
+            self.__append(voltage_channel_data)
+
+            if self.pending_count < self.fft_size:
+                return None
+
+            # every complete window at once: (channels x windows x fft_size)
+            windows = sliding_window_view(self.pending_samples[:, :self.pending_count], self.fft_size,
+                                          axis=1)[:, ::self.hop_size]
+            number_of_windows = windows.shape[1]
+
+            spectra = np.fft.rfft(windows * self.window, axis=2)
+            window_psd = (spectra.real ** 2 + spectra.imag ** 2) * self.psd_scale
+
+            for window_index in range(number_of_windows):
+                if self.averaged_psd is None or self.averaging >= 1.0:
+                    self.averaged_psd = window_psd[:, window_index]
+                else:
+                    self.averaged_psd = self.averaged_psd + self.averaging * (window_psd[:, window_index] -
+                                                                              self.averaged_psd)
+            self.windows_averaged += number_of_windows
+
+            last_window_start = (number_of_windows - 1) * self.hop_size
+            frame = DQPsdFrame(
+                first_sample_index=self.pending_first_sample_index + last_window_start,
+                frequencies_hz=self.frequencies_hz,
+                psd=self.averaged_psd.copy(),
+                windows_averaged=self.windows_averaged
+            )
+
+            # keep what the next window needs
+            consumed = number_of_windows * self.hop_size
+            remaining = self.pending_count - consumed
+            self.pending_samples[:, :remaining] = self.pending_samples[:, consumed:self.pending_count]
+            self.pending_count = remaining
+            self.pending_first_sample_index += consumed
+
+            self.latest_psd_frame = frame
+
+        self.__publish(frame)
+
+        return frame
+
+    def __publish(self, frame: DQPsdFrame):
+        decibel_psd = None
+
+        for psd_handler, decibels in self.psd_handlers:
+            if decibels:
+                if decibel_psd is None:
+                    decibel_psd = 10 * np.log10(np.maximum(frame.psd, np.finfo(float).tiny))
+                psd_handler(decibel_psd)
+            else:
+                psd_handler(frame.psd)
+
+    def get_latest_psd_frame(self) -> DQPsdFrame:
+        return self.latest_psd_frame
+
+    def voltage_data_sink_handler(self, voltage_channel_data: np.ndarray):
+        self.add_block(voltage_channel_data)
+
+    def decoded_block_handler(self, decoded_block):
+        self.add_block(decoded_block.voltages())
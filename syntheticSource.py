@@ -0,0 +1,166 @@
+"""
+Synthetic signal source that produces channel data in the same (channels x samples) layout the
+sinks receive from the logger. Useful as a load generator for the plotting and processing code
+without a DI-4108 on the network.
+"""
+
+import logging
+import threading
+import time
+import numpy as np
+
+from dataqRatePlanner import DI4108_MAX_THROUGHPUT_HZ
+
+
+class SyntheticSignalSource:
+
+    def __init__(self, number_of_channels, sample_rate_hz=DI4108_MAX_THROUGHPUT_HZ, frequencies_hz=None,
+                 phases_rad=None, amplitudes=None, offsets=None, noise_amplitudes=None, seed=None):
+        """
+        Every per-channel argument accepts either a scalar (applied to all channels) or a sequence with one
+        entry per channel.
+        :param number_of_channels: rows in each generated block
+        :param sample_rate_hz: per channel sample rate
+        :param frequencies_hz: sine frequency of each channel
+        :param phases_rad: starting phase of each channel
+        :param amplitudes: peak amplitude of each channel
+        :param offsets: DC offset added to each channel
+        :param noise_amplitudes: peak to peak amplitude of the uniform noise added to each channel
+        :param seed: seed for the noise generator, for repeatable runs
+        """
+        self.log = logging.getLogger("SyntheticSignalSource")
+
+        self.number_of_channels = number_of_channels
+        self.sample_rate_hz = float(sample_rate_hz)
+
+        self.frequencies_hz = self.__per_channel(frequencies_hz, 10.0)
+        self.amplitudes = self.__per_channel(amplitudes, 1.0)
+        self.offsets = self.__per_channel(offsets, 0.0)
+        self.noise_amplitudes = self.__per_channel(noise_amplitudes, 0.0)
+
+        # phase is accumulated per block and wrapped so long runs don't lose precision
+        self.channel_phases_rad = self.__per_channel(phases_rad, 0.0)
+        self.samples_generated = 0
+
+        self.random_generator = np.random.default_rng(seed)
+
+        # sample offsets inside a block, reused between calls of the same size
+        self.sample_ramp = np.arange(0, dtype=float)
+
+        self.source_thread_enable = False
+        self.source_thread = None
+        self.source_thread_event = threading.Event()
+
+    def __per_channel(self, value, default):
+        if value is None:
+            value = default
+
+        values = np.asarray(value, dtype=float)
+
+        if values.ndim == 0:
+            return np.full(self.number_of_channels, float(values))
+
+        if values.shape != (self.number_of_channels,):
+            raise ValueError("expected " + str(self.number_of_channels) + " per channel values, got " +
+                             str(values.shape))
+
+        return values.copy()
+
+    def set_channel(self, channel_index, frequency_hz=None, phase_rad=None, amplitude=None, offset=None,
+                    noise_amplitude=None):
+        if frequency_hz is not None:
+            self.frequencies_hz[channel_index] = frequency_hz
+        if phase_rad is not None:
+            self.channel_phases_rad[channel_index] = phase_rad
+        if amplitude is not None:
+            self.amplitudes[channel_index] = amplitude
+        if offset is not None:
+            self.offsets[channel_index] = offset
+        if noise_amplitude is not None:
+            self.noise_amplitudes[channel_index] = noise_amplitude
+
+    def generate_block(self, number_of_samples, out=None):
+        """
+        Generate the next block of samples. Phase is continuous between consecutive blocks.
+        :param number_of_samples: samples per channel
+        :param out: optional preallocated (channels x samples) float array to fill
+        :return: (channels x samples) array
+        """
+        if self.sample_ramp.shape[0] != number_of_samples:
+            self.sample_ramp = np.arange(number_of_samples, dtype=float)
+
+        if out is None:
+            out = np.empty(shape=(self.number_of_channels, number_of_samples), dtype=float)
+
+        radians_per_sample = 2 * np.pi * self.frequencies_hz / self.sample_rate_hz
+
+        np.multiply.outer(radians_per_sample, self.sample_ramp, out=out)
+        out += self.channel_phases_rad[:, None]
+        np.sin(out, out=out)
+        out *= self.amplitudes[:, None]
+        out += self.offsets[:, None]
+
+        if np.any(self.noise_amplitudes):
+            out += self.noise_amplitudes[:, None] * self.random_generator.random(size=out.shape)
+
+        self.channel_phases_rad = np.mod(self.channel_phases_rad + radians_per_sample * number_of_samples,
+                                         2 * np.pi)
+        self.samples_generated += number_of_samples
+
+        return out
+
+    def data_gen(self, number_of_samples):
+        """
+        Endless generator of blocks, matches the generator protocol FuncAnimation expects.
+        """
+        while True:
+            yield self.generate_block(number_of_samples)
+
+    def start(self, sink_handler, number_of_samples, real_time=True):
+        """
+        Push blocks into sink_handler from a background thread.
+        :param sink_handler: callable taking a (channels x samples) ndarray, same as the logger sinks
+        :param number_of_samples: samples per channel handed over per call
+        :param real_time: pace blocks at sample_rate_hz, otherwise generate as fast as possible
+        """
+        name = "start"
+        self.log.info(name)
+
+        self.source_thread_enable = True
+        self.source_thread = threading.Thread(target=self.source_runnable,
+                                              args=(sink_handler, number_of_samples, real_time))
+        self.source_thread.start()
+        self.source_thread_event.set()
+
+    def stop(self):
+        name = "stop"
+        self.log.info(name)
+
+        if self.source_thread is not None:
+            self.source_thread_enable = False
+            self.source_thread_event.set()
+            self.source_thread.join()
+            self.source_thread = None
+
+    def source_runnable(self, sink_handler, number_of_samples, real_time):
+        name = "source_runnable"
+
+        block_period_sec = number_of_samples / self.sample_rate_hz
+        next_block_time = time.perf_counter()
+
+        self.source_thread_event.wait()
+
+        while self.source_thread_enable:
+            sink_handler(self.generate_block(number_of_samples))
+
+            if real_time:
+                next_block_time += block_period_sec
+                sleep_time = next_block_time - time.perf_counter()
+
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                else:
+                    # fell behind, don't try to catch up with a burst
+                    next_block_time = time.perf_counter()
+
+        self.log.info(name + ": exiting...")